@@ -1,10 +1,68 @@
+import json
+from datetime import timedelta
 from django.contrib import admin
 from django.contrib import messages
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
+from django.db import connection
+from django.http import StreamingHttpResponse
+from django.template.response import TemplateResponse
+from django.utils import timezone
+from django.utils.functional import cached_property
 from django.utils.html import format_html
-from django.db.models import Sum, F, Count, OuterRef, Subquery, Max
-from django.urls import reverse
+from django.db.models import Count, Sum
+from django.urls import path, reverse
 from django.utils.http import urlencode
-from .models import Category, Product, FAQ, CartItem, Order, OrderItem, TelegramUser, Broadcast
+from .exports import OrderExportForm, csv_stream, order_lines, xlsx_stream
+from .models import (Category, Product, FAQ, CartItem, Order, OrderItem, TelegramUser, Broadcast, SalesDaily,
+                     SalesHourly)
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Число строк для больших списков берет из оценки планировщика Postgres (EXPLAIN) вместо COUNT(*),
+    который на каждой странице читает все подходящие строки. Если оценка меньше ESTIMATE_MIN_ROWS,
+    строк считается точно: небольшие выборки (заказы одного пользователя, поиск) считаются быстро.
+    """
+    ESTIMATE_MIN_ROWS = 100_000
+
+    @cached_property
+    def count(self):
+        sql, params = self.object_list.order_by().query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        estimate = plan[0]['Plan']['Plan Rows']
+        if estimate >= self.ESTIMATE_MIN_ROWS:
+            return int(estimate)
+        return super().count
+
+class OrderStatusFilter(admin.SimpleListFilter):
+    """Фильтр по статусу: список статусов читается из индекса, а не через DISTINCT по всей таблице."""
+    title = 'status'
+    parameter_name = 'status__exact'
+
+    def lookups(self, request, model_admin):
+        # Рекурсивный запрос переходит от статуса к следующему по индексу shop_order_status_created_idx:
+        # по одному короткому поиску на каждый статус
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                WITH RECURSIVE statuses AS (
+                    (SELECT status FROM shop_order ORDER BY status LIMIT 1)
+                    UNION ALL
+                    SELECT (SELECT o.status FROM shop_order o WHERE o.status > s.status ORDER BY o.status LIMIT 1)
+                    FROM statuses s
+                    WHERE s.status IS NOT NULL
+                )
+                SELECT status FROM statuses WHERE status IS NOT NULL
+            """)
+            return [(status, status) for status, in cursor.fetchall()]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(status=self.value())
+        return queryset
 
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
@@ -18,6 +76,12 @@ class ProductAdmin(admin.ModelAdmin):
     list_filter = ("category", "is_active")
     search_fields = ("name",)
 
+    def save_model(self, request, obj, form, change):
+        # Новое изображение нужно заново загрузить в Telegram, старый file_id больше не подходит
+        if 'image' in form.changed_data:
+            obj.image_file_id = ''
+        super().save_model(request, obj, form, change)
+
     def image_thumbnail(self, obj):
         if obj.image:
             return format_html('<img src="{}" width="50" height="50" />', obj.image.url)
@@ -44,31 +108,63 @@ class CartItemAdmin(admin.ModelAdmin):
 
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
-    list_display = ("id", "user_id", "status", "order_summary", "total_cost_display", "created_at")
-    list_filter = ("status",)
+    list_display = ("id", "user_id", "status", "item_count", "total_cost_display", "created_at")
+    list_filter = (OrderStatusFilter,)
     search_fields = ("id", "user_id",)
-    ordering = ('-id',)
+    # Страница списка читается с начала индекса shop_order_created_idx
+    # (или shop_order_status_created_idx / shop_order_user_created_idx при фильтре).
+    # Сортировать можно только по колонкам с индексом
+    ordering = ('-created_at',)
+    sortable_by = ('id', 'total_cost_display', 'created_at')
     inlines = [OrderItemInline]
-    readonly_fields = ('total_cost_display',)
+    readonly_fields = ('total_cost', 'item_count')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    # Кнопка «Выгрузка» над списком
+    change_list_template = 'admin/shop/order/change_list.html'
 
-    def get_queryset(self, request):
-        queryset = super().get_queryset(request)
-        queryset = queryset.prefetch_related('items').annotate(
-            total_cost=Sum(F('items__product_price') * F('items__quantity'))
-        )
-        return queryset
+    def get_urls(self):
+        return [
+            path('export/', self.admin_site.admin_view(self.export_view), name='shop_order_export'),
+        ] + super().get_urls()
 
-    def order_summary(self, obj):
-        summary = ", ".join(
-            f"{item.product_name} ({item.quantity} шт.)" for item in obj.items.all()
-        )
-        return summary if summary else "–"
-    order_summary.short_description = 'Состав заказа'
+    def export_view(self, request):
+        """Выгрузка позиций заказов за период в CSV или XLSX, потоком из серверного курсора."""
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        form = OrderExportForm(request.GET or None)
+        if form.is_valid():
+            start, end = form.period()
+            rows = order_lines(start, end, form.cleaned_data['status'])
+            filename = f"orders-{form.cleaned_data['date_from']:%Y%m%d}-{form.cleaned_data['date_to']:%Y%m%d}"
+            if form.cleaned_data['format'] == 'xlsx':
+                response = StreamingHttpResponse(
+                    xlsx_stream(rows),
+                    content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                )
+                filename += '.xlsx'
+            else:
+                response = StreamingHttpResponse(csv_stream(rows), content_type='text/csv; charset=utf-8')
+                filename += '.csv'
+            response['Content-Disposition'] = f'attachment; filename="{filename}"'
+            return response
 
+        context = {
+            **self.admin_site.each_context(request),
+            'title': 'Выгрузка заказов',
+            'opts': self.model._meta,
+            'form': form,
+        }
+        return TemplateResponse(request, 'admin/shop/order/export.html', context)
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # Позиции могли измениться в инлайне — сохраненные итоги пересчитываются
+        form.instance.refresh_totals()
+
+    @admin.display(description='Сумма заказа', ordering='total_cost')
     def total_cost_display(self, obj):
-        return f"{obj.total_cost} ₽" if obj.total_cost is not None else "0.00 ₽"
-    total_cost_display.short_description = 'Сумма заказа'
-    total_cost_display.admin_order_field = 'total_cost'
+        return f"{obj.total_cost} ₽"
 
 @admin.register(TelegramUser)
 class TelegramUserAdmin(admin.ModelAdmin):
@@ -80,63 +176,49 @@ class TelegramUserAdmin(admin.ModelAdmin):
     search_fields = ('user_id', 'username', 'first_name', 'last_name')
     ordering = ('-updated_at',)
 
+    # Счетчики берутся из shop_userstats (ведется триггерами), а не считаются подзапросами для каждой строки
+    list_select_related = ('stats',)
+    # Второй COUNT(*) по всей таблице ради «из N» при поиске не нужен
+    show_full_result_count = False
+
     def get_queryset(self, request):
-        queryset = super().get_queryset(request)
-
-        # Subquery для подсчета заказов
-        order_count_subquery = Order.objects.filter(
-            user_id=OuterRef('pk')
-        ).values('user_id').annotate(c=Count('pk')).values('c')
-
-        # Subquery для подсчета общей суммы
-        total_spent_subquery = OrderItem.objects.filter(
-            order__user_id=OuterRef('pk')
-        ).values('order__user_id').annotate(
-            total=Sum(F('product_price') * F('quantity'))
-        ).values('total')
-
-        # Subquery для получения даты последнего заказа
-        last_order_date_subquery = Order.objects.filter(
-            user_id=OuterRef('pk')
-        ).values('user_id').annotate(last_date=Max('created_at')).values('last_date')
-
-        return queryset.annotate(
-            order_count=Subquery(order_count_subquery),
-            total_spent=Subquery(total_spent_subquery),
-            last_order_date=Subquery(last_order_date_subquery),
-            broadcast_count=Count('broadcasts', distinct=True),
-        )
+        # INNER JOIN вместо LEFT: так первую страницу при сортировке по счетчику Postgres читает
+        # прямо из индекса shop_userstats. Строка статистики есть у каждого пользователя —
+        # ее создает триггер на вставку в shop_telegramuser (и команда rebuild_user_stats).
+        # order_by() убирает -updated_at, который ChangeList иначе добавил бы вторым ключом
+        # к выбранной колонке: при равных счетчиках это сортировка всей таблицы.
+        # Без выбранной колонки ChangeList сам сортирует по ordering.
+        return super().get_queryset(request).filter(stats__isnull=False).order_by()
 
-    @admin.display(description='Заказы', ordering='order_count')
+    @admin.display(description='Заказы', ordering='stats__order_count')
     def order_count_link(self, obj):
-        count = obj.order_count or 0
         url = reverse("admin:shop_order_changelist") + "?" + urlencode({"user_id__exact": f"{obj.user_id}"})
-        return format_html('<a href="{}">{}</a>', url, count)
+        return format_html('<a href="{}">{}</a>', url, obj.stats.order_count)
 
-    @admin.display(description='Общая сумма', ordering='total_spent')
+    @admin.display(description='Общая сумма', ordering='stats__total_spent')
     def total_spent_display(self, obj):
-        return f"{obj.total_spent or '0.00'} ₽"
+        return f"{obj.stats.total_spent} ₽"
 
-    @admin.display(description='Последний заказ', ordering='last_order_date')
+    @admin.display(description='Последний заказ', ordering='stats__last_order_at')
     def last_order_date_display(self, obj):
-        return obj.last_order_date.strftime("%d.%m.%Y %H:%M") if obj.last_order_date else "–"
+        last_order_at = obj.stats.last_order_at
+        return last_order_at.strftime("%d.%m.%Y %H:%M") if last_order_at else "–"
 
-    @admin.display(description='Рассылок получено', ordering='broadcast_count')
+    @admin.display(description='Рассылок получено', ordering='stats__broadcast_count')
     def broadcast_count_link(self, obj):
-        count = obj.broadcast_count or 0
         url = (
             reverse("admin:shop_broadcast_changelist")
             + "?"
             + urlencode({"recipients__user_id": f"{obj.user_id}"})
         )
-        return format_html('<a href="{}">{}</a>', url, count)
+        return format_html('<a href="{}">{}</a>', url, obj.stats.broadcast_count)
 
 @admin.register(Broadcast)
 class BroadcastAdmin(admin.ModelAdmin):
-    list_display = ('__str__', 'status', 'recipient_count_display', 'created_at', 'sent_at')
+    list_display = ('__str__', 'status', 'recipient_count_display', 'sent_count', 'created_at', 'sent_at')
     list_filter = ('status',)
     actions = ['schedule_for_sending']
-    readonly_fields = ('sent_at', 'status')
+    readonly_fields = ('sent_at', 'status', 'sent_count', 'heartbeat_at')
     filter_horizontal = ('recipients',)
 
     def get_queryset(self, request):
@@ -153,3 +235,67 @@ class BroadcastAdmin(admin.ModelAdmin):
         self.message_user(
             request, f"{count} рассылок поставлено в очередь на отправку.", messages.SUCCESS
         )
+
+@admin.register(SalesDaily)
+class SalesDailyAdmin(admin.ModelAdmin):
+    """
+    Сводка продаж вместо списка строк. Все цифры берутся из shop_salesdaily и shop_saleshourly
+    (миграция 0022), позиции заказов не читаются: итоги магазина и категорий — по частичным индексам
+    shop_salesdaily_summary_idx / shop_saleshourly_summary_idx, товары — по ключу дня.
+    """
+    PERIODS = (7, 30, 90)
+    TOP_LIMIT = 10
+    METRICS = ('orders', 'units', 'revenue', 'paid_orders', 'paid_units', 'paid_revenue')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        if not self.has_view_or_change_permission(request):
+            raise PermissionDenied
+        try:
+            days = int(request.GET.get('days', 30))
+        except ValueError:
+            days = 30
+        if days not in self.PERIODS:
+            days = 30
+        today = timezone.localdate()
+        first_day = today - timedelta(days=days - 1)
+
+        period = SalesDaily.objects.filter(day__gte=first_day, day__lte=today)
+        # Итоговые строки: product и category пустые — весь магазин, только product пустой — категория
+        shop_rows = period.filter(product__isnull=True, category__isnull=True)
+        metrics = {metric: Sum(metric) for metric in self.METRICS}
+        # Товары группируются только по product_id, названия дочитываются для первых TOP_LIMIT
+        top_products = list(
+            period.filter(product__isnull=False).values('product_id').annotate(**metrics)
+            .order_by('-revenue')[:self.TOP_LIMIT]
+        )
+        names = Product.objects.in_bulk([row['product_id'] for row in top_products])
+        for row in top_products:
+            row['product'] = names.get(row['product_id'])
+        context = {
+            **self.admin_site.each_context(request),
+            'title': 'Продажи',
+            'opts': self.model._meta,
+            'periods': self.PERIODS,
+            'days': days,
+            'first_day': first_day,
+            'today': today,
+            'totals': shop_rows.aggregate(**metrics),
+            'by_day': shop_rows.order_by('-day'),
+            'top_categories': period.filter(product__isnull=True, category__isnull=False)
+                .values('category_id', 'category__name').annotate(**metrics).order_by('-revenue')[:self.TOP_LIMIT],
+            'top_products': top_products,
+            'by_hour': SalesHourly.objects.filter(
+                hour__gte=timezone.now() - timedelta(hours=24), product__isnull=True, category__isnull=True,
+            ).order_by('hour'),
+            **(extra_context or {}),
+        }
+        return TemplateResponse(request, 'admin/shop/salesdaily/dashboard.html', context)
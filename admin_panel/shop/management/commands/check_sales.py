@@ -0,0 +1,98 @@
+from datetime import datetime, time, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from shop.models import Category, Order, OrderItem, Product
+
+# Строки сводок за день; строки из одних нулей не отличаются от отсутствующих
+SNAPSHOT_SQL = """
+    SELECT 'hour', hour::text, product_id, category_id, orders, units, revenue, paid_orders, paid_units, paid_revenue
+    FROM shop_saleshourly WHERE hour >= %(start)s AND hour < %(end)s
+    UNION ALL
+    SELECT 'day', day::text, product_id, category_id, orders, units, revenue, paid_orders, paid_units, paid_revenue
+    FROM shop_salesdaily WHERE day = %(day)s
+"""
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Проверяет триггеры сводок продаж (миграция 0022): правит позиции тестового заказа '
+            'отдельными операторами, как админка, и после каждого шага сравнивает сводки за день '
+            'с пересчетом shop_rebuild_sales. Все изменения откатываются')
+
+    def handle(self, *args, **options):
+        tz = timezone.get_current_timezone()
+        today = timezone.localdate()
+        self.period = {
+            'start': datetime.combine(today, time.min, tzinfo=tz),
+            'end': datetime.combine(today + timedelta(days=1), time.min, tzinfo=tz),
+            'day': today,
+        }
+        try:
+            with transaction.atomic():
+                # Сначала сводки дня приводятся к пересчету: проверяются только изменения ниже
+                self.rebuild()
+                failed = self.run_steps()
+                raise _Rollback
+        except _Rollback:
+            pass
+        if failed:
+            raise CommandError(f'Сводки разошлись с пересчетом на шагах: {", ".join(failed)}')
+        self.stdout.write(self.style.SUCCESS('Сводки продаж совпадают с пересчетом на всех шагах.'))
+
+    def run_steps(self):
+        root = Category.objects.create(name='check_sales')
+        other = Category.objects.create(name='check_sales other', parent=root)
+        products = [Product.objects.create(name=f'check_sales {i}', price=10 * (i + 1), category=root)
+                    for i in range(3)]
+        products.append(Product.objects.create(name='check_sales other', price=7, category=other))
+        order = Order.objects.create(user_id=0, delivery_info='check_sales', status='created')
+
+        def item(product, quantity=1):
+            return OrderItem(order=order, product=product, product_name=product.name,
+                             product_price=product.price, quantity=quantity)
+
+        steps = [
+            # Как create_order бота: все позиции одним оператором
+            ('заказ из двух позиций', lambda: OrderItem.objects.bulk_create([item(products[0]), item(products[1])])),
+            # Inline в админке: каждая позиция — отдельный оператор
+            ('третья позиция отдельно', lambda: item(products[0], 2).save()),
+            ('позиция другой категории', lambda: item(products[3]).save()),
+            ('изменено количество', lambda: order.items.filter(product=products[1]).update(quantity=5)),
+            ('оплата', lambda: Order.objects.filter(pk=order.pk).update(status='paid')),
+            ('позиция в оплаченный заказ', lambda: item(products[2]).save()),
+            ('удалены две позиции', lambda: order.items.filter(product=products[0]).delete()),
+            ('товар заменен', lambda: order.items.filter(product=products[2]).update(product=products[1])),
+            ('товар удален', lambda: order.items.filter(product=products[3]).update(product=None)),
+            ('отмена оплаты', lambda: Order.objects.filter(pk=order.pk).update(status='created')),
+            ('удалена одна из позиций товара', lambda: order.items.filter(product=products[1]).first().delete()),
+            ('заказ удален', lambda: order.delete()),
+        ]
+        failed = []
+        for name, step in steps:
+            step()
+            incremental = self.snapshot()
+            rebuilt = self.rebuild()
+            if incremental == rebuilt:
+                self.stdout.write(f'ok   {name}')
+                continue
+            failed.append(name)
+            self.stdout.write(self.style.ERROR(f'FAIL {name}'))
+            for row in sorted(incremental - rebuilt, key=str):
+                self.stdout.write(f'    триггеры: {row}')
+            for row in sorted(rebuilt - incremental, key=str):
+                self.stdout.write(f'    пересчет: {row}')
+        return failed
+
+    def snapshot(self):
+        with connection.cursor() as cursor:
+            cursor.execute(SNAPSHOT_SQL, self.period)
+            return {row for row in cursor.fetchall() if any(row[4:])}
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT shop_rebuild_sales(%(start)s, %(end)s)", self.period)
+        return self.snapshot()
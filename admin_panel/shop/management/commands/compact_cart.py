@@ -0,0 +1,39 @@
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    help = ('Переносит неактивные позиции корзины и брошенные корзины из shop_cartitem '
+            'в архив (shop_cartitemarchive) порциями')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Сколько позиций переносить в одной транзакции')
+        parser.add_argument('--abandoned-days', type=int, default=30,
+                            help='Через сколько дней без изменений корзина считается брошенной; 0 — не трогать')
+        parser.add_argument('--pause', type=float, default=0,
+                            help='Пауза между порциями, секунд')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        abandoned_before = None
+        if options['abandoned_days']:
+            abandoned_before = timezone.now() - timedelta(days=options['abandoned_days'])
+        total = 0
+        # Каждая порция — отдельная короткая транзакция: строки, занятые ботом, пропускаются (SKIP LOCKED)
+        while True:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute("SELECT shop_compact_cartitems(%s, %s)", [batch_size, abandoned_before])
+                moved = cursor.fetchone()[0]
+            total += moved
+            if moved:
+                self.stdout.write(f'Перенесено позиций: {total}')
+            if moved < batch_size:
+                break
+            if options['pause']:
+                time.sleep(options['pause'])
+
+        self.stdout.write(self.style.SUCCESS(f'Уплотнение корзин завершено, перенесено {total} позиций.'))
@@ -0,0 +1,78 @@
+import re
+from datetime import date
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+PARENTS = ('shop_order', 'shop_orderitem')
+ARCHIVE_SCHEMA = 'shop_archive'
+
+
+class Command(BaseCommand):
+    help = ('Обслуживание месячных секций shop_order и shop_orderitem: создание будущих, '
+            'отключение старых с переносом в схему shop_archive')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=3,
+                            help='На сколько месяцев вперед создать секции')
+        parser.add_argument('--detach-before', metavar='ГГГГ-ММ',
+                            help='Отключить секции месяцев раньше указанного и перенести их в shop_archive')
+        parser.add_argument('--list', action='store_true', help='Показать секции и число строк в них')
+
+    def handle(self, *args, **options):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT shop_ensure_order_partitions(%s)", [options['ahead']])
+            created = cursor.fetchone()[0]
+        self.stdout.write(f'Создано секций: {created}')
+
+        if options['detach_before']:
+            self.detach_before(self.parse_month(options['detach_before']))
+        if options['list']:
+            self.list_partitions()
+
+    def parse_month(self, value):
+        match = re.fullmatch(r'(\d{4})-(\d{2})', value)
+        if not match or not 1 <= int(match[2]) <= 12:
+            raise CommandError('Месяц указывается в формате ГГГГ-ММ')
+        month = date(int(match[1]), int(match[2]), 1)
+        now = timezone.now()
+        if month > date(now.year, now.month, 1):
+            raise CommandError('Нельзя отключить секции текущего и будущих месяцев')
+        return month
+
+    def partitions(self, cursor, parent):
+        # Имя секции содержит месяц: <таблица>_yГГГГmММ (см. shop_create_order_partitions)
+        cursor.execute("""
+            SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = %s::regclass ORDER BY c.relname
+        """, [parent])
+        result = []
+        for (name,) in cursor.fetchall():
+            match = re.fullmatch(rf'{parent}_y(\d{{4}})m(\d{{2}})', name)
+            if match:
+                result.append((name, date(int(match[1]), int(match[2]), 1)))
+        return result
+
+    def detach_before(self, month):
+        # DETACH ... CONCURRENTLY нельзя выполнять в транзакции; соединение Django в autocommit.
+        # Заказы и позиции в отключенных секциях пропадают из админки и бота, но остаются
+        # в shop_archive; статистика пользователей (shop_userstats) их не вычитает.
+        detached = 0
+        with connection.cursor() as cursor:
+            for parent in PARENTS:
+                for name, part_month in self.partitions(cursor, parent):
+                    if part_month >= month:
+                        continue
+                    cursor.execute(f'ALTER TABLE {parent} DETACH PARTITION {name} CONCURRENTLY')
+                    cursor.execute(f'ALTER TABLE {name} SET SCHEMA {ARCHIVE_SCHEMA}')
+                    detached += 1
+                    self.stdout.write(f'{name} перенесена в {ARCHIVE_SCHEMA}')
+        self.stdout.write(self.style.SUCCESS(f'Отключено секций: {detached}'))
+
+    def list_partitions(self):
+        with connection.cursor() as cursor:
+            for parent in PARENTS:
+                for name, _ in self.partitions(cursor, parent):
+                    cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", [name])
+                    rows = cursor.fetchone()[0]
+                    self.stdout.write(f'{name}: ~{max(rows, 0)} строк')
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+# Итоги заказов по позициям. Обновляются только расходящиеся строки: триггер статистики
+# пользователей (миграция 0021) пересчитывает shop_userstats лишь для них
+REBUILD_SQL = """
+    UPDATE shop_order o
+    SET total_cost = t.total_cost, item_count = t.item_count
+    FROM (
+        SELECT i.order_id, SUM(i.product_price * i.quantity) AS total_cost, SUM(i.quantity) AS item_count
+        FROM shop_orderitem i
+        JOIN shop_order z ON z.id = i.order_id {order_filter}
+        GROUP BY i.order_id
+    ) t
+    WHERE t.order_id = o.id {order_filter_o}
+      AND (o.total_cost <> t.total_cost OR o.item_count <> t.item_count)
+"""
+
+
+class Command(BaseCommand):
+    help = ('Пересчитывает total_cost и item_count заказов по позициям. По умолчанию — только заказы '
+            'с item_count = 0: их оформил бот старой версии во время выкатки миграции 0018')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Проверить и пересчитать все заказы')
+
+    def handle(self, *args, **options):
+        if options['all']:
+            sql = REBUILD_SQL.format(order_filter='', order_filter_o='')
+        else:
+            sql = REBUILD_SQL.format(order_filter='AND z.item_count = 0', order_filter_o='AND o.item_count = 0')
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(sql)
+            updated = cursor.rowcount
+        self.stdout.write(self.style.SUCCESS(f'Итоги пересчитаны для {updated} заказов.'))
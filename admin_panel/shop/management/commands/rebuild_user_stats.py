@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+# Пользователи из shop_telegramuser и все user_id, у которых есть заказы
+USER_IDS_SQL = """
+    SELECT user_id FROM (
+        SELECT user_id FROM shop_telegramuser WHERE user_id > %s
+        UNION
+        SELECT user_id FROM shop_order WHERE user_id > %s
+    ) u
+    ORDER BY user_id
+    LIMIT %s
+"""
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает статистику пользователей (shop_userstats) по заказам и рассылкам'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Сколько пользователей пересчитывать в одной транзакции')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = -1
+        total = 0
+        # Короткие транзакции по batch_size пользователей: триггеры и бот не ждут блокировок всей таблицы
+        while True:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(USER_IDS_SQL, [last_id, last_id, batch_size])
+                user_ids = [row[0] for row in cursor.fetchall()]
+                if not user_ids:
+                    break
+                cursor.execute("SELECT shop_refresh_user_stats(%s::bigint[])", [user_ids])
+            last_id = user_ids[-1]
+            total += len(user_ids)
+            self.stdout.write(f'Пересчитано пользователей: {total}')
+
+        self.stdout.write(self.style.SUCCESS(f'Статистика пересчитана для {total} пользователей.'))
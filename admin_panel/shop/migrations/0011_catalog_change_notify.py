@@ -0,0 +1,35 @@
+from django.db import migrations
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("shop", "0010_fix_cartitem_unique_constraint"),
+    ]
+
+    operations = [
+        # Бот держит каталог в кэше и сбрасывает его по NOTIFY 'catalog_changed'.
+        # Триггеры уровня оператора срабатывают на любые изменения: сохранение в админке,
+        # массовые действия, ручной SQL. Уведомление уходит только после COMMIT.
+        migrations.RunSQL(
+            sql="""
+                CREATE OR REPLACE FUNCTION shop_notify_catalog_changed() RETURNS trigger AS $$
+                BEGIN
+                    PERFORM pg_notify('catalog_changed', TG_TABLE_NAME);
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+
+                CREATE TRIGGER shop_category_catalog_changed
+                AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON shop_category
+                FOR EACH STATEMENT EXECUTE FUNCTION shop_notify_catalog_changed();
+
+                CREATE TRIGGER shop_product_catalog_changed
+                AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON shop_product
+                FOR EACH STATEMENT EXECUTE FUNCTION shop_notify_catalog_changed();
+            """,
+            reverse_sql="""
+                DROP TRIGGER IF EXISTS shop_product_catalog_changed ON shop_product;
+                DROP TRIGGER IF EXISTS shop_category_catalog_changed ON shop_category;
+                DROP FUNCTION IF EXISTS shop_notify_catalog_changed();
+            """
+        ),
+    ]
@@ -0,0 +1,27 @@
+from django.db import migrations
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("shop", "0011_catalog_change_notify"),
+    ]
+
+    operations = [
+        # Индексы под keyset-пагинацию каталога в боте: страница читается
+        # диапазонным сканированием индекса, без сортировки всех строк категории.
+        migrations.RunSQL(
+            sql="""
+                CREATE INDEX IF NOT EXISTS shop_category_active_keyset_idx
+                ON shop_category (parent_id, sort_order, name, id)
+                WHERE (is_active = TRUE);
+            """,
+            reverse_sql="DROP INDEX IF EXISTS shop_category_active_keyset_idx;"
+        ),
+        migrations.RunSQL(
+            sql="""
+                CREATE INDEX IF NOT EXISTS shop_product_active_keyset_idx
+                ON shop_product (category_id, name, id)
+                WHERE (is_active = TRUE);
+            """,
+            reverse_sql="DROP INDEX IF EXISTS shop_product_active_keyset_idx;"
+        ),
+    ]
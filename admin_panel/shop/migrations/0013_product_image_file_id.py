@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-17 13:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0012_catalog_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='image_file_id',
+            field=models.CharField(blank=True, default='', editable=False, max_length=255, verbose_name='Telegram file_id изображения'),
+        ),
+        # Бот сам записывает image_file_id — такие UPDATE не должны сбрасывать кэш каталога,
+        # поэтому триггер срабатывает только на изменение видимых в боте столбцов.
+        migrations.RunSQL(
+            sql="""
+                DROP TRIGGER IF EXISTS shop_product_catalog_changed ON shop_product;
+                CREATE TRIGGER shop_product_catalog_changed
+                AFTER INSERT OR UPDATE OF name, description, image, price, category_id, is_active OR DELETE OR TRUNCATE
+                ON shop_product
+                FOR EACH STATEMENT EXECUTE FUNCTION shop_notify_catalog_changed();
+            """,
+            reverse_sql="""
+                DROP TRIGGER IF EXISTS shop_product_catalog_changed ON shop_product;
+                CREATE TRIGGER shop_product_catalog_changed
+                AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON shop_product
+                FOR EACH STATEMENT EXECUTE FUNCTION shop_notify_catalog_changed();
+            """
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 13:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0013_product_image_file_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='broadcast',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Последняя отметка прогресса'),
+        ),
+        migrations.AddField(
+            model_name='broadcast',
+            name='progress_user_id',
+            field=models.BigIntegerField(blank=True, editable=False, null=True, verbose_name='Последний обработанный получатель'),
+        ),
+        migrations.AddField(
+            model_name='broadcast',
+            name='send_to_all',
+            field=models.BooleanField(editable=False, null=True, verbose_name='Всем активным пользователям'),
+        ),
+        migrations.AddField(
+            model_name='broadcast',
+            name='sent_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Доставлено'),
+        ),
+    ]
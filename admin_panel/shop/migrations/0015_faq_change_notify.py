@@ -0,0 +1,19 @@
+from django.db import migrations
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("shop", "0014_broadcast_progress"),
+    ]
+
+    operations = [
+        # Бот держит индекс FAQ в том же кэше, что и каталог: изменения статей
+        # сбрасывают его тем же уведомлением 'catalog_changed'.
+        migrations.RunSQL(
+            sql="""
+                CREATE TRIGGER shop_faq_catalog_changed
+                AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON shop_faq
+                FOR EACH STATEMENT EXECUTE FUNCTION shop_notify_catalog_changed();
+            """,
+            reverse_sql="DROP TRIGGER IF EXISTS shop_faq_catalog_changed ON shop_faq;"
+        ),
+    ]
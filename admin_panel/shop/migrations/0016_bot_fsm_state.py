@@ -0,0 +1,23 @@
+from django.db import migrations
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("shop", "0015_faq_change_notify"),
+    ]
+
+    operations = [
+        # Состояния диалогов бота (FSM). Таблица служебная, моделью не описывается.
+        # UNLOGGED: записи не идут в WAL, после аварийного рестарта PostgreSQL таблица
+        # очищается — пользователю придется заново начать оформление заказа.
+        migrations.RunSQL(
+            sql="""
+                CREATE UNLOGGED TABLE bot_fsm_state (
+                    key text PRIMARY KEY,
+                    value jsonb NOT NULL DEFAULT '{}'::jsonb,
+                    expires_at timestamptz NOT NULL
+                );
+                CREATE INDEX bot_fsm_state_expires_at_idx ON bot_fsm_state (expires_at);
+            """,
+            reverse_sql="DROP TABLE IF EXISTS bot_fsm_state;"
+        ),
+    ]
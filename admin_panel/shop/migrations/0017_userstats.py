@@ -0,0 +1,238 @@
+# Generated by Django 5.2.18 on 2026-10-17 14:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0016_bot_fsm_state'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user_id', 'created_at'], name='shop_order_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='telegramuser',
+            index=models.Index(fields=['updated_at', 'user_id'], name='shop_tguser_updated_at_idx'),
+        ),
+        migrations.CreateModel(
+            name='UserStats',
+            fields=[
+                ('user', models.OneToOneField(db_column='user_id', db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='stats', serialize=False, to='shop.telegramuser', verbose_name='Пользователь')),
+                ('order_count', models.PositiveIntegerField(default=0, verbose_name='Заказы')),
+                ('total_spent', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='Общая сумма')),
+                ('last_order_at', models.DateTimeField(blank=True, null=True, verbose_name='Последний заказ')),
+                ('broadcast_count', models.PositiveIntegerField(default=0, verbose_name='Рассылок получено')),
+            ],
+            options={
+                'verbose_name': 'Статистика пользователя',
+                'verbose_name_plural': 'Статистика пользователей',
+                'indexes': [models.Index(fields=['order_count', 'user'], name='shop_userstats_orders_idx'), models.Index(fields=['total_spent', 'user'], name='shop_userstats_spent_idx'), models.Index(fields=['last_order_at', 'user'], name='shop_userstats_last_order_idx'), models.Index(fields=['broadcast_count', 'user'], name='shop_userstats_broadcasts_idx')],
+            },
+        ),
+        # Статистика обновляется триггерами уровня оператора с таблицами переходов:
+        # оформление заказа (один INSERT заказа и позиций) и добавление получателей рассылки
+        # увеличивают счетчики одним UPSERT на пользователя. Редкие изменения и удаления
+        # пересчитывают затронутых пользователей функцией shop_refresh_user_stats.
+        migrations.RunSQL(
+            sql="""
+                -- Пересчет с нуля для заданных пользователей; NULL — для всех (начальное заполнение)
+                CREATE OR REPLACE FUNCTION shop_refresh_user_stats(user_ids bigint[]) RETURNS void AS $$
+                    WITH ids AS (
+                        SELECT unnest(user_ids) AS user_id
+                        UNION SELECT user_id FROM shop_telegramuser WHERE user_ids IS NULL
+                        UNION SELECT user_id FROM shop_order WHERE user_ids IS NULL
+                    )
+                    INSERT INTO shop_userstats AS s (user_id, order_count, total_spent, last_order_at, broadcast_count)
+                    SELECT ids.user_id, COALESCE(o.order_count, 0), COALESCE(t.total_spent, 0), o.last_order_at,
+                           COALESCE(b.broadcast_count, 0)
+                    FROM ids
+                    LEFT JOIN (
+                        SELECT user_id, COUNT(*) AS order_count, MAX(created_at) AS last_order_at
+                        FROM shop_order JOIN ids USING (user_id)
+                        GROUP BY user_id
+                    ) o USING (user_id)
+                    LEFT JOIN (
+                        SELECT o.user_id, SUM(i.product_price * i.quantity) AS total_spent
+                        FROM shop_order o JOIN ids USING (user_id) JOIN shop_orderitem i ON i.order_id = o.id
+                        GROUP BY o.user_id
+                    ) t USING (user_id)
+                    LEFT JOIN (
+                        SELECT r.telegramuser_id AS user_id, COUNT(*) AS broadcast_count
+                        FROM shop_broadcast_recipients r JOIN ids ON ids.user_id = r.telegramuser_id
+                        GROUP BY r.telegramuser_id
+                    ) b USING (user_id)
+                    WHERE ids.user_id IS NOT NULL
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        order_count = EXCLUDED.order_count,
+                        total_spent = EXCLUDED.total_spent,
+                        last_order_at = EXCLUDED.last_order_at,
+                        broadcast_count = EXCLUDED.broadcast_count;
+                $$ LANGUAGE sql;
+
+                -- Заказы
+                CREATE OR REPLACE FUNCTION shop_user_stats_order_inserted() RETURNS trigger AS $$
+                BEGIN
+                    INSERT INTO shop_userstats AS s (user_id, order_count, total_spent, last_order_at, broadcast_count)
+                    SELECT user_id, COUNT(*), 0, MAX(created_at), 0 FROM new_rows GROUP BY user_id
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        order_count = s.order_count + EXCLUDED.order_count,
+                        last_order_at = GREATEST(s.last_order_at, EXCLUDED.last_order_at);
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+
+                CREATE OR REPLACE FUNCTION shop_user_stats_order_updated() RETURNS trigger AS $$
+                BEGIN
+                    -- Смена статуса (оплата) статистику не меняет: пересчет только при смене владельца или даты
+                    PERFORM shop_refresh_user_stats(ARRAY(
+                        SELECT unnest(ARRAY[o.user_id, n.user_id])
+                        FROM old_rows o JOIN new_rows n ON n.id = o.id
+                        WHERE o.user_id <> n.user_id OR o.created_at IS DISTINCT FROM n.created_at
+                    ));
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+
+                CREATE OR REPLACE FUNCTION shop_user_stats_order_deleted() RETURNS trigger AS $$
+                BEGIN
+                    PERFORM shop_refresh_user_stats(ARRAY(SELECT user_id FROM old_rows));
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+
+                CREATE TRIGGER shop_order_user_stats_insert AFTER INSERT ON shop_order
+                REFERENCING NEW TABLE AS new_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION shop_user_stats_order_inserted();
+
+                CREATE TRIGGER shop_order_user_stats_update AFTER UPDATE ON shop_order
+                REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION shop_user_stats_order_updated();
+
+                CREATE TRIGGER shop_order_user_stats_delete AFTER DELETE ON shop_order
+                REFERENCING OLD TABLE AS old_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION shop_user_stats_order_deleted();
+
+                -- Позиции заказов
+                CREATE OR REPLACE FUNCTION shop_user_stats_orderitem_inserted() RETURNS trigger AS $$
+                BEGIN
+                    INSERT INTO shop_userstats AS s (user_id, order_count, total_spent, last_order_at, broadcast_count)
+                    SELECT o.user_id, 0, SUM(n.product_price * n.quantity), NULL, 0
+                    FROM new_rows n JOIN shop_order o ON o.id = n.order_id
+                    GROUP BY o.user_id
+                    ON CONFLICT (user_id) DO UPDATE SET total_spent = s.total_spent + EXCLUDED.total_spent;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+
+                CREATE OR REPLACE FUNCTION shop_user_stats_orderitem_changed() RETURNS trigger AS $$
+                BEGIN
+                    PERFORM shop_refresh_user_stats(ARRAY(
+                        SELECT o.user_id FROM shop_order o
+                        WHERE o.id IN (SELECT order_id FROM old_rows UNION SELECT order_id FROM new_rows)
+                    ));
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+
+                CREATE OR REPLACE FUNCTION shop_user_stats_orderitem_deleted() RETURNS trigger AS $$
+                BEGIN
+                    PERFORM shop_refresh_user_stats(ARRAY(
+                        SELECT o.user_id FROM shop_order o WHERE o.id IN (SELECT order_id FROM old_rows)
+                    ));
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+
+                CREATE TRIGGER shop_orderitem_user_stats_insert AFTER INSERT ON shop_orderitem
+                REFERENCING NEW TABLE AS new_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION shop_user_stats_orderitem_inserted();
+
+                CREATE TRIGGER shop_orderitem_user_stats_update AFTER UPDATE ON shop_orderitem
+                REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION shop_user_stats_orderitem_changed();
+
+                CREATE TRIGGER shop_orderitem_user_stats_delete AFTER DELETE ON shop_orderitem
+                REFERENCING OLD TABLE AS old_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION shop_user_stats_orderitem_deleted();
+
+                -- Получатели рассылок
+                CREATE OR REPLACE FUNCTION shop_user_stats_recipient_inserted() RETURNS trigger AS $$
+                BEGIN
+                    INSERT INTO shop_userstats AS s (user_id, order_count, total_spent, last_order_at, broadcast_count)
+                    SELECT telegramuser_id, 0, 0, NULL, COUNT(*) FROM new_rows GROUP BY telegramuser_id
+                    ON CONFLICT (user_id) DO UPDATE SET broadcast_count = s.broadcast_count + EXCLUDED.broadcast_count;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+
+                CREATE OR REPLACE FUNCTION shop_user_stats_recipient_changed() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP = 'UPDATE' THEN
+                        PERFORM shop_refresh_user_stats(ARRAY(
+                            SELECT telegramuser_id FROM old_rows UNION SELECT telegramuser_id FROM new_rows
+                        ));
+                    ELSE
+                        PERFORM shop_refresh_user_stats(ARRAY(SELECT telegramuser_id FROM old_rows));
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+
+                CREATE TRIGGER shop_broadcast_recipients_user_stats_insert AFTER INSERT ON shop_broadcast_recipients
+                REFERENCING NEW TABLE AS new_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION shop_user_stats_recipient_inserted();
+
+                CREATE TRIGGER shop_broadcast_recipients_user_stats_update AFTER UPDATE ON shop_broadcast_recipients
+                REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION shop_user_stats_recipient_changed();
+
+                CREATE TRIGGER shop_broadcast_recipients_user_stats_delete AFTER DELETE ON shop_broadcast_recipients
+                REFERENCING OLD TABLE AS old_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION shop_user_stats_recipient_changed();
+
+                -- Новый пользователь сразу получает нулевую строку: сортировка в админке не зависит от NULL
+                CREATE OR REPLACE FUNCTION shop_user_stats_user_inserted() RETURNS trigger AS $$
+                BEGIN
+                    INSERT INTO shop_userstats (user_id, order_count, total_spent, last_order_at, broadcast_count)
+                    VALUES (NEW.user_id, 0, 0, NULL, 0)
+                    ON CONFLICT (user_id) DO NOTHING;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+
+                -- Построчный: upsert из бота (add_or_update_user) для существующего пользователя его не вызывает
+                CREATE TRIGGER shop_telegramuser_user_stats_insert AFTER INSERT ON shop_telegramuser
+                FOR EACH ROW EXECUTE FUNCTION shop_user_stats_user_inserted();
+
+                -- Начальное заполнение
+                SELECT shop_refresh_user_stats(NULL);
+            """,
+            reverse_sql="""
+                DROP TRIGGER IF EXISTS shop_telegramuser_user_stats_insert ON shop_telegramuser;
+                DROP TRIGGER IF EXISTS shop_broadcast_recipients_user_stats_delete ON shop_broadcast_recipients;
+                DROP TRIGGER IF EXISTS shop_broadcast_recipients_user_stats_update ON shop_broadcast_recipients;
+                DROP TRIGGER IF EXISTS shop_broadcast_recipients_user_stats_insert ON shop_broadcast_recipients;
+                DROP TRIGGER IF EXISTS shop_orderitem_user_stats_delete ON shop_orderitem;
+                DROP TRIGGER IF EXISTS shop_orderitem_user_stats_update ON shop_orderitem;
+                DROP TRIGGER IF EXISTS shop_orderitem_user_stats_insert ON shop_orderitem;
+                DROP TRIGGER IF EXISTS shop_order_user_stats_delete ON shop_order;
+                DROP TRIGGER IF EXISTS shop_order_user_stats_update ON shop_order;
+                DROP TRIGGER IF EXISTS shop_order_user_stats_insert ON shop_order;
+                DROP FUNCTION IF EXISTS shop_user_stats_user_inserted();
+                DROP FUNCTION IF EXISTS shop_user_stats_recipient_changed();
+                DROP FUNCTION IF EXISTS shop_user_stats_recipient_inserted();
+                DROP FUNCTION IF EXISTS shop_user_stats_orderitem_deleted();
+                DROP FUNCTION IF EXISTS shop_user_stats_orderitem_changed();
+                DROP FUNCTION IF EXISTS shop_user_stats_orderitem_inserted();
+                DROP FUNCTION IF EXISTS shop_user_stats_order_deleted();
+                DROP FUNCTION IF EXISTS shop_user_stats_order_updated();
+                DROP FUNCTION IF EXISTS shop_user_stats_order_inserted();
+                DROP FUNCTION IF EXISTS shop_refresh_user_stats(bigint[]);
+            """
+        ),
+    ]
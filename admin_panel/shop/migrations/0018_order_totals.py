@@ -0,0 +1,58 @@
+# Generated by Django 5.2.18 on 2026-10-17 14:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0017_userstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Товаров'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total_cost',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='Сумма заказа'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['status', 'created_at'], name='shop_order_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['created_at'], name='shop_order_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['total_cost', 'id'], name='shop_order_total_cost_idx'),
+        ),
+        # Значения по умолчанию на стороне БД: заказы, которые бот старой версии оформит во время
+        # выкатки, вставляются без новых колонок и остаются с нулевой суммой. Порядок выкатки:
+        # миграция, затем новый бот, затем manage.py rebuild_order_totals для заказов,
+        # оформленных старым ботом в промежутке. Итоги существующих заказов заполняются здесь.
+        migrations.RunSQL(
+            sql="""
+                ALTER TABLE shop_order ALTER COLUMN total_cost SET DEFAULT 0;
+                ALTER TABLE shop_order ALTER COLUMN item_count SET DEFAULT 0;
+
+                UPDATE shop_order o
+                SET total_cost = t.total_cost, item_count = t.item_count
+                FROM (
+                    SELECT order_id, SUM(product_price * quantity) AS total_cost, SUM(quantity) AS item_count
+                    FROM shop_orderitem
+                    GROUP BY order_id
+                ) t
+                WHERE t.order_id = o.id;
+            """,
+            reverse_sql="""
+                ALTER TABLE shop_order ALTER COLUMN total_cost DROP DEFAULT;
+                ALTER TABLE shop_order ALTER COLUMN item_count DROP DEFAULT;
+            """
+        ),
+    ]
@@ -0,0 +1,59 @@
+from django.db import migrations
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("shop", "0018_order_totals"),
+    ]
+
+    # Частичные индексы под запросы бота (tgbot/db.py), которые не покрыты индексами
+    # 0010 и 0012. Проверка планов: python -m bench.plan_check из каталога tgbot.
+    operations = [
+        # Страницы корневых категорий: parent_id IS NULL — не равенство, и порядок
+        # (sort_order, name, id) из shop_category_active_keyset_idx планировщик не использует
+        migrations.RunSQL(
+            sql="""
+                CREATE INDEX IF NOT EXISTS shop_category_root_keyset_idx
+                ON shop_category (sort_order, name, id)
+                WHERE (is_active = TRUE AND parent_id IS NULL);
+            """,
+            reverse_sql="DROP INDEX IF EXISTS shop_category_root_keyset_idx;"
+        ),
+        # fetch_cart, хвост запросов изменения корзины и create_order: активные позиции
+        # пользователя в порядке добавления читаются только из индекса, без сортировки
+        migrations.RunSQL(
+            sql="""
+                CREATE INDEX IF NOT EXISTS shop_cartitem_active_user_idx
+                ON shop_cartitem (user_id, created_at) INCLUDE (id, product_id, quantity)
+                WHERE (is_active = TRUE);
+            """,
+            reverse_sql="DROP INDEX IF EXISTS shop_cartitem_active_user_idx;"
+        ),
+        # add_to_cart: поиск неактивной позиции для повторного использования.
+        # Неактивные позиции остаются после каждого заказа, и без индекса это полный просмотр корзин
+        migrations.RunSQL(
+            sql="""
+                CREATE INDEX IF NOT EXISTS shop_cartitem_inactive_user_product_idx
+                ON shop_cartitem (user_id, product_id)
+                WHERE (is_active = FALSE);
+            """,
+            reverse_sql="DROP INDEX IF EXISTS shop_cartitem_inactive_user_product_idx;"
+        ),
+        # get_pending_broadcast: очередь рассылок; отправленные в индекс не попадают
+        migrations.RunSQL(
+            sql="""
+                CREATE INDEX IF NOT EXISTS shop_broadcast_queue_idx
+                ON shop_broadcast (created_at)
+                WHERE (status IN ('pending', 'sending'));
+            """,
+            reverse_sql="DROP INDEX IF EXISTS shop_broadcast_queue_idx;"
+        ),
+        # fetch_faq_index: активные статьи от новых к старым
+        migrations.RunSQL(
+            sql="""
+                CREATE INDEX IF NOT EXISTS shop_faq_active_idx
+                ON shop_faq (id)
+                WHERE (is_active = TRUE);
+            """,
+            reverse_sql="DROP INDEX IF EXISTS shop_faq_active_idx;"
+        ),
+    ]
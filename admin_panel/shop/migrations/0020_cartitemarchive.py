@@ -0,0 +1,99 @@
+# Generated by Django 5.2.18 on 2026-10-17 14:36
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0019_bot_query_indexes'),
+    ]
+
+    operations = [
+        # Время последнего изменения позиции: по нему, а не по created_at, корзина считается брошенной.
+        # Бот обновляет его в каждом запросе, меняющем корзину, админка — через auto_now.
+        # Для существующих позиций берется время добавления.
+        migrations.AddField(
+            model_name='cartitem',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.RunSQL(
+            sql="UPDATE shop_cartitem SET updated_at = created_at;",
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.CreateModel(
+            name='CartItemArchive',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('user_id', models.BigIntegerField(db_index=True)),
+                ('quantity', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('reason', models.CharField(choices=[('inactive', 'Удалена или оформлена'), ('abandoned', 'Брошенная корзина')], max_length=16)),
+                ('product', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='shop.product')),
+            ],
+            options={
+                'verbose_name': 'Архивная позиция корзины',
+                'verbose_name_plural': 'Архив корзин',
+            },
+        ),
+        # Одна порция уплотнения: до batch_size позиций переносятся из shop_cartitem в архив
+        # в той же транзакции (DELETE ... RETURNING -> INSERT). Сначала неактивные позиции
+        # (удаленные из корзины и оформленные в заказ), затем брошенные корзины — активные позиции
+        # пользователей, у которых корзина не менялась с abandoned_before (NULL — не трогать).
+        # FOR UPDATE SKIP LOCKED: строки, которые сейчас меняет бот, пропускаются до следующей порции,
+        # и бот не ждет уплотнения. Возвращает число перенесенных позиций.
+        migrations.RunSQL(
+            sql="""
+                CREATE OR REPLACE FUNCTION shop_compact_cartitems(batch_size integer, abandoned_before timestamptz)
+                RETURNS integer AS $$
+                DECLARE
+                    moved integer;
+                    abandoned integer;
+                BEGIN
+                    WITH victims AS (
+                        SELECT id FROM shop_cartitem
+                        WHERE is_active = FALSE
+                        LIMIT batch_size
+                        FOR UPDATE SKIP LOCKED
+                    ), deleted AS (
+                        DELETE FROM shop_cartitem c USING victims v
+                        WHERE c.id = v.id
+                        RETURNING c.id, c.user_id, c.product_id, c.quantity, c.created_at
+                    )
+                    INSERT INTO shop_cartitemarchive (id, user_id, product_id, quantity, created_at, archived_at, reason)
+                    SELECT id, user_id, product_id, quantity, created_at, NOW(), 'inactive' FROM deleted;
+                    GET DIAGNOSTICS moved = ROW_COUNT;
+
+                    IF moved < batch_size AND abandoned_before IS NOT NULL THEN
+                        WITH victims AS (
+                            SELECT c.id FROM shop_cartitem c
+                            WHERE c.is_active = TRUE AND c.updated_at < abandoned_before
+                              AND NOT EXISTS (
+                                  SELECT 1 FROM shop_cartitem n
+                                  WHERE n.user_id = c.user_id AND n.is_active = TRUE
+                                    AND n.updated_at >= abandoned_before
+                              )
+                            LIMIT batch_size - moved
+                            FOR UPDATE SKIP LOCKED
+                        ), deleted AS (
+                            DELETE FROM shop_cartitem c USING victims v
+                            WHERE c.id = v.id
+                            RETURNING c.id, c.user_id, c.product_id, c.quantity, c.created_at
+                        )
+                        INSERT INTO shop_cartitemarchive (id, user_id, product_id, quantity, created_at, archived_at, reason)
+                        SELECT id, user_id, product_id, quantity, created_at, NOW(), 'abandoned' FROM deleted;
+                        GET DIAGNOSTICS abandoned = ROW_COUNT;
+                        moved := moved + abandoned;
+                    END IF;
+                    RETURN moved;
+                END;
+                $$ LANGUAGE plpgsql;
+            """,
+            reverse_sql="DROP FUNCTION IF EXISTS shop_compact_cartitems(integer, timestamptz);"
+        ),
+    ]
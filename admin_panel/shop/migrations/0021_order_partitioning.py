@@ -0,0 +1,211 @@
+# Generated by Django 5.2.18 on 2026-10-17 14:43
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# Секции создаются на столько месяцев вперед; дальше их продлевают бот (order_partitions.py)
+# и команда order_partitions
+MONTHS_AHEAD = 3
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0020_cartitemarchive'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='orderitem',
+            name='order',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='items', to='shop.order'),
+        ),
+        # Месячные секции shop_order и shop_orderitem по created_at (границы — по UTC).
+        # Имя секции: <таблица>_yГГГГmММ. Секции по умолчанию нет намеренно: без нее планировщик
+        # читает секции по порядку (Append вместо Merge Append), и список последних заказов
+        # не открывает старые секции. Поэтому будущие секции нужно создавать заранее: бот делает это
+        # при каждом запуске и раз в ORDER_PARTITIONS_INTERVAL и пишет ERROR, если запас месяцев мал.
+        # Если обслуживание все же не сработало, create_order бота создает секцию сам и повторяет заказ.
+        migrations.RunSQL(
+            sql="""
+                CREATE SCHEMA IF NOT EXISTS shop_archive;
+
+                CREATE OR REPLACE FUNCTION shop_create_order_partitions(from_month date, to_month date)
+                RETURNS integer AS $$
+                DECLARE
+                    part_month date;
+                    parent text;
+                    part_name text;
+                    created integer := 0;
+                BEGIN
+                    FOR part_month IN
+                        SELECT generate_series(date_trunc('month', from_month), date_trunc('month', to_month),
+                                               INTERVAL '1 month')::date
+                    LOOP
+                        FOREACH parent IN ARRAY ARRAY['shop_order', 'shop_orderitem'] LOOP
+                            part_name := format('%s_y%s', parent, to_char(part_month, 'YYYY"m"MM'));
+                            IF to_regclass('public.' || part_name) IS NULL THEN
+                                EXECUTE format('CREATE TABLE public.%I PARTITION OF public.%I '
+                                               'FOR VALUES FROM (%L) TO (%L)',
+                                               part_name, parent, part_month::timestamp AT TIME ZONE 'UTC',
+                                               (part_month + INTERVAL '1 month')::timestamp AT TIME ZONE 'UTC');
+                                created := created + 1;
+                            END IF;
+                        END LOOP;
+                    END LOOP;
+                    RETURN created;
+                END;
+                $$ LANGUAGE plpgsql;
+
+                -- Секции с текущего месяца на months_ahead месяцев вперед; возвращает число созданных
+                CREATE OR REPLACE FUNCTION shop_ensure_order_partitions(months_ahead integer) RETURNS integer AS $$
+                    SELECT shop_create_order_partitions(
+                        (NOW() AT TIME ZONE 'UTC')::date,
+                        ((NOW() AT TIME ZONE 'UTC') + months_ahead * INTERVAL '1 month')::date
+                    );
+                $$ LANGUAGE sql;
+            """,
+            reverse_sql="""
+                DROP FUNCTION IF EXISTS shop_ensure_order_partitions(integer);
+                DROP FUNCTION IF EXISTS shop_create_order_partitions(date, date);
+                DROP SCHEMA IF EXISTS shop_archive;
+            """
+        ),
+        # Перенос данных в секционированные таблицы. Первичные ключи — (id, created_at):
+        # ключ секционированной таблицы должен включать ключ секционирования. id по-прежнему
+        # выдаются одной последовательностью и уникальны. Identity-столбцы в секционированных
+        # таблицах PostgreSQL 16 не поддерживает, поэтому id берется из обычной последовательности.
+        # Миграция необратима (reverse_sql=None, откат дает IrreversibleError): старые таблицы удаляются,
+        # а обратный перенос потребовал бы вернуть identity, внешний ключ на shop_order.id и триггеры
+        # статистики из 0017. Откат — только восстановлением БД из резервной копии, снятой перед миграцией.
+        migrations.RunSQL(
+            sql=f"""
+                ALTER TABLE shop_order RENAME TO shop_order_unpartitioned;
+                ALTER TABLE shop_orderitem RENAME TO shop_orderitem_unpartitioned;
+
+                CREATE TABLE shop_order (LIKE shop_order_unpartitioned INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+                PARTITION BY RANGE (created_at);
+                CREATE TABLE shop_orderitem (LIKE shop_orderitem_unpartitioned INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+                PARTITION BY RANGE (created_at);
+
+                SELECT shop_create_order_partitions(
+                    (COALESCE(LEAST(
+                        (SELECT MIN(created_at) FROM shop_order_unpartitioned),
+                        (SELECT MIN(created_at) FROM shop_orderitem_unpartitioned)
+                    ), NOW()) AT TIME ZONE 'UTC')::date,
+                    ((NOW() AT TIME ZONE 'UTC') + INTERVAL '{MONTHS_AHEAD} months')::date
+                );
+
+                INSERT INTO shop_order SELECT * FROM shop_order_unpartitioned;
+                INSERT INTO shop_orderitem SELECT * FROM shop_orderitem_unpartitioned;
+                -- Вместе со старыми таблицами удаляются их identity-последовательности и триггеры статистики
+                DROP TABLE shop_orderitem_unpartitioned;
+                DROP TABLE shop_order_unpartitioned;
+
+                CREATE SEQUENCE shop_order_id_seq OWNED BY shop_order.id;
+                SELECT setval('shop_order_id_seq', COALESCE(MAX(id), 0) + 1, false) FROM shop_order;
+                ALTER TABLE shop_order ALTER COLUMN id SET DEFAULT nextval('shop_order_id_seq');
+                CREATE SEQUENCE shop_orderitem_id_seq OWNED BY shop_orderitem.id;
+                SELECT setval('shop_orderitem_id_seq', COALESCE(MAX(id), 0) + 1, false) FROM shop_orderitem;
+                ALTER TABLE shop_orderitem ALTER COLUMN id SET DEFAULT nextval('shop_orderitem_id_seq');
+
+                ALTER TABLE shop_order ADD CONSTRAINT shop_order_pkey PRIMARY KEY (id, created_at);
+                ALTER TABLE shop_orderitem ADD CONSTRAINT shop_orderitem_pkey PRIMARY KEY (id, created_at);
+
+                -- Индексы моделей (имена те же, что создал Django), на каждой секции
+                CREATE INDEX shop_order_user_created_idx ON shop_order (user_id, created_at);
+                CREATE INDEX shop_order_status_created_idx ON shop_order (status, created_at);
+                CREATE INDEX shop_order_created_idx ON shop_order (created_at);
+                CREATE INDEX shop_order_total_cost_idx ON shop_order (total_cost, id);
+                CREATE INDEX shop_orderitem_order_id_2f1b00cf ON shop_orderitem (order_id);
+                CREATE INDEX shop_orderitem_product_id_48153f22 ON shop_orderitem (product_id);
+                ALTER TABLE shop_orderitem ADD CONSTRAINT shop_orderitem_product_id_48153f22_fk_shop_product_id
+                    FOREIGN KEY (product_id) REFERENCES shop_product (id) DEFERRABLE INITIALLY DEFERRED;
+            """,
+            reverse_sql=None,
+        ),
+        # Статистика пользователей (0017) на секционированных таблицах. Сумма покупок теперь
+        # берется из сохраненного shop_order.total_cost (0018), а не из позиций: триггеры на
+        # shop_orderitem больше не нужны, и оформление заказа не ищет заказ позиции по всем секциям.
+        # Правка позиций в админке пересчитывает total_cost заказа (Order.refresh_totals),
+        # и статистику обновляет триггер на изменение shop_order. Необратимо, как и перенос данных выше.
+        migrations.RunSQL(
+            sql="""
+                DROP FUNCTION IF EXISTS shop_user_stats_orderitem_inserted();
+                DROP FUNCTION IF EXISTS shop_user_stats_orderitem_changed();
+                DROP FUNCTION IF EXISTS shop_user_stats_orderitem_deleted();
+
+                CREATE OR REPLACE FUNCTION shop_refresh_user_stats(user_ids bigint[]) RETURNS void AS $$
+                    WITH ids AS (
+                        SELECT unnest(user_ids) AS user_id
+                        UNION SELECT user_id FROM shop_telegramuser WHERE user_ids IS NULL
+                        UNION SELECT user_id FROM shop_order WHERE user_ids IS NULL
+                    )
+                    INSERT INTO shop_userstats AS s (user_id, order_count, total_spent, last_order_at, broadcast_count)
+                    SELECT ids.user_id, COALESCE(o.order_count, 0), COALESCE(o.total_spent, 0), o.last_order_at,
+                           COALESCE(b.broadcast_count, 0)
+                    FROM ids
+                    LEFT JOIN (
+                        SELECT user_id, COUNT(*) AS order_count, SUM(total_cost) AS total_spent,
+                               MAX(created_at) AS last_order_at
+                        FROM shop_order JOIN ids USING (user_id)
+                        GROUP BY user_id
+                    ) o USING (user_id)
+                    LEFT JOIN (
+                        SELECT r.telegramuser_id AS user_id, COUNT(*) AS broadcast_count
+                        FROM shop_broadcast_recipients r JOIN ids ON ids.user_id = r.telegramuser_id
+                        GROUP BY r.telegramuser_id
+                    ) b USING (user_id)
+                    WHERE ids.user_id IS NOT NULL
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        order_count = EXCLUDED.order_count,
+                        total_spent = EXCLUDED.total_spent,
+                        last_order_at = EXCLUDED.last_order_at,
+                        broadcast_count = EXCLUDED.broadcast_count;
+                $$ LANGUAGE sql;
+
+                CREATE OR REPLACE FUNCTION shop_user_stats_order_inserted() RETURNS trigger AS $$
+                BEGIN
+                    INSERT INTO shop_userstats AS s (user_id, order_count, total_spent, last_order_at, broadcast_count)
+                    SELECT user_id, COUNT(*), SUM(total_cost), MAX(created_at), 0 FROM new_rows GROUP BY user_id
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        order_count = s.order_count + EXCLUDED.order_count,
+                        total_spent = s.total_spent + EXCLUDED.total_spent,
+                        last_order_at = GREATEST(s.last_order_at, EXCLUDED.last_order_at);
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+
+                CREATE OR REPLACE FUNCTION shop_user_stats_order_updated() RETURNS trigger AS $$
+                BEGIN
+                    -- Смена статуса (оплата) статистику не меняет: пересчет только при смене владельца,
+                    -- даты или суммы заказа
+                    PERFORM shop_refresh_user_stats(ARRAY(
+                        SELECT unnest(ARRAY[o.user_id, n.user_id])
+                        FROM old_rows o JOIN new_rows n ON n.id = o.id
+                        WHERE o.user_id <> n.user_id OR o.created_at IS DISTINCT FROM n.created_at
+                           OR o.total_cost <> n.total_cost
+                    ));
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+
+                -- Триггеры уровня оператора с таблицами переходов ставятся на корневую таблицу
+                -- и срабатывают для строк всех секций
+                CREATE TRIGGER shop_order_user_stats_insert AFTER INSERT ON shop_order
+                REFERENCING NEW TABLE AS new_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION shop_user_stats_order_inserted();
+
+                CREATE TRIGGER shop_order_user_stats_update AFTER UPDATE ON shop_order
+                REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION shop_user_stats_order_updated();
+
+                CREATE TRIGGER shop_order_user_stats_delete AFTER DELETE ON shop_order
+                REFERENCING OLD TABLE AS old_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION shop_user_stats_order_deleted();
+
+                SELECT shop_refresh_user_stats(NULL);
+            """,
+            reverse_sql=None,
+        ),
+    ]
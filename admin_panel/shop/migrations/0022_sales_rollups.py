@@ -0,0 +1,301 @@
+# Generated by Django 5.2.18 on 2026-10-17 14:54
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+# Часовой пояс, по которому заказы раскладываются по дням. При смене TIME_ZONE нужно пересоздать
+# shop_sales_day() и пересчитать дни командой rebuild_sales
+REPORT_TIME_ZONE = settings.TIME_ZONE
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0021_order_partitioning'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SalesDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('orders', models.IntegerField(default=0, verbose_name='Заказы')),
+                ('units', models.IntegerField(default=0, verbose_name='Товаров, шт.')),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='Сумма')),
+                ('paid_orders', models.IntegerField(default=0, verbose_name='Оплачено заказов')),
+                ('paid_units', models.IntegerField(default=0, verbose_name='Оплачено товаров, шт.')),
+                ('paid_revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='Оплачено')),
+                ('day', models.DateField(verbose_name='День')),
+                ('category', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='shop.category', verbose_name='Категория')),
+                ('product', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='shop.product', verbose_name='Товар')),
+            ],
+            options={
+                'verbose_name': 'Продажи за день',
+                'verbose_name_plural': 'Продажи',
+            },
+        ),
+        migrations.CreateModel(
+            name='SalesHourly',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('orders', models.IntegerField(default=0, verbose_name='Заказы')),
+                ('units', models.IntegerField(default=0, verbose_name='Товаров, шт.')),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='Сумма')),
+                ('paid_orders', models.IntegerField(default=0, verbose_name='Оплачено заказов')),
+                ('paid_units', models.IntegerField(default=0, verbose_name='Оплачено товаров, шт.')),
+                ('paid_revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='Оплачено')),
+                ('hour', models.DateTimeField(verbose_name='Час')),
+                ('category', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='shop.category', verbose_name='Категория')),
+                ('product', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='shop.product', verbose_name='Товар')),
+            ],
+            options={
+                'verbose_name': 'Продажи за час',
+                'verbose_name_plural': 'Продажи по часам',
+            },
+        ),
+        # Уникальный ключ периода: пустые product/category — итоги по категории и магазину,
+        # поэтому NULLS NOT DISTINCT (PostgreSQL 15+). Частичные индексы — под сводку в админке,
+        # которая читает только итоговые строки.
+        migrations.RunSQL(
+            sql="""
+                CREATE UNIQUE INDEX shop_saleshourly_key ON shop_saleshourly (hour, product_id, category_id)
+                NULLS NOT DISTINCT;
+                CREATE UNIQUE INDEX shop_salesdaily_key ON shop_salesdaily (day, product_id, category_id)
+                NULLS NOT DISTINCT;
+                CREATE INDEX shop_saleshourly_summary_idx ON shop_saleshourly (hour) WHERE product_id IS NULL;
+                CREATE INDEX shop_salesdaily_summary_idx ON shop_salesdaily (day) WHERE product_id IS NULL;
+            """,
+            reverse_sql="""
+                DROP INDEX IF EXISTS shop_salesdaily_summary_idx;
+                DROP INDEX IF EXISTS shop_saleshourly_summary_idx;
+                DROP INDEX IF EXISTS shop_salesdaily_key;
+                DROP INDEX IF EXISTS shop_saleshourly_key;
+            """
+        ),
+        # Инкрементное обновление: триггеры уровня оператора собирают изменения позиций в массив
+        # shop_sales_delta и передают в shop_sales_apply, которая прибавляет их к строкам часа и дня
+        # на трех уровнях. ordered/paid — знак вклада в заказанное и оплаченное (+1, -1 или 0).
+        # Заказ учитывается на уровне, когда у него появляется первая позиция этого товара, категории
+        # или магазина, и снимается, когда исчезает последняя: число позиций до оператора — это позиции
+        # в shop_orderitem после него (триггеры AFTER видят изменения) минус добавленные оператором.
+        # Так число заказов верно и когда позиции существующего заказа меняют отдельными операторами
+        # (inline в админке); проверка — команда check_sales.
+        migrations.RunSQL(
+            sql=f"""
+                CREATE TYPE shop_sales_delta AS (
+                    order_id bigint,
+                    order_created_at timestamptz,
+                    product_id bigint,
+                    units integer,
+                    revenue numeric,
+                    ordered integer,
+                    paid integer
+                );
+
+                CREATE OR REPLACE FUNCTION shop_sales_day(ts timestamptz) RETURNS date AS $$
+                    SELECT (ts AT TIME ZONE '{REPORT_TIME_ZONE}')::date;
+                $$ LANGUAGE sql IMMUTABLE;
+
+                CREATE OR REPLACE FUNCTION shop_sales_apply(deltas shop_sales_delta[]) RETURNS void AS $$
+                    WITH d AS (
+                        SELECT d.order_id, d.order_created_at, COALESCE(d.product_id, 0) AS product_id,
+                               COALESCE(p.category_id, 0) AS category_id, d.units, d.revenue, d.ordered, d.paid
+                        FROM unnest(deltas) d LEFT JOIN shop_product p ON p.id = d.product_id
+                    ),
+                    -- Изменения каждого заказа на уровнях товар, категория, магазин;
+                    -- items/paid_items — сколько позиций оператор добавил (убрал) в заказанное и оплаченное
+                    changes AS (
+                        SELECT order_id, order_created_at, product_id, category_id,
+                               SUM(ordered) AS items, SUM(paid) AS paid_items,
+                               SUM(units * ordered) AS units, SUM(revenue * ordered) AS revenue,
+                               SUM(units * paid) AS paid_units, SUM(revenue * paid) AS paid_revenue
+                        FROM d
+                        GROUP BY order_id, order_created_at,
+                                 GROUPING SETS ((product_id, category_id), (category_id), ())
+                    ),
+                    orders AS (
+                        SELECT o.id, o.created_at, o.status = 'paid' AS is_paid
+                        FROM (SELECT DISTINCT order_id, order_created_at FROM d) c
+                        JOIN shop_order o ON o.id = c.order_id AND o.created_at = c.order_created_at
+                    ),
+                    -- Позиции этих заказов после оператора, на тех же уровнях
+                    current AS (
+                        SELECT order_id, product_id, category_id, COUNT(*) AS items
+                        FROM (
+                            SELECT i.order_id, COALESCE(i.product_id, 0) AS product_id,
+                                   COALESCE(p.category_id, 0) AS category_id
+                            FROM orders o
+                            JOIN shop_orderitem i ON i.order_id = o.id AND i.created_at >= o.created_at
+                            LEFT JOIN shop_product p ON p.id = i.product_id
+                        ) i
+                        GROUP BY order_id, GROUPING SETS ((product_id, category_id), (category_id), ())
+                    ),
+                    per_order AS (
+                        SELECT c.order_created_at, c.product_id, c.category_id,
+                               (a.items > 0)::integer - (a.items - c.items > 0)::integer AS orders,
+                               c.units, c.revenue,
+                               (a.paid_items > 0)::integer - (a.paid_items - c.paid_items > 0)::integer AS paid_orders,
+                               c.paid_units, c.paid_revenue
+                        FROM changes c
+                        LEFT JOIN orders o ON o.id = c.order_id
+                        LEFT JOIN current cur ON cur.order_id = c.order_id
+                            AND cur.product_id IS NOT DISTINCT FROM c.product_id
+                            AND cur.category_id IS NOT DISTINCT FROM c.category_id
+                        CROSS JOIN LATERAL (
+                            SELECT COALESCE(cur.items, 0) AS items,
+                                   CASE WHEN o.is_paid THEN COALESCE(cur.items, 0) ELSE 0 END AS paid_items
+                        ) a
+                    ),
+                    buckets AS (
+                        SELECT date_trunc('hour', order_created_at, 'UTC') AS hour,
+                               shop_sales_day(order_created_at) AS day, product_id, category_id,
+                               orders, units, revenue, paid_orders, paid_units, paid_revenue
+                        FROM per_order
+                        WHERE orders <> 0 OR units <> 0 OR revenue <> 0
+                           OR paid_orders <> 0 OR paid_units <> 0 OR paid_revenue <> 0
+                    ),
+                    -- Строки обновляются в порядке ключа: параллельные заказы не заблокируют друг друга
+                    -- накрест, сначала часы, потом дни
+                    hourly AS (
+                        INSERT INTO shop_saleshourly AS s (hour, product_id, category_id, orders, units, revenue,
+                                                           paid_orders, paid_units, paid_revenue)
+                        SELECT hour, product_id, category_id, SUM(orders), SUM(units), SUM(revenue),
+                               SUM(paid_orders), SUM(paid_units), SUM(paid_revenue)
+                        FROM buckets
+                        GROUP BY hour, product_id, category_id
+                        ORDER BY hour, product_id NULLS FIRST, category_id NULLS FIRST
+                        ON CONFLICT (hour, product_id, category_id) DO UPDATE SET
+                            orders = s.orders + EXCLUDED.orders,
+                            units = s.units + EXCLUDED.units,
+                            revenue = s.revenue + EXCLUDED.revenue,
+                            paid_orders = s.paid_orders + EXCLUDED.paid_orders,
+                            paid_units = s.paid_units + EXCLUDED.paid_units,
+                            paid_revenue = s.paid_revenue + EXCLUDED.paid_revenue
+                    )
+                    INSERT INTO shop_salesdaily AS s (day, product_id, category_id, orders, units, revenue,
+                                                      paid_orders, paid_units, paid_revenue)
+                    SELECT day, product_id, category_id, SUM(orders), SUM(units), SUM(revenue),
+                           SUM(paid_orders), SUM(paid_units), SUM(paid_revenue)
+                    FROM buckets
+                    GROUP BY day, product_id, category_id
+                    ORDER BY day, product_id NULLS FIRST, category_id NULLS FIRST
+                    ON CONFLICT (day, product_id, category_id) DO UPDATE SET
+                        orders = s.orders + EXCLUDED.orders,
+                        units = s.units + EXCLUDED.units,
+                        revenue = s.revenue + EXCLUDED.revenue,
+                        paid_orders = s.paid_orders + EXCLUDED.paid_orders,
+                        paid_units = s.paid_units + EXCLUDED.paid_units,
+                        paid_revenue = s.paid_revenue + EXCLUDED.paid_revenue;
+                $$ LANGUAGE sql;
+
+                -- Позиции: заказ ищется по id и не может быть новее позиции (отсекает будущие секции)
+                CREATE OR REPLACE FUNCTION shop_sales_orderitem_inserted() RETURNS trigger AS $$
+                BEGIN
+                    PERFORM shop_sales_apply(ARRAY(
+                        SELECT ROW(i.order_id, o.created_at, i.product_id, i.quantity, i.product_price * i.quantity,
+                                   1, (o.status = 'paid')::integer)::shop_sales_delta
+                        FROM new_rows i JOIN shop_order o ON o.id = i.order_id AND o.created_at <= i.created_at
+                    ));
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+
+                CREATE OR REPLACE FUNCTION shop_sales_orderitem_updated() RETURNS trigger AS $$
+                BEGIN
+                    -- Удаление товара обнуляет product_id (SET_NULL): его продажи переходят в product_id 0,
+                    -- как и при пересчете
+                    PERFORM shop_sales_apply(ARRAY(
+                        SELECT ROW(c.order_id, ord.created_at, c.product_id, c.quantity, c.product_price * c.quantity,
+                                   c.sign, c.sign * (ord.status = 'paid')::integer)::shop_sales_delta
+                        FROM old_rows o JOIN new_rows n ON n.id = o.id
+                        CROSS JOIN LATERAL (VALUES
+                            (o.order_id, o.created_at, o.product_id, o.quantity, o.product_price, -1),
+                            (n.order_id, n.created_at, n.product_id, n.quantity, n.product_price, 1)
+                        ) c (order_id, created_at, product_id, quantity, product_price, sign)
+                        JOIN shop_order ord ON ord.id = c.order_id AND ord.created_at <= c.created_at
+                        WHERE o.order_id <> n.order_id OR o.quantity <> n.quantity
+                           OR o.product_price <> n.product_price OR n.product_id IS DISTINCT FROM o.product_id
+                    ));
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+
+                -- Django удаляет позиции раньше заказа, поэтому заказ здесь еще находится
+                CREATE OR REPLACE FUNCTION shop_sales_orderitem_deleted() RETURNS trigger AS $$
+                BEGIN
+                    PERFORM shop_sales_apply(ARRAY(
+                        SELECT ROW(i.order_id, o.created_at, i.product_id, i.quantity, i.product_price * i.quantity,
+                                   -1, -(o.status = 'paid')::integer)::shop_sales_delta
+                        FROM old_rows i JOIN shop_order o ON o.id = i.order_id AND o.created_at <= i.created_at
+                    ));
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+
+                -- Заказы: оплата и отмена оплаты переносят позиции заказа в оплаченное и обратно
+                CREATE OR REPLACE FUNCTION shop_sales_order_updated() RETURNS trigger AS $$
+                BEGIN
+                    PERFORM shop_sales_apply(ARRAY(
+                        SELECT ROW(i.order_id, n.created_at, i.product_id, i.quantity, i.product_price * i.quantity,
+                                   0, CASE WHEN n.status = 'paid' THEN 1 ELSE -1 END)::shop_sales_delta
+                        FROM old_rows o JOIN new_rows n ON n.id = o.id
+                        JOIN shop_orderitem i ON i.order_id = n.id AND i.created_at >= n.created_at
+                        WHERE (o.status = 'paid') <> (n.status = 'paid')
+                    ));
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+
+                CREATE TRIGGER shop_orderitem_sales_insert AFTER INSERT ON shop_orderitem
+                REFERENCING NEW TABLE AS new_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION shop_sales_orderitem_inserted();
+
+                CREATE TRIGGER shop_orderitem_sales_update AFTER UPDATE ON shop_orderitem
+                REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION shop_sales_orderitem_updated();
+
+                CREATE TRIGGER shop_orderitem_sales_delete AFTER DELETE ON shop_orderitem
+                REFERENCING OLD TABLE AS old_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION shop_sales_orderitem_deleted();
+
+                CREATE TRIGGER shop_order_sales_update AFTER UPDATE ON shop_order
+                REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION shop_sales_order_updated();
+
+                -- Пересчет периода [from_ts, to_ts) с нуля; границы — полночь по REPORT_TIME_ZONE.
+                -- Возвращает число учтенных позиций. Используется командой rebuild_sales
+                CREATE OR REPLACE FUNCTION shop_rebuild_sales(from_ts timestamptz, to_ts timestamptz)
+                RETURNS integer AS $$
+                DECLARE
+                    deltas shop_sales_delta[];
+                BEGIN
+                    DELETE FROM shop_saleshourly WHERE hour >= from_ts AND hour < to_ts;
+                    DELETE FROM shop_salesdaily WHERE day >= shop_sales_day(from_ts) AND day < shop_sales_day(to_ts);
+                    deltas := ARRAY(
+                        SELECT ROW(i.order_id, o.created_at, i.product_id, i.quantity, i.product_price * i.quantity,
+                                   1, (o.status = 'paid')::integer)::shop_sales_delta
+                        FROM shop_order o JOIN shop_orderitem i ON i.order_id = o.id AND i.created_at >= o.created_at
+                        WHERE o.created_at >= from_ts AND o.created_at < to_ts AND i.created_at >= from_ts
+                    );
+                    PERFORM shop_sales_apply(deltas);
+                    RETURN cardinality(deltas);
+                END;
+                $$ LANGUAGE plpgsql;
+            """,
+            reverse_sql="""
+                DROP FUNCTION IF EXISTS shop_rebuild_sales(timestamptz, timestamptz);
+                DROP TRIGGER IF EXISTS shop_order_sales_update ON shop_order;
+                DROP TRIGGER IF EXISTS shop_orderitem_sales_delete ON shop_orderitem;
+                DROP TRIGGER IF EXISTS shop_orderitem_sales_update ON shop_orderitem;
+                DROP TRIGGER IF EXISTS shop_orderitem_sales_insert ON shop_orderitem;
+                DROP FUNCTION IF EXISTS shop_sales_order_updated();
+                DROP FUNCTION IF EXISTS shop_sales_orderitem_deleted();
+                DROP FUNCTION IF EXISTS shop_sales_orderitem_updated();
+                DROP FUNCTION IF EXISTS shop_sales_orderitem_inserted();
+                DROP FUNCTION IF EXISTS shop_sales_apply(shop_sales_delta[]);
+                DROP FUNCTION IF EXISTS shop_sales_day(timestamptz);
+                DROP TYPE IF EXISTS shop_sales_delta;
+            """
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models import F, Sum
 
 class Category(models.Model):
     name = models.CharField(max_length=100)
@@ -18,6 +19,8 @@ class Product(models.Model):
     name = models.CharField(max_length=200)
     description = models.TextField(blank=True)
     image = models.ImageField(upload_to='products/', blank=True, null=True, verbose_name='Изображение')
+    # file_id, полученный ботом после первой загрузки текущего изображения в Telegram
+    image_file_id = models.CharField(max_length=255, blank=True, default='', editable=False, verbose_name='Telegram file_id изображения')
     price = models.DecimalField(max_digits=10, decimal_places=2)
     category = models.ForeignKey(Category, related_name='products', on_delete=models.CASCADE)
     is_active = models.BooleanField(default=True)
@@ -54,36 +57,119 @@ class TelegramUser(models.Model):
     class Meta:
         verbose_name = 'Пользователь Telegram'
         verbose_name_plural = 'Пользователи Telegram'
+        # Сортировка списка в админке по умолчанию
+        indexes = [models.Index(fields=['updated_at', 'user_id'], name='shop_tguser_updated_at_idx')]
 
     def __str__(self):
         return f"@{self.username}" if self.username else f"ID: {self.user_id}"
 
+class UserStats(models.Model):
+    """
+    Денормализованная статистика пользователя для списка в админке.
+    Заполняется только триггерами Postgres (миграция 0017): на вставку заказов, позиций
+    и получателей рассылок счетчики увеличиваются, при изменении и удалении пересчитываются.
+    Полный пересчет — команда rebuild_user_stats.
+    """
+    # Без внешнего ключа в БД: заказы ссылаются на user_id, которого может не быть в shop_telegramuser
+    user = models.OneToOneField(
+        TelegramUser, primary_key=True, related_name='stats', db_column='user_id',
+        db_constraint=False, on_delete=models.DO_NOTHING, verbose_name='Пользователь'
+    )
+    order_count = models.PositiveIntegerField(default=0, verbose_name='Заказы')
+    total_spent = models.DecimalField(max_digits=14, decimal_places=2, default=0, verbose_name='Общая сумма')
+    last_order_at = models.DateTimeField(null=True, blank=True, verbose_name='Последний заказ')
+    broadcast_count = models.PositiveIntegerField(default=0, verbose_name='Рассылок получено')
+
+    class Meta:
+        verbose_name = 'Статистика пользователя'
+        verbose_name_plural = 'Статистика пользователей'
+        # Под сортировку списка пользователей в админке: поле + user_id (админка добавляет -pk для однозначности)
+        indexes = [
+            models.Index(fields=['order_count', 'user'], name='shop_userstats_orders_idx'),
+            models.Index(fields=['total_spent', 'user'], name='shop_userstats_spent_idx'),
+            models.Index(fields=['last_order_at', 'user'], name='shop_userstats_last_order_idx'),
+            models.Index(fields=['broadcast_count', 'user'], name='shop_userstats_broadcasts_idx'),
+        ]
+
 class CartItem(models.Model):
     user_id = models.BigIntegerField()
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Последнее изменение позиции; по нему уплотнение находит брошенные корзины
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         verbose_name = 'Товар в корзине'
         verbose_name_plural = 'Корзина'
 
+class CartItemArchive(models.Model):
+    """
+    Позиции, вынесенные из shop_cartitem при уплотнении (функция shop_compact_cartitems,
+    команда compact_cart и фоновая задача бота): удаленные из корзины и оформленные в заказ,
+    а также брошенные корзины. id — id исходной позиции.
+    """
+    REASON_INACTIVE = 'inactive'
+    REASON_ABANDONED = 'abandoned'
+    REASON_CHOICES = [
+        (REASON_INACTIVE, 'Удалена или оформлена'),
+        (REASON_ABANDONED, 'Брошенная корзина'),
+    ]
+
+    id = models.BigIntegerField(primary_key=True)
+    user_id = models.BigIntegerField(db_index=True)
+    # Товар могли удалить после архивации, поэтому без внешнего ключа в БД
+    product = models.ForeignKey(Product, on_delete=models.DO_NOTHING, db_constraint=False, null=True,
+                                related_name='+')
+    quantity = models.PositiveIntegerField()
+    created_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+    reason = models.CharField(max_length=16, choices=REASON_CHOICES)
+
+    class Meta:
+        verbose_name = 'Архивная позиция корзины'
+        verbose_name_plural = 'Архив корзин'
+
 class Order(models.Model):
     user_id = models.BigIntegerField()
     delivery_info = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=32, default='created')
+    # Итоги по позициям: записываются ботом при оформлении (create_order), чтобы список заказов
+    # не считал SUM по shop_orderitem для каждой страницы. После правки позиций — refresh_totals().
+    total_cost = models.DecimalField(max_digits=14, decimal_places=2, default=0, verbose_name='Сумма заказа')
+    item_count = models.PositiveIntegerField(default=0, verbose_name='Товаров')
 
     class Meta:
         verbose_name = 'Заказ'
         verbose_name_plural = 'Заказы'
+        indexes = [
+            # Заказы пользователя: фильтр в админке и пересчет shop_userstats
+            models.Index(fields=['user_id', 'created_at'], name='shop_order_user_created_idx'),
+            # Список заказов в админке: сортировка по дате, с фильтром по статусу и без
+            models.Index(fields=['status', 'created_at'], name='shop_order_status_created_idx'),
+            models.Index(fields=['created_at'], name='shop_order_created_idx'),
+            models.Index(fields=['total_cost', 'id'], name='shop_order_total_cost_idx'),
+        ]
 
     def __str__(self):
         return f"Order #{self.id} ({self.user_id})"
 
+    def refresh_totals(self):
+        """Пересчитывает total_cost и item_count по позициям заказа."""
+        totals = self.items.aggregate(
+            total_cost=Sum(F('product_price') * F('quantity')),
+            item_count=Sum('quantity'),
+        )
+        self.total_cost = totals['total_cost'] or 0
+        self.item_count = totals['item_count'] or 0
+        Order.objects.filter(pk=self.pk).update(total_cost=self.total_cost, item_count=self.item_count)
+
 class OrderItem(models.Model):
-    order = models.ForeignKey(Order, related_name='items', on_delete=models.CASCADE)
+    # shop_order секционирована по created_at (миграция 0021): ее первичный ключ (id, created_at),
+    # и внешний ключ на один id в БД невозможен. Каскадное удаление выполняет Django.
+    order = models.ForeignKey(Order, related_name='items', on_delete=models.CASCADE, db_constraint=False)
     product = models.ForeignKey(Product, on_delete=models.SET_NULL, null=True, blank=True)
     product_name = models.CharField(max_length=200)
     product_price = models.DecimalField(max_digits=10, decimal_places=2)
@@ -97,6 +183,47 @@ class OrderItem(models.Model):
     def __str__(self):
         return f"{self.product_name} ({self.quantity} шт.) для Заказа #{self.order.id}"
 
+class SalesRollup(models.Model):
+    """
+    Продажи за период по товару и категории. Ведется только триггерами Postgres (миграция 0022)
+    при оформлении и оплате заказов и при изменении позиций; полный пересчет — команда rebuild_sales,
+    сверка триггеров с пересчетом — check_sales.
+    Уровни: товар (product и category заданы), категория (product пустой) и весь магазин
+    (оба пустые). Заказы и выручка привязаны ко времени оформления заказа, категория — та,
+    в которой товар был при учете позиции. product_id/category_id = 0 — удаленный товар.
+    """
+    # Без внешних ключей и отдельных индексов: строки ищутся только по уникальному ключу периода
+    product = models.ForeignKey(Product, on_delete=models.DO_NOTHING, db_constraint=False, db_index=False,
+                                null=True, related_name='+', verbose_name='Товар')
+    category = models.ForeignKey(Category, on_delete=models.DO_NOTHING, db_constraint=False, db_index=False,
+                                 null=True, related_name='+', verbose_name='Категория')
+    orders = models.IntegerField(default=0, verbose_name='Заказы')
+    units = models.IntegerField(default=0, verbose_name='Товаров, шт.')
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0, verbose_name='Сумма')
+    paid_orders = models.IntegerField(default=0, verbose_name='Оплачено заказов')
+    paid_units = models.IntegerField(default=0, verbose_name='Оплачено товаров, шт.')
+    paid_revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0, verbose_name='Оплачено')
+
+    class Meta:
+        abstract = True
+
+class SalesHourly(SalesRollup):
+    hour = models.DateTimeField(verbose_name='Час')
+
+    class Meta:
+        verbose_name = 'Продажи за час'
+        verbose_name_plural = 'Продажи по часам'
+        # Уникальность (hour, product, category) с NULLS NOT DISTINCT задана в миграции 0022
+
+class SalesDaily(SalesRollup):
+    # День по часовому поясу админки (TIME_ZONE на момент миграции 0022)
+    day = models.DateField(verbose_name='День')
+
+    class Meta:
+        verbose_name = 'Продажи за день'
+        verbose_name_plural = 'Продажи'
+        # Уникальность (day, product, category) с NULLS NOT DISTINCT задана в миграции 0022
+
 class Broadcast(models.Model):
     message = models.TextField(verbose_name='Текст сообщения')
     recipients = models.ManyToManyField(
@@ -118,6 +245,12 @@ class Broadcast(models.Model):
         default='draft',
         verbose_name='Статус'
     )
+    # Прогресс отправки: бот сохраняет его после каждой порции получателей
+    # и после перезапуска продолжает рассылку с progress_user_id
+    send_to_all = models.BooleanField(null=True, editable=False, verbose_name='Всем активным пользователям')
+    progress_user_id = models.BigIntegerField(null=True, blank=True, editable=False, verbose_name='Последний обработанный получатель')
+    sent_count = models.PositiveIntegerField(default=0, editable=False, verbose_name='Доставлено')
+    heartbeat_at = models.DateTimeField(null=True, blank=True, editable=False, verbose_name='Последняя отметка прогресса')
 
     class Meta:
         verbose_name = 'Рассылка'
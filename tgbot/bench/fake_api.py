@@ -0,0 +1,172 @@
+"""
+Поддельный Bot API для нагрузочных тестов: отвечает на вызовы бота как api.telegram.org,
+выдает обновления через getUpdates или доставляет их на вебхук, как это делает Telegram.
+Бот подключается к нему через TELEGRAM_API_URL.
+"""
+import asyncio
+import json
+import logging
+import time
+from itertools import count
+from aiohttp import ClientSession, web
+
+BENCH_TOKEN = "123456:bench"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# Поля, которые aiogram передает в form-data строкой JSON
+JSON_FIELDS = {'reply_markup', 'allowed_updates', 'entities', 'caption_entities', 'link_preview_options',
+               'reply_parameters'}
+
+
+def _decode(key, value):
+    return json.loads(value) if key in JSON_FIELDS else value
+
+
+class FakeBotAPI:
+    def __init__(self):
+        self.app = web.Application(client_max_size=64 * 1024 ** 2)
+        self.app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        self.updates = asyncio.Queue()
+        self.listeners = []  # функции (method, params, result), вызываемые на каждый запрос бота
+        self.responders = {}  # method -> функция (params) -> result, переопределяет ответ по умолчанию
+        self._update_ids = count(1)
+        self._message_ids = count(1)
+        self._webhook_tasks = []
+        self._session = None
+
+    # --- Обновления ---
+    def make_message_update(self, user_id, text):
+        now = int(time.time())
+        user = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids), "date": now, "text": text,
+                "chat": {"id": user_id, "type": "private"}, "from": user,
+            },
+        }
+
+    def make_callback_update(self, user_id, data, message):
+        user = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._update_ids)), "from": user, "chat_instance": str(user_id),
+                "data": data, "message": message,
+            },
+        }
+
+    def push(self, update):
+        self.updates.put_nowait(update)
+
+    # --- Методы Bot API ---
+    def _message(self, params, **extra):
+        chat_id = int(params.get("chat_id", 0))
+        message = {
+            "message_id": int(params.get("message_id") or next(self._message_ids)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            **extra,
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        if "caption" in params:
+            message["caption"] = params["caption"]
+        # Как и Telegram, в сообщении возвращается только inline-клавиатура
+        markup = params.get("reply_markup")
+        if isinstance(markup, dict) and "inline_keyboard" in markup:
+            message["reply_markup"] = markup
+        return message
+
+    def _default_result(self, method, params):
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "editMessageText", "editMessageReplyMarkup", "editMessageCaption"):
+            return self._message(params)
+        if method == "sendPhoto":
+            photo = [{"file_id": f"photo-{next(self._message_ids)}", "file_unique_id": "u", "width": 1, "height": 1}]
+            return self._message(params, photo=photo)
+        if method == "getChatMember":
+            user = {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "User"}
+            return {"status": "member", "user": user}
+        return True
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        if request.content_type in ('multipart/form-data', 'application/x-www-form-urlencoded'):
+            form = await request.post()
+            params = {k: _decode(k, v) for k, v in form.items() if isinstance(v, str)}
+        elif request.can_read_body:
+            params = await request.json()
+        else:
+            params = dict(request.query)
+
+        if method == "getUpdates":
+            result = await self._get_updates(float(params.get("timeout", 0)))
+        elif method == "setWebhook":
+            self._start_webhook(params)
+            result = True
+        elif method == "deleteWebhook":
+            self._stop_webhook()
+            result = True
+        else:
+            responder = self.responders.get(method)
+            result = responder(params) if responder else self._default_result(method, params)
+
+        for listener in self.listeners:
+            listener(method, params, result)
+        return web.json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, timeout):
+        batch = []
+        try:
+            batch.append(await asyncio.wait_for(self.updates.get(), timeout=max(timeout, 0.01)))
+        except asyncio.TimeoutError:
+            return batch
+        while len(batch) < 100 and not self.updates.empty():
+            batch.append(self.updates.get_nowait())
+        if self._webhook_tasks:
+            # Запрос пережил остановку polling, а обновления уже идут на вебхук: возвращаем их в очередь
+            for update in batch:
+                self.updates.put_nowait(update)
+            return []
+        return batch
+
+    # --- Доставка на вебхук ---
+    def _start_webhook(self, params):
+        self._stop_webhook()
+        connections = int(params.get("max_connections") or 40)
+        headers = {SECRET_HEADER: params["secret_token"]} if params.get("secret_token") else {}
+        self._webhook_tasks = [
+            asyncio.create_task(self._deliver(params["url"], headers)) for _ in range(connections)
+        ]
+
+    def _stop_webhook(self):
+        for task in self._webhook_tasks:
+            task.cancel()
+        self._webhook_tasks = []
+
+    async def _deliver(self, url, headers):
+        # Как и Telegram, держим не больше max_connections одновременных запросов
+        while True:
+            update = await self.updates.get()
+            while True:
+                try:
+                    async with self._session.post(url, json=update, headers=headers) as response:
+                        if response.status == 200:
+                            break
+                except Exception as e:
+                    logging.warning(f"Fake API: доставка на вебхук не удалась: {e}")
+                await asyncio.sleep(0.1)
+
+    async def start(self, host, port):
+        self._session = ClientSession()
+        self._runner = web.AppRunner(self.app, handle_signals=False)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        self._stop_webhook()
+        await self._runner.cleanup()
+        await self._session.close()
@@ -0,0 +1,376 @@
+"""
+Сквозной нагрузочный тест: настоящий бот (bot.py) в отдельном процессе, поддельный Bot API
+(bench/fake_api.py) и тысячи симулированных пользователей, которые проходят сценарий покупки
+/start → Каталог → категория → подкатегория → товар → В корзину → количество → подтверждение →
+Оформить заказ → адрес → Я оплатил(а). Бот работает с Postgres из .env (POSTGRES_*).
+
+Время шага — от выдачи обновления боту до появления в чате ответа, нужного для следующего шага.
+Пользователи ищут кнопки по тексту, как живой человек, поэтому тест не зависит от формата callback_data.
+
+Запуск из каталога tgbot:
+    python -m bench.load_test --seed --users 2000 --concurrency 500
+    python -m bench.load_test --cleanup   # удалить тестовый каталог, заказы и пользователей
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+import asyncpg
+from bench.fake_api import BENCH_TOKEN, FakeBotAPI
+from bench.stats import percentile
+from db import DB_CONFIG
+
+HOST = '127.0.0.1'
+BOT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bot.py')
+# Названия тестовых категорий и товаров начинаются с этого префикса; по нему же --cleanup их удаляет
+SEED_PREFIX = 'Нагрузочный тест'
+# ID симулированных пользователей: заведомо вне диапазона реальных
+USER_ID_BASE = 7_000_000_000
+STARTUP_TIMEOUT = 60
+SHUTDOWN_TIMEOUT = 30
+CATALOG_ATTEMPTS = 3
+
+CATALOG_BUTTON = "🛍️ Каталог"
+NAV_BUTTONS = ("Далее ▶️", "◀️ Назад")
+CONTENT_METHODS = ('sendMessage', 'sendPhoto', 'editMessageText', 'editMessageCaption', 'editMessageReplyMarkup',
+                   'deleteMessage')
+STEPS = ('start', 'catalog', 'category', 'subcategory', 'product', 'addcart', 'quantity', 'confirm', 'order',
+         'delivery', 'paid')
+
+
+class StepFailed(Exception):
+    pass
+
+
+def text(message):
+    return message.get('text') or message.get('caption') or ''
+
+
+def buttons(message):
+    markup = message.get('reply_markup') or {}
+    return [b for row in markup.get('inline_keyboard', []) for b in row if 'callback_data' in b]
+
+
+def find_button(message, label):
+    return next((b for b in buttons(message) if b['text'].startswith(label)), None)
+
+
+def item_buttons(message):
+    """Кнопки категорий или товаров без кнопок перехода по страницам; тестовые — в приоритете."""
+    items = [b for b in buttons(message) if b['text'] not in NAV_BUTTONS]
+    seeded = [b for b in items if b['text'].startswith(SEED_PREFIX)]
+    return seeded or items
+
+
+class Chat:
+    """Сообщения бота в чате одного пользователя, как их видит клиент Telegram."""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.messages = {}  # message_id -> сообщение в формате Bot API
+        self.versions = {}  # message_id -> номер последнего изменения
+        self.version = 0
+        self.changed = asyncio.Event()
+
+    def apply(self, method, params, result):
+        self.version += 1
+        if method == 'deleteMessage':
+            message_id = int(params['message_id'])
+            self.messages.pop(message_id, None)
+            self.versions.pop(message_id, None)
+        else:
+            message = self.messages.setdefault(result['message_id'], {})
+            # editMessageText без reply_markup убирает клавиатуру, editMessageReplyMarkup не трогает текст
+            if method in ('editMessageText', 'editMessageCaption'):
+                message.pop('reply_markup', None)
+            message.update(result)
+            self.versions[result['message_id']] = self.version
+        self.changed.set()
+
+    async def wait(self, since, predicate):
+        """Ждет сообщения, измененного после since и подходящего под predicate."""
+        while True:
+            for message_id, message in self.messages.items():
+                if self.versions[message_id] > since and predicate(message):
+                    return message
+            self.changed.clear()
+            await self.changed.wait()
+
+
+class LoadTest:
+    def __init__(self, api, step_timeout, think_time):
+        self.api = api
+        self.step_timeout = step_timeout
+        self.think_time = think_time
+        self.chats = {}
+        self.timings = defaultdict(list)
+        self.failures = Counter()
+        self.completed = 0
+        self.dead_ends = 0
+        api.listeners.append(self.on_call)
+
+    def on_call(self, method, params, result):
+        if method not in CONTENT_METHODS:
+            return
+        chat = self.chats.get(int(params.get('chat_id', 0)))
+        if chat is not None:
+            chat.apply(method, params, result)
+
+    # --- Шаги сценария ---
+    async def step(self, name, chat, update, predicate):
+        if self.think_time:
+            await asyncio.sleep(random.uniform(0, 2 * self.think_time))
+        since = chat.version
+        started = time.perf_counter()
+        self.api.push(update)
+        try:
+            async with asyncio.timeout(self.step_timeout):
+                message = await chat.wait(since, predicate)
+        except TimeoutError:
+            self.failures[name] += 1
+            raise StepFailed(name)
+        self.timings[name].append(time.perf_counter() - started)
+        return message
+
+    async def send(self, name, chat, message_text, predicate):
+        return await self.step(name, chat, self.api.make_message_update(chat.user_id, message_text), predicate)
+
+    async def click(self, name, chat, message, button, predicate):
+        if button is None:
+            self.failures[name] += 1
+            raise StepFailed(name)
+        update = self.api.make_callback_update(chat.user_id, button['callback_data'], message)
+        return await self.step(name, chat, update, predicate)
+
+    async def open_products(self, chat):
+        """Каталог → категория → подкатегории, пока не появится список товаров."""
+        for _ in range(CATALOG_ATTEMPTS):
+            message = await self.send('catalog', chat, CATALOG_BUTTON, lambda m: 'Выберите категорию' in text(m))
+            name = 'category'
+            while 'Выберите' in text(message):
+                choices = item_buttons(message)
+                message_id = message['message_id']
+                message = await self.click(name, chat, message, random.choice(choices) if choices else None,
+                                           lambda m: m['message_id'] == message_id)
+                name = 'subcategory'
+            if item_buttons(message):
+                return message
+            # Категория без товаров: начинаем заново с каталога
+            self.dead_ends += 1
+        self.failures['catalog'] += 1
+        raise StepFailed('catalog')
+
+    async def run_user(self, user_id):
+        chat = self.chats[user_id] = Chat(user_id)
+        try:
+            await self.send('start', chat, '/start', lambda m: 'Выберите действие' in text(m))
+            message = await self.open_products(chat)
+            message = await self.click('product', chat, message, random.choice(item_buttons(message)),
+                                       lambda m: find_button(m, "➕ Добавить в корзину"))
+            message = await self.click('addcart', chat, message, find_button(message, "➕ Добавить в корзину"),
+                                       lambda m: find_button(m, "1"))
+            message = await self.click('quantity', chat, message, find_button(message, str(random.randint(1, 3))),
+                                       lambda m: find_button(m, "✅ Добавить"))
+            message = await self.click('confirm', chat, message, find_button(message, "✅ Добавить"),
+                                       lambda m: find_button(m, "💳 Оформить заказ"))
+            await self.click('order', chat, message, find_button(message, "💳 Оформить заказ"),
+                             lambda m: 'Введите адрес' in text(m))
+            message = await self.send('delivery', chat, f"{SEED_PREFIX}: г. Москва, ул. Тестовая, д. {user_id % 100}",
+                                      lambda m: find_button(m, "✅ Я оплатил(а)"))
+            await self.click('paid', chat, message, find_button(message, "✅ Я оплатил(а)"),
+                             lambda m: 'продолжить покупки' in text(m))
+            self.completed += 1
+        except StepFailed:
+            pass
+        finally:
+            del self.chats[user_id]
+
+    async def run(self, users, concurrency, user_id_base):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run_limited(user_id):
+            async with semaphore:
+                await self.run_user(user_id)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(run_limited(user_id_base + i) for i in range(users)))
+        return time.perf_counter() - started
+
+
+# --- Тестовые данные ---
+async def seed_catalog(conn, categories, subcategories, products):
+    await cleanup_catalog(conn)
+    n = 0
+    for i in range(categories):
+        root_id = await conn.fetchval(
+            "INSERT INTO shop_category (name, parent_id, sort_order, is_active) VALUES ($1, NULL, 0, TRUE) RETURNING id",
+            f"{SEED_PREFIX} {i + 1}")
+        for j in range(subcategories):
+            sub_id = await conn.fetchval(
+                "INSERT INTO shop_category (name, parent_id, sort_order, is_active) VALUES ($1, $2, 0, TRUE) RETURNING id",
+                f"{SEED_PREFIX} {i + 1}.{j + 1}", root_id)
+            rows = []
+            for _ in range(products):
+                n += 1
+                # Половина товаров с фото (уже загруженным в Telegram, по file_id), половина — текстом
+                image, file_id = ('products/load-test.jpg', f'load-test-{n}') if n % 2 else (None, '')
+                rows.append((f"{SEED_PREFIX}: товар {n}", 'Товар для нагрузочного теста', image, file_id,
+                             random.randint(100, 5000), sub_id))
+            await conn.executemany(
+                "INSERT INTO shop_product (name, description, image, image_file_id, price, category_id, is_active) "
+                "VALUES ($1, $2, $3, $4, $5, $6, TRUE)", rows)
+    print(f"Тестовый каталог: {categories} категорий, {categories * subcategories} подкатегорий, {n} товаров")
+
+
+async def cleanup_catalog(conn):
+    categories = await conn.fetch("SELECT id FROM shop_category WHERE name LIKE $1 || '%'", SEED_PREFIX)
+    ids = [row['id'] for row in categories]
+    if not ids:
+        return
+    products = "SELECT id FROM shop_product WHERE category_id = ANY($1::bigint[])"
+    await conn.execute(f"UPDATE shop_orderitem SET product_id = NULL WHERE product_id IN ({products})", ids)
+    await conn.execute(f"DELETE FROM shop_cartitem WHERE product_id IN ({products})", ids)
+    await conn.execute("DELETE FROM shop_product WHERE category_id = ANY($1::bigint[])", ids)
+    await conn.execute("DELETE FROM shop_category WHERE parent_id = ANY($1::bigint[])", ids)
+    await conn.execute("DELETE FROM shop_category WHERE id = ANY($1::bigint[])", ids)
+
+
+async def cleanup_users(conn, first_id, last_id):
+    await conn.execute("DELETE FROM shop_orderitem WHERE order_id IN "
+                       "(SELECT id FROM shop_order WHERE user_id BETWEEN $1 AND $2)", first_id, last_id)
+    await conn.execute("DELETE FROM shop_order WHERE user_id BETWEEN $1 AND $2", first_id, last_id)
+    await conn.execute("DELETE FROM shop_cartitem WHERE user_id BETWEEN $1 AND $2", first_id, last_id)
+    await conn.execute("DELETE FROM shop_cartitemarchive WHERE user_id BETWEEN $1 AND $2", first_id, last_id)
+    await conn.execute("DELETE FROM shop_broadcast_recipients WHERE telegramuser_id BETWEEN $1 AND $2",
+                       first_id, last_id)
+    await conn.execute("DELETE FROM shop_telegramuser WHERE user_id BETWEEN $1 AND $2", first_id, last_id)
+    await conn.execute("DELETE FROM shop_userstats WHERE user_id BETWEEN $1 AND $2", first_id, last_id)
+
+
+# --- Процесс бота ---
+def start_bot(args, api_port, workdir, log_level='WARNING'):
+    env = dict(
+        os.environ,
+        TG_BOT_TOKEN=BENCH_TOKEN,
+        CHANNEL_ID='-1001',
+        TELEGRAM_API_URL=f"http://{HOST}:{api_port}",
+        BOT_MODE=args.mode,
+        BOT_WORKERS=str(args.workers),
+        METRICS_PORT=str(args.metrics_port),
+        LOG_LEVEL=log_level,
+        ORDERS_EXPORT_DIR=os.path.join(workdir, 'exports'),
+    )
+    if args.mode == 'webhook':
+        env.update(WEBHOOK_URL=f"http://{HOST}:{args.webhook_port}", WEBHOOK_HOST=HOST,
+                   WEBHOOK_PORT=str(args.webhook_port), WEBHOOK_SECRET='load-test')
+    if args.workers > 1 and args.metrics_port:
+        env['PROMETHEUS_MULTIPROC_DIR'] = os.path.join(workdir, 'metrics')
+        os.makedirs(env['PROMETHEUS_MULTIPROC_DIR'])
+    # bot.log, выгрузка заказов и вывод бота остаются во временном каталоге
+    output = open(os.path.join(workdir, 'bot.out'), 'w')
+    return subprocess.Popen([sys.executable, BOT_PATH], cwd=workdir, env=env, stdout=output, stderr=subprocess.STDOUT)
+
+
+def stop_bot(process):
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(SHUTDOWN_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+async def wait_bot_ready(api, process, mode):
+    # Бот готов, когда начал опрашивать getUpdates или зарегистрировал вебхук
+    ready = asyncio.Event()
+    ready_method = 'setWebhook' if mode == 'webhook' else 'getUpdates'
+
+    def on_call(method, params, result):
+        if method == ready_method:
+            ready.set()
+
+    api.listeners.append(on_call)
+    try:
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while not ready.is_set():
+            if process.poll() is not None:
+                raise RuntimeError(f"Бот завершился с кодом {process.returncode} при запуске")
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Бот не запустился за {STARTUP_TIMEOUT} с")
+            await asyncio.sleep(0.1)
+    finally:
+        api.listeners.remove(on_call)
+
+
+def print_report(test, args, elapsed):
+    updates = sum(len(t) for t in test.timings.values()) + sum(test.failures.values())
+    print(f"\nпользователей: {args.users}, одновременно: {args.concurrency}, режим: {args.mode}, "
+          f"процессов-обработчиков: {args.workers}")
+    print(f"длительность: {elapsed:.1f} с, сценариев завершено: {test.completed} "
+          f"({test.completed / elapsed:.1f}/с), обновлений: {updates} ({updates / elapsed:.0f}/с)")
+    if test.dead_ends:
+        print(f"категорий без товаров по пути: {test.dead_ends}")
+    print(f"{'шаг':<14}{'выполнено':>10}{'ошибок':>8}{'в сек.':>9}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    for name in STEPS:
+        timings = test.timings.get(name, [])
+        if not timings and not test.failures[name]:
+            continue
+        print(f"{name:<14}{len(timings):>10}{test.failures[name]:>8}{len(timings) / elapsed:>9.1f}"
+              f"{percentile(timings, 50) * 1000:>10.1f}{percentile(timings, 95) * 1000:>10.1f}"
+              f"{percentile(timings, 99) * 1000:>10.1f}")
+
+
+async def main(args):
+    conn = await asyncpg.connect(**DB_CONFIG)
+    try:
+        if args.cleanup:
+            await cleanup_users(conn, USER_ID_BASE, USER_ID_BASE + 10 ** 9)
+            await cleanup_catalog(conn)
+            print("Тестовые данные удалены")
+            return
+        if args.seed:
+            await seed_catalog(conn, args.categories, args.subcategories, args.products)
+    finally:
+        await conn.close()
+
+    api = FakeBotAPI()
+    await api.start(HOST, args.api_port)
+    workdir = tempfile.mkdtemp(prefix='bot-load-test-')
+    process = start_bot(args, args.api_port, workdir)
+    try:
+        await wait_bot_ready(api, process, args.mode)
+        test = LoadTest(api, args.step_timeout, args.think_time)
+        elapsed = await test.run(args.users, args.concurrency, USER_ID_BASE)
+    finally:
+        await asyncio.get_running_loop().run_in_executor(None, stop_bot, process)
+        await api.stop()
+    print_report(test, args, elapsed)
+    print(f"журнал бота: {workdir}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000, help='сколько пользователей проходят сценарий')
+    parser.add_argument('--concurrency', type=int, default=200, help='сколько пользователей активны одновременно')
+    parser.add_argument('--think-time', type=float, default=0, help='средняя пауза пользователя перед шагом, с')
+    parser.add_argument('--step-timeout', type=float, default=30, help='после скольких секунд шаг считается ошибкой')
+    parser.add_argument('--mode', default='polling', choices=['polling', 'webhook'])
+    parser.add_argument('--workers', type=int, default=1, help='BOT_WORKERS бота')
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--webhook-port', type=int, default=8082)
+    parser.add_argument('--metrics-port', type=int, default=0, help='METRICS_PORT бота, 0 — без /metrics')
+    parser.add_argument('--seed', action='store_true', help='пересоздать тестовый каталог перед запуском')
+    parser.add_argument('--categories', type=int, default=5)
+    parser.add_argument('--subcategories', type=int, default=3, help='подкатегорий в каждой категории')
+    parser.add_argument('--products', type=int, default=20, help='товаров в каждой подкатегории')
+    parser.add_argument('--cleanup', action='store_true', help='удалить тестовый каталог, заказы и пользователей')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(args))
@@ -0,0 +1,278 @@
+"""
+Проверка планов запросов бота: каждый запрос из реестра db.QUERIES (и запросы PostgresStorage)
+выполняется как EXPLAIN на заполненной базе, и проверка падает, если горячий путь читает таблицу
+последовательным сканированием (Seq Scan), целиком по индексу без условия или сортирует строки (Sort).
+
+Тестовые данные (каталог, пользователи, корзины, заказы, рассылки, FAQ, состояния FSM) вставляются
+в одной транзакции, после ANALYZE по ним строятся планы, затем транзакция откатывается:
+база остается как была. Нужен Postgres из .env (POSTGRES_*) с примененными миграциями админки.
+
+Планы строятся с enable_seqscan = off и enable_sort = off: Seq Scan и Sort остаются в плане, только если
+ни один индекс не подходит. Так проверка не зависит от объема данных: на маленькой таблице планировщик
+законно выбирает полный просмотр, но индекс должен быть к тому времени, когда таблица вырастет.
+
+Запуск из каталога tgbot:
+    python -m bench.plan_check            # код возврата 1, если есть нарушения
+    python -m bench.plan_check --verbose  # вывести планы всех запросов
+"""
+import argparse
+import asyncio
+import json
+import sys
+import asyncpg
+from bench.load_test import USER_ID_BASE
+from db import DB_CONFIG, QUERIES
+from fsm_storage import PostgresStorage
+
+# Узлы плана, которые на горячем пути означают отсутствие подходящего индекса
+FORBIDDEN_NODES = ('Seq Scan', 'Sort')
+INDEX_SCANS = ('Index Scan', 'Index Only Scan')
+FULL_INDEX_SCAN = 'Full Index Scan'
+
+# Разрешенные нарушения: запрос -> {узел: причина}. Пополняется только осознанно.
+ALLOWED = {
+    # Сортируются только позиции корзины одного пользователя после изменения:
+    # измененные строки (CTE) объединяются с остальными, прочитанными по индексу
+    'add_to_cart': {'Sort': 'позиции корзины одного пользователя'},
+    'update_cart_item_quantity': {'Sort': 'позиции корзины одного пользователя'},
+    'remove_from_cart': {'Sort': 'позиции корзины одного пользователя'},
+    'create_order': {'Sort': 'позиции корзины одного пользователя'},
+}
+
+
+class Seed:
+    """Объем тестовых данных и ID записей, по которым строятся параметры запросов."""
+
+    def __init__(self, scale):
+        self.users = 200_000 * scale
+        self.cart_users = self.users // 2
+        self.root_categories = 100
+        self.subcategories = 20  # в каждой корневой
+        self.products = 100_000 * scale
+        self.faq = 2_000
+        self.broadcasts = 5_000
+        self.recipients = 100_000 * scale
+        self.orders = 200_000 * scale
+        self.fsm_keys = 100_000 * scale
+        self.user_id = USER_ID_BASE + 42
+        # Заполняются после вставки
+        self.root_category_id = self.category_id = self.product_id = None
+        self.subcategory_id = self.cart_item_id = self.broadcast_id = self.order_id = None
+        self.order_created_at = None
+
+
+async def seed(conn, s):
+    base = USER_ID_BASE
+    await conn.execute("""
+        INSERT INTO shop_category (name, parent_id, sort_order, is_active)
+        SELECT 'План: категория ' || g, NULL, g % 10, g % 20 <> 0 FROM generate_series(1, $1) g
+    """, s.root_categories)
+    await conn.execute("""
+        INSERT INTO shop_category (name, parent_id, sort_order, is_active)
+        SELECT 'План: подкатегория ' || c.id || '.' || g, c.id, g % 5, g % 20 <> 0
+        FROM shop_category c CROSS JOIN generate_series(1, $1) g
+        WHERE c.name LIKE 'План: категория %'
+    """, s.subcategories)
+    await conn.execute("""
+        INSERT INTO shop_product (name, description, image_file_id, price, category_id, is_active)
+        SELECT 'План: товар ' || md5(g::text), '', '', 100 + g % 5000,
+               sub.ids[1 + g % cardinality(sub.ids)], g % 10 <> 0
+        FROM generate_series(1, $1) g,
+             (SELECT array_agg(id) AS ids FROM shop_category WHERE name LIKE 'План: подкатегория %') sub
+    """, s.products)
+    await conn.execute("""
+        INSERT INTO shop_telegramuser (user_id, username, first_name, last_name, is_subscribed, is_active,
+                                       created_at, updated_at)
+        SELECT $1::bigint + g, 'user' || g, 'Имя', '', g % 2 = 0, g % 10 <> 0,
+               NOW() - g * INTERVAL '1 minute', NOW() - g * INTERVAL '1 minute'
+        FROM generate_series(1, $2) g
+    """, base, s.users)
+    # Пять позиций на пользователя; активна только текущая корзина, остальное — история заказов
+    await conn.execute("""
+        INSERT INTO shop_cartitem (user_id, product_id, quantity, is_active, created_at, updated_at)
+        SELECT $1::bigint + u, p.ids[1 + (u * 7 + k) % cardinality(p.ids)], 1 + k, u % 10 = 0 OR k = 0,
+               NOW() - (u + k) * INTERVAL '1 second', NOW() - (u + k) * INTERVAL '1 second'
+        FROM generate_series(1, $2) u, generate_series(0, 4) k,
+             (SELECT array_agg(id) AS ids FROM shop_product WHERE name LIKE 'План: товар %') p
+    """, base, s.cart_users)
+    # Заказы растянуты на несколько месяцев назад: секции для них создаются здесь же (миграция 0021)
+    await conn.execute(
+        "SELECT shop_create_order_partitions((NOW() - $1 * INTERVAL '1 minute')::date, NOW()::date)", s.orders)
+    await conn.execute("""
+        INSERT INTO shop_order (user_id, delivery_info, created_at, status, total_cost, item_count)
+        SELECT $1::bigint + 1 + g % $3, 'адрес', NOW() - g * INTERVAL '1 minute',
+               CASE WHEN g % 3 = 0 THEN 'created' ELSE 'paid' END, 100, 1
+        FROM generate_series(1, $2) g
+    """, base, s.orders, s.cart_users)
+    await conn.execute("""
+        INSERT INTO shop_faq (question, answer, is_active)
+        SELECT 'План: вопрос ' || g, 'Ответ ' || g, g % 10 <> 0 FROM generate_series(1, $1) g
+    """, s.faq)
+    await conn.execute("""
+        INSERT INTO shop_broadcast (message, created_at, status, sent_count, send_to_all)
+        SELECT 'План: рассылка ' || g, NOW() - g * INTERVAL '1 hour',
+               CASE WHEN g <= 3 THEN 'pending' ELSE 'sent' END, 0, FALSE
+        FROM generate_series(1, $1) g
+    """, s.broadcasts)
+    await conn.execute("""
+        INSERT INTO shop_broadcast_recipients (broadcast_id, telegramuser_id)
+        SELECT b.ids[1 + g % 20], $1::bigint + g
+        FROM generate_series(1, $2) g,
+             (SELECT array_agg(id) AS ids FROM shop_broadcast WHERE message LIKE 'План: рассылка %') b
+    """, base, min(s.recipients, s.users))
+    await conn.execute("""
+        INSERT INTO bot_fsm_state (key, value, expires_at)
+        SELECT 'plan:' || g, '{}'::jsonb, NOW() + INTERVAL '1 day' - (g % 100) * INTERVAL '1 minute'
+        FROM generate_series(1, $1) g
+        ON CONFLICT (key) DO NOTHING
+    """, s.fsm_keys)
+    for table in ('shop_category', 'shop_product', 'shop_telegramuser', 'shop_cartitem', 'shop_order', 'shop_faq',
+                  'shop_broadcast', 'shop_broadcast_recipients', 'bot_fsm_state'):
+        await conn.execute(f"ANALYZE {table}")
+
+    s.root_category_id = await conn.fetchval(
+        "SELECT id FROM shop_category WHERE name LIKE 'План: категория %' AND is_active ORDER BY id LIMIT 1")
+    s.category_id = await conn.fetchval(
+        "SELECT category_id FROM shop_product WHERE name LIKE 'План: товар %' AND is_active ORDER BY id LIMIT 1")
+    s.product_id = await conn.fetchval(
+        "SELECT id FROM shop_product WHERE category_id = $1 AND is_active ORDER BY name, id OFFSET 10 LIMIT 1",
+        s.category_id)
+    s.subcategory_id = await conn.fetchval(
+        "SELECT id FROM shop_category WHERE parent_id = $1 AND is_active ORDER BY sort_order, name, id LIMIT 1",
+        s.root_category_id)
+    s.cart_item_id = await conn.fetchval(
+        "SELECT id FROM shop_cartitem WHERE user_id = $1 AND is_active LIMIT 1", s.user_id)
+    s.order_id, s.order_created_at = await conn.fetchrow(
+        "SELECT id, created_at FROM shop_order WHERE user_id = $1 LIMIT 1", s.user_id)
+    s.broadcast_id = await conn.fetchval(
+        "SELECT id FROM shop_broadcast WHERE message LIKE 'План: рассылка %' ORDER BY id LIMIT 1")
+
+
+def sample_params(s):
+    """Аргументы каждого запроса, как их передает бот. Новый запрос в db.QUERIES без строки здесь — ошибка."""
+    return {
+        'add_or_update_user': (s.user_id, 'user', 'Имя', '', True),
+        'fetch_recent_subscribers': (3600.0,),
+        'root_categories_page_first': (6,),
+        'root_categories_page_next': (s.root_category_id, 6),
+        'root_categories_page_prev': (s.root_category_id, 6),
+        'subcategories_page_first': (s.root_category_id, 6),
+        'subcategories_page_next': (s.root_category_id, s.subcategory_id, 6),
+        'subcategories_page_prev': (s.root_category_id, s.subcategory_id, 6),
+        'products_page_first': (s.category_id, 11),
+        'products_page_next': (s.category_id, s.product_id, 11),
+        'products_page_prev': (s.category_id, s.product_id, 11),
+        'fetch_product': (s.product_id,),
+        'save_product_image_file_id': (s.product_id, 'products/plan.jpg', 'file-id'),
+        'fetch_cart': (s.user_id,),
+        'add_to_cart': (s.user_id, s.product_id, 1),
+        'update_cart_item_quantity': (s.user_id, s.cart_item_id, 1),
+        'remove_from_cart': (s.user_id, s.cart_item_id),
+        'compact_cart': (1000, 30 * 86400.0),
+        'ensure_order_partitions': (3,),
+        'order_partitions_months_ahead': (3,),
+        'update_order_status': ('paid', s.order_id, s.user_id, s.order_created_at),
+        'update_order_status_by_id': ('paid', s.order_id, s.user_id),
+        'create_order': (s.user_id, 'адрес'),
+        'fetch_faq_index': (),
+        'get_pending_broadcast': (300.0,),
+        'broadcast_recipients_all': (USER_ID_BASE, 1000),
+        'broadcast_recipients_selected': (USER_ID_BASE, 1000, s.broadcast_id),
+        'checkpoint_broadcast': (s.broadcast_id, s.user_id, [s.user_id], True),
+        'finalize_broadcast': (s.broadcast_id,),
+        'fsm_upsert': ([f'plan:{i}' for i in range(100)], ['{"state": "x"}'] * 100, 3600.0),
+        'fsm_select': ('plan:1', 'state'),
+        'fsm_cleanup': (),
+    }
+
+
+def bot_queries():
+    queries = {name: query.sql for name, query in QUERIES.items()}
+    queries.update(fsm_upsert=PostgresStorage.UPSERT, fsm_select=PostgresStorage.SELECT,
+                   fsm_cleanup=PostgresStorage.CLEANUP)
+    return queries
+
+
+def walk(node):
+    yield node
+    for child in node.get('Plans', ()):
+        yield from walk(child)
+
+
+def describe(node):
+    relation = node.get('Relation Name')
+    index = node.get('Index Name')
+    return node['Node Type'] + (f" on {relation}" if relation else '') + (f" using {index}" if index else '')
+
+
+def node_kind(node, partial_indexes):
+    # Чтение частичного индекса целиком — нормально: в нем только строки, подходящие под его условие
+    if node['Node Type'] in INDEX_SCANS and 'Index Cond' not in node and node['Index Name'] not in partial_indexes:
+        return FULL_INDEX_SCAN
+    return node['Node Type']
+
+
+def violations(name, plan, partial_indexes):
+    allowed = ALLOWED.get(name, {})
+    problems = []
+    for node in walk(plan):
+        kind = node_kind(node, partial_indexes)
+        if kind in FORBIDDEN_NODES + (FULL_INDEX_SCAN,) and kind not in allowed:
+            problems.append(describe(node) if kind == node['Node Type'] else f"{kind} {describe(node)}")
+    return problems
+
+
+async def explain(conn, sql, params):
+    # Параметры передаются как есть: строится custom-план, как у первых выполнений prepared statement
+    plan = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {sql}", *params)
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']
+
+
+def print_plan(node, depth=0):
+    details = [node[key] for key in ('Index Cond', 'Filter') if key in node]
+    print(f"    {'  ' * depth}{describe(node)}" + (f"  [{'; '.join(details)}]" if details else ''))
+    for child in node.get('Plans', ()):
+        print_plan(child, depth + 1)
+
+
+async def main(args):
+    conn = await asyncpg.connect(**DB_CONFIG)
+    failed = 0
+    try:
+        transaction = conn.transaction()
+        await transaction.start()
+        try:
+            s = Seed(args.scale)
+            await seed(conn, s)
+            await conn.execute("SET LOCAL enable_seqscan = off")
+            await conn.execute("SET LOCAL enable_sort = off")
+            params = sample_params(s)
+            partial_indexes = {row[0] for row in await conn.fetch(
+                "SELECT indexrelid::regclass::text FROM pg_index WHERE indpred IS NOT NULL")}
+            for name, sql in bot_queries().items():
+                if name not in params:
+                    print(f"FAIL {name}: нет параметров в sample_params()")
+                    failed += 1
+                    continue
+                plan = await explain(conn, sql, params[name])
+                problems = violations(name, plan, partial_indexes)
+                print(f"{'FAIL' if problems else 'ok  '} {name}" + (f": {', '.join(problems)}" if problems else ''))
+                if problems or args.verbose:
+                    print_plan(plan)
+                failed += bool(problems)
+        finally:
+            await transaction.rollback()
+    finally:
+        await conn.close()
+    print(f"\nзапросов с нарушениями: {failed}" if failed else "\nвсе запросы читают данные по индексам")
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=int, default=1, help='множитель объема тестовых данных')
+    parser.add_argument('--verbose', action='store_true', help='вывести планы всех запросов')
+    args = parser.parse_args()
+    sys.exit(1 if asyncio.run(main(args)) else 0)
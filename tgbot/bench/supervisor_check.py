@@ -0,0 +1,101 @@
+"""
+Проверка перезапуска процессов супервизора (supervisor.py): бот с BOT_WORKERS=2 на поддельном Bot API,
+процесс-обработчик и процесс фоновых задач убиваются SIGKILL, супервизор должен поднять замену,
+и замена обработчика должна ответить на /start. Нужен Postgres из .env (POSTGRES_*), как для load_test.
+
+Запуск из каталога tgbot:
+    python -m bench.supervisor_check   # код возврата 1, если замена не запустилась или не ответила
+"""
+import argparse
+import asyncio
+import logging
+import os
+import re
+import signal
+import sys
+import tempfile
+import time
+from bench.fake_api import FakeBotAPI
+from bench.load_test import HOST, USER_ID_BASE, Chat, LoadTest, StepFailed, start_bot, stop_bot, text, wait_bot_ready
+
+WORKERS = 2
+RESTART_TIMEOUT = 60
+# Строки bot.log, по которым видны pid процессов (supervisor.py)
+WORKER_STARTED = re.compile(r'Обработчик #(\d+) запущен \(pid (\d+)\)')
+BACKGROUND_STARTED = re.compile(r'Процесс фоновых задач запущен \(pid (\d+)\)')
+
+
+def started_pids(workdir):
+    """pid запущенных процессов по bot.log: {'worker-0': [..], 'background': [..]} в порядке запуска."""
+    pids = {}
+    with open(os.path.join(workdir, 'bot.log'), encoding='utf-8') as log:
+        for line in log:
+            if match := WORKER_STARTED.search(line):
+                pids.setdefault(f'worker-{match[1]}', []).append(int(match[2]))
+            elif match := BACKGROUND_STARTED.search(line):
+                pids.setdefault('background', []).append(int(match[1]))
+    return pids
+
+
+async def wait_started(workdir, name, count):
+    """Ждет count-го запуска процесса name и возвращает его pid."""
+    deadline = time.monotonic() + RESTART_TIMEOUT
+    while time.monotonic() < deadline:
+        pids = started_pids(workdir).get(name, [])
+        if len(pids) >= count:
+            return pids[count - 1]
+        await asyncio.sleep(0.2)
+    raise StepFailed(f'{name}: запуск #{count} не дождались за {RESTART_TIMEOUT} с')
+
+
+async def answers_start(test, user_id):
+    chat = test.chats[user_id] = Chat(user_id)
+    try:
+        await test.send('start', chat, '/start', lambda m: 'Выберите действие' in text(m))
+    finally:
+        del test.chats[user_id]
+
+
+async def check(api, workdir):
+    test = LoadTest(api, step_timeout=30, think_time=0)
+    # Супервизор раскладывает обновления по user_id % BOT_WORKERS: этот пользователь попадает в обработчик #0
+    user_id = USER_ID_BASE
+    await answers_start(test, user_id)
+    print('ok   обработчик #0 отвечает')
+
+    for name in ('worker-0', 'background'):
+        pid = await wait_started(workdir, name, 1)
+        os.kill(pid, signal.SIGKILL)
+        new_pid = await wait_started(workdir, name, 2)
+        print(f'ok   {name}: pid {pid} убит, замена запущена (pid {new_pid})')
+
+    await answers_start(test, user_id)
+    print('ok   замена обработчика #0 отвечает')
+
+
+async def main(args):
+    api = FakeBotAPI()
+    await api.start(HOST, args.api_port)
+    workdir = tempfile.mkdtemp(prefix='bot-supervisor-check-')
+    bot_args = argparse.Namespace(mode='polling', workers=WORKERS, metrics_port=0, webhook_port=0)
+    process = start_bot(bot_args, args.api_port, workdir, log_level='INFO')
+    failed = False
+    try:
+        await wait_bot_ready(api, process, 'polling')
+        await check(api, workdir)
+    except StepFailed as e:
+        print(f'FAIL {e}')
+        failed = True
+    finally:
+        await asyncio.get_running_loop().run_in_executor(None, stop_bot, process)
+        await api.stop()
+    print(f"журнал бота: {workdir}")
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--api-port', type=int, default=8081)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(1 if asyncio.run(main(args)) else 0)
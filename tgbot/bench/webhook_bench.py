@@ -0,0 +1,169 @@
+"""
+Сравнение режимов polling и webhook: пропускная способность (обновлений/с) и задержка
+от выдачи обновления до ответа бота (p50/p95/p99).
+
+Поддельный Bot API (bench/fake_api.py) работает в отдельном процессе, чтобы не делить
+с ботом event loop. Хендлер синтетический: ждет HANDLER_DELAY (имитация запроса к БД)
+и отвечает sendMessage, по которому фиксируется завершение обработки.
+
+Запуск из каталога tgbot:
+    python -m bench.webhook_bench --updates 5000 --rate 1000
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import time
+from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import ClientSession, ClientTimeout, web
+from bench.fake_api import BENCH_TOKEN, FakeBotAPI
+from bench.stats import percentile
+from webhook import WebhookServer
+
+HOST = '127.0.0.1'
+API_PORT = 8081
+WEBHOOK_PORT = 8082
+WEBHOOK_SECRET = 'bench-secret'
+
+
+# --- Процесс поддельного API ---
+async def _serve_api(ready):
+    api = FakeBotAPI()
+    sent_at = {}
+    done_at = {}
+    all_done = asyncio.Event()
+    expected = 0
+
+    def on_call(method, params, result):
+        if method == 'sendMessage':
+            update_id = int(params['text'])
+            done_at[update_id] = time.perf_counter()
+            if len(done_at) >= expected:
+                all_done.set()
+
+    async def run(request):
+        nonlocal expected
+        params = await request.json()
+        sent_at.clear()
+        done_at.clear()
+        all_done.clear()
+        expected = params['updates']
+        interval = 1 / params['rate'] if params['rate'] else 0
+        started = time.perf_counter()
+        for i in range(expected):
+            update = api.make_message_update(1000 + i % params['users'], '')
+            update['message']['text'] = str(update['update_id'])
+            sent_at[update['update_id']] = time.perf_counter()
+            api.push(update)
+            if interval:
+                # Открытая нагрузка: обновления приходят по расписанию, независимо от скорости бота
+                delay = started + (i + 1) * interval - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        await all_done.wait()
+        latencies = [done_at[u] - sent_at[u] for u in done_at]
+        return web.json_response({
+            'elapsed': max(done_at.values()) - started,
+            'latencies': latencies,
+        })
+
+    api.listeners.append(on_call)
+    api.app.router.add_post('/_bench/run', run)
+    await api.start(HOST, API_PORT)
+    ready.set()
+    await asyncio.Event().wait()
+
+
+def _api_process(ready):
+    asyncio.run(_serve_api(ready))
+
+
+# --- Бот ---
+def make_bot_and_dispatcher(handler_delay):
+    bot = Bot(BENCH_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(f"http://{HOST}:{API_PORT}")))
+    dp = Dispatcher()
+
+    @dp.message()
+    async def echo(message: types.Message):
+        await asyncio.sleep(handler_delay)
+        # В тексте номер обновления: по ответу с ним поддельный API считает задержку
+        await message.answer(message.text)
+
+    return bot, dp
+
+
+async def run_mode(mode, args):
+    bot, dp = make_bot_and_dispatcher(args.handler_delay)
+
+    if mode == 'polling':
+        runner = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False,
+                                                      polling_timeout=1))
+        server = None
+    else:
+        server = WebhookServer(lambda update: dp.feed_raw_update(bot, update), secret=WEBHOOK_SECRET,
+                               path='/webhook', max_concurrency=args.concurrency)
+        await server.start(HOST, WEBHOOK_PORT)
+        await bot.set_webhook(f"http://{HOST}:{WEBHOOK_PORT}/webhook", secret_token=WEBHOOK_SECRET,
+                              max_connections=args.connections)
+        runner = None
+
+    try:
+        async with ClientSession(timeout=ClientTimeout(total=None)) as session:
+            payload = {'updates': args.updates, 'rate': args.rate, 'users': args.users}
+            async with session.post(f"http://{HOST}:{API_PORT}/_bench/run", json=payload) as response:
+                result = await response.json()
+    finally:
+        if runner is not None:
+            await dp.stop_polling()
+            await runner
+        else:
+            await bot.delete_webhook()
+            await server.stop()
+        await bot.session.close()
+
+    latencies = result['latencies']
+    return {
+        'mode': mode,
+        'rate': len(latencies) / result['elapsed'],
+        'p50': percentile(latencies, 50) * 1000,
+        'p95': percentile(latencies, 95) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+    }
+
+
+async def main(args):
+    results = []
+    for mode in args.modes:
+        results.append(await run_mode(mode, args))
+        await asyncio.sleep(0.5)
+
+    print(f"\nобновлений: {args.updates}, темп подачи: {args.rate or 'без ограничения'}/с, "
+          f"задержка хендлера: {args.handler_delay * 1000:.0f} мс")
+    print(f"{'режим':<10}{'обн./с':>10}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    for r in results:
+        print(f"{r['mode']:<10}{r['rate']:>10.0f}{r['p50']:>10.1f}{r['p95']:>10.1f}{r['p99']:>10.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', nargs='+', default=['polling', 'webhook'], choices=['polling', 'webhook'])
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--rate', type=float, default=0, help='обновлений в секунду, 0 — все сразу')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--handler-delay', type=float, default=0.02)
+    parser.add_argument('--concurrency', type=int, default=100, help='WEBHOOK_MAX_CONCURRENCY')
+    parser.add_argument('--connections', type=int, default=40, help='max_connections в setWebhook')
+    args = parser.parse_args()
+    # Журнал aiogram по каждому обновлению заметно тормозит бота и искажает замер
+    logging.basicConfig(level=logging.WARNING)
+
+    ready = multiprocessing.Event()
+    api = multiprocessing.Process(target=_api_process, args=(ready,), daemon=True)
+    api.start()
+    ready.wait()
+    try:
+        asyncio.run(main(args))
+    finally:
+        api.terminate()
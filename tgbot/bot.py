@@ -1,62 +1,116 @@
 import logging
 import asyncio
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.exceptions import TelegramForbiddenError
+from datetime import datetime, timezone
 from decimal import Decimal
 from aiogram.types import FSInputFile
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.enums import ParseMode
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.filters import Command
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
 import os
 from dotenv import load_dotenv
+from callbacks import (CallbackRouter, CatalogLevel, CartAction, CategoryCallback, SubcategoryCallback,
+                       CatalogPageCallback, ProductCallback, AddToCartCallback, QuantityCallback, ConfirmCallback,
+                       CartItemCallback, CartNoopCallback, OrderCallback, PaidCallback, FaqCallback, FaqAllCallback,
+                       FaqBackCallback, MainMenuCallback)
 from keyboards import main_menu, get_inline_categories, get_inline_products, get_add_to_cart_keyboard, get_quantity_keyboard, get_confirm_keyboard, get_cart_keyboard, get_faq_keyboard, get_payment_keyboard, get_back_to_faq_keyboard
-from db import (get_pool, fetch_categories, fetch_subcategories, fetch_products, fetch_product, fetch_cart, add_to_cart, remove_from_cart, create_order, search_faq, get_faq_answer, get_all_faq, add_or_update_user, get_pending_broadcast, get_all_active_users_ids, finalize_broadcast, add_recipients_to_broadcast, get_broadcast_recipients_from_db, update_cart_item_quantity, update_order_status)
+from db import (DB_CONFIG, get_pool, fetch_categories_page, fetch_products_page, fetch_product, save_product_image_file_id, fetch_cart, add_to_cart, remove_from_cart, create_order, search_faq, get_faq_answer, get_all_faq, add_or_update_user, update_cart_item_quantity, update_order_status)
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from excel_export import append_order_to_excel
+from excel_export import append_order_to_journal, export_compactor
+from catalog_cache import catalog_cache
+from broadcast import broadcast_scheduler
+from cart_compaction import cart_compactor
+from order_partitions import check_order_partitions, order_partition_maintainer
+from subscription import SubscriptionCache
+from fsm_storage import PostgresStorage, create_storage
+from webhook import run_webhook
+from supervisor import BOT_WORKERS, run_supervisor
+from metrics import setup_metrics, start_metrics_server
+from markup_cache import PackedMarkupSession
 
 load_dotenv()
 
 API_TOKEN = os.getenv("TG_BOT_TOKEN")
 CHANNEL_ID = os.getenv("CHANNEL_ID")
 CHANNEL_LINK = os.getenv("CHANNEL_LINK")
+# 'polling' или 'webhook' (настройки вебхука — в webhook.py)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Адрес собственного Bot API сервера (telegram-bot-api) вместо api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 
 logging.basicConfig(
-    level=logging.INFO,
+    level=LOG_LEVEL,
     format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
     handlers=[logging.FileHandler("bot.log"), logging.StreamHandler()]
 )
 
 bot = Bot(
     token=API_TOKEN,
+    # Готовые клавиатуры из markup_cache уходят в Bot API уже сериализованными
+    session=PackedMarkupSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else PRODUCTION),
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
-dp = Dispatcher(storage=MemoryStorage())
+# Состояние диалогов хранится вне процесса (FSM_STORAGE), чтобы бот переживал рестарты и работал в нескольких экземплярах
+dp = Dispatcher(storage=create_storage())
+# Время хендлеров и вызовов Bot API для /metrics
+setup_metrics(dp, bot)
+# Все inline-кнопки: callback_data разбирается один раз, хендлер выбирается по префиксу
+callback_router = CallbackRouter()
+callback_router.setup(dp.callback_query)
  
+subscription_cache = SubscriptionCache(bot, CHANNEL_ID)
+
+# Ссылки на фоновые задачи: на задачу без ссылок event loop держит только слабую, и ее может собрать GC
+background_tasks = set()
+
 async def check_subscription(user_id: int) -> bool:
-    try:
-        member = await bot.get_chat_member(CHANNEL_ID, user_id)
-        return member.status in ("member", "administrator", "creator")
-    except TelegramBadRequest as e:
-        logging.critical(f"CRITICAL: Subscription check failed due to bad request. Check if bot is admin in the channel {CHANNEL_ID}. Error: {e}")
-        # Если бот не в канале или канал указан неверно, доступ не предоставляем.
-        return False
-    except Exception as e:
-        logging.error(f"Unexpected error in subscription check for user {user_id}: {e}")
-        return False
+    return await subscription_cache.is_subscribed(user_id)
+
+def start_background_task(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
 
 @dp.startup()
-async def on_startup(dispatcher):
+async def on_startup(dispatcher, role="all"):
+    """
+    role: 'all' — один процесс делает все; в режиме супервизора (supervisor.py)
+    'worker' только обрабатывает обновления, 'background' только выполняет фоновые задачи.
+    """
     pool = await get_pool()
     dispatcher.workflow_data["pool"] = pool
     logging.info("DB pool created")
-    # Запускаем фоновую задачу для мониторинга рассылок
-    asyncio.create_task(broadcast_scheduler(pool))
+    if isinstance(dispatcher.storage, PostgresStorage):
+        dispatcher.storage.pool = pool
+    # Секции заказов проверяются при каждом запуске, до приема обновлений: от них зависит оформление заказа
+    await check_order_partitions(pool)
+    if role in ("all", "worker"):
+        # Слушаем NOTIFY об изменениях каталога из админки для сброса кэша
+        start_background_task(catalog_cache.listen(**DB_CONFIG))
+        # Статусы подписки: сначала из БД, дальше фоновое обновление для активных пользователей
+        await subscription_cache.seed(pool)
+        start_background_task(subscription_cache.refresh_loop())
+    if role in ("all", "background"):
+        # Запускаем фоновую задачу для мониторинга рассылок
+        start_background_task(broadcast_scheduler(bot, pool))
+        # Сборка XLSX из журнала заказов идет в фоне, оформление заказа ее не ждет
+        start_background_task(export_compactor())
+        # Перенос неактивных позиций корзины в архив, чтобы shop_cartitem оставалась небольшой
+        start_background_task(cart_compactor(pool))
+        # Секции заказов на следующие месяцы: без них оформление заказа в новом месяце упадет
+        start_background_task(order_partition_maintainer(pool))
 
 @dp.shutdown()
 async def on_shutdown(dispatcher):
+    for task in list(background_tasks):
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    # aiogram при остановке хранилище не закрывает: сбрасываем буфер FSM, пока пул еще открыт
+    await dispatcher.storage.close()
     pool = dispatcher.workflow_data.get("pool")
     if pool:
         await pool.close()
@@ -93,61 +147,65 @@ async def cmd_start(message: types.Message, pool):
 
 @dp.message(F.text == "🛍️ Каталог")
 async def catalog_handler(message: types.Message, pool):
-    cats = await fetch_categories(pool)
-    kb = get_inline_categories(cats)
+    page = await fetch_categories_page(pool)
+    kb = get_inline_categories(page)
     if not kb:
         await message.answer("Категории не найдены.")
         return
     await message.answer("📁 Выберите категорию:", reply_markup=kb)
 
-@dp.callback_query(F.data.regexp(r"^(cat|subcat_\d+)_page_(\d+)$"))
-async def category_page_callback(call: types.CallbackQuery, pool):
-    prefix_part, page_str = call.data.rsplit("_page_", 1)
-    page = int(page_str)
+@callback_router(CatalogPageCallback)
+async def category_page_callback(call: types.CallbackQuery, callback_data: CatalogPageCallback, pool):
+    cursor = callback_data.cursor
 
-    if prefix_part == 'cat':
+    if callback_data.level == CatalogLevel.CATEGORIES:
         # Пагинация по основным категориям
-        items = await fetch_categories(pool)
-        kb = get_inline_categories(items, parent_prefix="cat", page=page)
+        page = await fetch_categories_page(pool, cursor=cursor)
+        kb = get_inline_categories(page)
         await call.message.edit_text("📁 Выберите категорию:", reply_markup=kb)
 
-    elif prefix_part.startswith("subcat_"):
+    elif callback_data.level == CatalogLevel.SUBCATEGORIES:
         # Пагинация по подкатегориям
-        parent_id = int(prefix_part.split("_")[1])
-        items = await fetch_subcategories(pool, parent_id)
-        kb = get_inline_categories(items, parent_prefix="subcat", page=page, parent_id_for_cb=parent_id)
+        page = await fetch_categories_page(pool, callback_data.parent_id, cursor=cursor)
+        kb = get_inline_categories(page, parent_id=callback_data.parent_id)
         await call.message.edit_text("📂 Выберите подкатегорию:", reply_markup=kb)
-    
+
+    else:
+        # Пагинация по товарам категории
+        page = await fetch_products_page(pool, callback_data.parent_id, cursor=cursor)
+        kb = get_inline_products(page, callback_data.parent_id)
+        await call.message.edit_text("🏷️ Товары:", reply_markup=kb)
+
     await call.answer()
 
-@dp.callback_query(F.data.startswith("cat_"))
-async def category_callback(call: types.CallbackQuery, pool):
-    cat_id = int(call.data.split("_")[1])
-    subcats = await fetch_subcategories(pool, cat_id)
-    kb = get_inline_categories(subcats, parent_prefix="subcat", parent_id_for_cb=cat_id)
+@callback_router(CategoryCallback)
+async def category_callback(call: types.CallbackQuery, callback_data: CategoryCallback, pool):
+    cat_id = callback_data.id
+    subcats = await fetch_categories_page(pool, cat_id)
+    kb = get_inline_categories(subcats, parent_id=cat_id)
     if kb:
         await call.message.edit_text("📂 Выберите подкатегорию:", reply_markup=kb)
         return
-    products = await fetch_products(pool, cat_id)
-    kb = get_inline_products(products)
+    products = await fetch_products_page(pool, cat_id)
+    kb = get_inline_products(products, cat_id)
     if not kb:
         await call.message.edit_text("В этой категории пока нет товаров.")
         return
     await call.message.edit_text("🏷️ Товары:", reply_markup=kb)
 
-@dp.callback_query(F.data.startswith("subcat_"))
-async def subcategory_callback(call: types.CallbackQuery, pool):
-    cat_id = int(call.data.split("_")[1])
-    products = await fetch_products(pool, cat_id)
-    kb = get_inline_products(products)
+@callback_router(SubcategoryCallback)
+async def subcategory_callback(call: types.CallbackQuery, callback_data: SubcategoryCallback, pool):
+    cat_id = callback_data.id
+    products = await fetch_products_page(pool, cat_id)
+    kb = get_inline_products(products, cat_id)
     if not kb:
         await call.message.edit_text("В этой подкатегории пока нет товаров.")
         return
     await call.message.edit_text("🏷️ Товары:", reply_markup=kb)
 
-@dp.callback_query(F.data.startswith("product_"))
-async def product_callback(call: types.CallbackQuery, pool):
-    prod_id = int(call.data.split("_")[1])
+@callback_router(ProductCallback)
+async def product_callback(call: types.CallbackQuery, callback_data: ProductCallback, pool):
+    prod_id = callback_data.id
     prod = await fetch_product(pool, prod_id)
     if not prod:
         await call.answer("Товар не найден.", show_alert=True)
@@ -155,29 +213,39 @@ async def product_callback(call: types.CallbackQuery, pool):
     text = f"<b>{prod['name']}</b>\nЦена: {prod['price']}₽\n\n{prod['description']}"
     kb = get_add_to_cart_keyboard(prod_id)
 
+    # Фото, уже загруженное в Telegram, отправляем по file_id без повторной выгрузки файла
+    if prod['image_file_id']:
+        try:
+            await call.message.answer_photo(prod['image_file_id'], caption=text, reply_markup=kb, parse_mode=ParseMode.HTML)
+            await call.answer()
+            return
+        except TelegramBadRequest as e:
+            logging.warning(f"Telegram rejected file_id for product {prod_id}, uploading file again: {e}")
+
     image_path = os.path.join('/app/media', prod['image']) if prod.get('image') else None
 
-    if image_path and os.path.exists(image_path):
+    if image_path and await asyncio.to_thread(os.path.exists, image_path):
         photo_to_send = FSInputFile(image_path)
-        await call.message.answer_photo(photo_to_send, caption=text, reply_markup=kb, parse_mode=ParseMode.HTML)
+        sent = await call.message.answer_photo(photo_to_send, caption=text, reply_markup=kb, parse_mode=ParseMode.HTML)
+        await save_product_image_file_id(pool, prod_id, prod['image'], sent.photo[-1].file_id)
     else:
         if image_path:
             logging.warning(f"Image file not found at path: {image_path}")
         await call.message.answer(f"🖼️ [фото не доступно]\n{text}", reply_markup=kb if kb else None, parse_mode=ParseMode.HTML)
     await call.answer()
 
-@dp.callback_query(F.data.startswith("addcart_"))
-async def addcart_callback(call: types.CallbackQuery):
-    prod_id = int(call.data.split("_")[1])
+@callback_router(AddToCartCallback)
+async def addcart_callback(call: types.CallbackQuery, callback_data: AddToCartCallback):
+    prod_id = callback_data.product_id
     # Заменяем клавиатуру в текущем сообщении, не создавая новое
     await call.message.edit_reply_markup(reply_markup=get_quantity_keyboard(prod_id))
     await call.answer()
 
-@dp.callback_query(F.data.startswith("qty_"))
-async def quantity_callback(call: types.CallbackQuery):
-    _, prod_id, qty = call.data.split("_")
+@callback_router(QuantityCallback)
+async def quantity_callback(call: types.CallbackQuery, callback_data: QuantityCallback):
+    qty = callback_data.qty
     text = f"Добавить {qty} шт. в корзину?"
-    kb = get_confirm_keyboard(int(prod_id), int(qty))
+    kb = get_confirm_keyboard(callback_data.product_id, qty)
 
     # Проверяем, есть ли у сообщения фото. Если да, редактируем подпись (caption).
     if call.message.photo:
@@ -187,15 +255,12 @@ async def quantity_callback(call: types.CallbackQuery):
         await call.message.edit_text(text, reply_markup=kb)
     await call.answer()
 
-@dp.callback_query(F.data.startswith("confirm_"))
-async def confirm_callback(call: types.CallbackQuery, pool):
-    _, prod_id, qty = call.data.split("_")
-    prod_id = int(prod_id)
-    qty = int(qty)
-    await add_to_cart(pool, call.from_user.id, prod_id, qty)
+@callback_router(ConfirmCallback)
+async def confirm_callback(call: types.CallbackQuery, callback_data: ConfirmCallback, pool):
+    items = await add_to_cart(pool, call.from_user.id, callback_data.product_id, callback_data.qty)
     await call.answer("Товар добавлен в корзину")
     # Обновляем сообщение, чтобы показать корзину
-    await update_cart_message(call, pool)
+    await update_cart_message(call, pool, items)
 
 async def format_cart_text(items: list) -> str:
     """Форматирует текст для сообщения с корзиной."""
@@ -226,9 +291,13 @@ async def cart_handler(message: types.Message, pool):
     text = await format_cart_text(items)
     await message.answer(text, reply_markup=get_cart_keyboard(items))
 
-async def update_cart_message(call: types.CallbackQuery, pool):
-    """Обновляет сообщение с корзиной, игнорируя ошибку 'message is not modified'."""
-    items = await fetch_cart(pool, call.from_user.id)
+async def update_cart_message(call: types.CallbackQuery, pool, items=None):
+    """
+    Обновляет сообщение с корзиной, игнорируя ошибку 'message is not modified'.
+    items — корзина, уже полученная из функции изменения корзины; иначе она запрашивается заново.
+    """
+    if items is None:
+        items = await fetch_cart(pool, call.from_user.id)
     text = await format_cart_text(items)
     kb = get_cart_keyboard(items)
     try:
@@ -244,29 +313,27 @@ async def update_cart_message(call: types.CallbackQuery, pool):
             logging.error(f"Error updating cart message: {e}")
             await call.answer("Произошла ошибка.", show_alert=True)
 
-@dp.callback_query(F.data == "cart_noop")
+@callback_router(CartNoopCallback)
 async def cart_noop_callback(call: types.CallbackQuery):
     """Пустой обработчик для кнопок, которые не должны ничего делать (например, отображение кол-ва)."""
     await call.answer()
 
-@dp.callback_query(F.data.startswith(("cart_incr_", "cart_decr_")))
-async def cart_quantity_callback(call: types.CallbackQuery, pool):
-    _, action, cartitem_id_str = call.data.split("_")
-    cartitem_id = int(cartitem_id_str)
-    change = 1 if action == "incr" else -1
-    await update_cart_item_quantity(pool, cartitem_id, call.from_user.id, change)
-    await update_cart_message(call, pool)
+@callback_router(CartItemCallback)
+async def cart_item_callback(call: types.CallbackQuery, callback_data: CartItemCallback, pool):
+    """Кнопки ➖/➕/❌ у позиции корзины."""
+    cartitem_id = callback_data.item_id
+    if callback_data.action == CartAction.DELETE:
+        items = await remove_from_cart(pool, cartitem_id, call.from_user.id)
+        await call.answer("Товар удалён из корзины.")
+        await update_cart_message(call, pool, items)
+        return
+    change = 1 if callback_data.action == CartAction.INCR else -1
+    items = await update_cart_item_quantity(pool, cartitem_id, call.from_user.id, change)
+    await update_cart_message(call, pool, items)
     await call.answer()  # Убедитесь, что ответ отправлен
 
-@dp.callback_query(F.data.startswith("delcart_"))
-async def delcart_callback(call: types.CallbackQuery, pool):
-    cartitem_id = int(call.data.split("_")[1])
-    await remove_from_cart(pool, cartitem_id, call.from_user.id)
-    await call.answer("Товар удалён из корзины.")
-    await update_cart_message(call, pool)
-
 
-@dp.callback_query(F.data == "order")
+@callback_router(OrderCallback)
 async def order_callback(call: types.CallbackQuery, state: FSMContext):
     await call.message.answer("Введите адрес или данные для доставки:")
     await state.set_state(OrderForm.delivery)
@@ -282,9 +349,9 @@ async def process_delivery(message: types.Message, state: FSMContext, pool):
             await state.clear()
             return
 
-        # Синхронная операция экспорта в Excel
+        # Дозапись заказа в журнал выгрузки; XLSX собирается фоновой задачей
         await asyncio.to_thread(
-            append_order_to_excel,
+            append_order_to_journal,
             order['id'],
             message.from_user.id,
             delivery_info,
@@ -294,13 +361,13 @@ async def process_delivery(message: types.Message, state: FSMContext, pool):
         )
 
         # --- Заглушка для оплаты ---
-        total_cost = sum(Decimal(item['product_price']) * item['quantity'] for item in order_items)
+        total_cost = order['total_cost']
         payment_url = f"https://example.com/pay?order_id={order['id']}"  # ЗАГЛУШКА
 
         await message.answer(
             f"✅ Заказ #{order['id']} успешно создан.\n\n"
             "Для завершения, пожалуйста, оплатите его.",
-            reply_markup=get_payment_keyboard(order['id'], total_cost, payment_url)
+            reply_markup=get_payment_keyboard(order['id'], total_cost, payment_url, order['created_at'])
         )
         # --- Конец заглушки ---
     except Exception as e:
@@ -309,13 +376,16 @@ async def process_delivery(message: types.Message, state: FSMContext, pool):
     finally:
         await state.clear()
 
-@dp.callback_query(F.data.startswith("paid_"))
-async def paid_callback(call: types.CallbackQuery, pool):
+@callback_router(PaidCallback)
+async def paid_callback(call: types.CallbackQuery, callback_data: PaidCallback, pool):
     """Обработчик-заглушка для подтверждения оплаты."""
-    order_id = int(call.data.split("_")[1])
+    order_id = callback_data.order_id
+    created_at = None
+    if callback_data.created is not None:
+        created_at = datetime.fromtimestamp(callback_data.created, timezone.utc)
 
     # Обновляем статус заказа в БД
-    updated_order_id = await update_order_status(pool, order_id, call.from_user.id, 'paid')
+    updated_order_id = await update_order_status(pool, order_id, call.from_user.id, 'paid', created_at)
 
     if updated_order_id:
         # Редактируем исходное сообщение, убирая кнопки
@@ -352,10 +422,9 @@ async def faq_search(message: types.Message, state: FSMContext, pool):
     await message.answer("Возможно, вы имели в виду:", reply_markup=kb)
     await state.clear()
 
-@dp.callback_query(F.data.regexp(r"^faq_\d+$"))
-async def faq_answer_callback(call: types.CallbackQuery, pool):
-    faq_id = int(call.data.split("_")[1])
-    answer = await get_faq_answer(pool, faq_id)
+@callback_router(FaqCallback)
+async def faq_answer_callback(call: types.CallbackQuery, callback_data: FaqCallback, pool):
+    answer = await get_faq_answer(pool, callback_data.id)
     kb = get_back_to_faq_keyboard()
     if answer:
         await call.message.edit_text(answer, reply_markup=kb)
@@ -363,7 +432,7 @@ async def faq_answer_callback(call: types.CallbackQuery, pool):
         await call.message.edit_text("Ответ не найден.", reply_markup=kb)
     await call.answer()
 
-@dp.callback_query(F.data == "faq_all")
+@callback_router(FaqAllCallback)
 async def faq_all_callback(call: types.CallbackQuery, pool):
     faqs = await get_all_faq(pool)
     kb = get_faq_keyboard(faqs, show_all_button=False)
@@ -374,7 +443,7 @@ async def faq_all_callback(call: types.CallbackQuery, pool):
     await call.message.edit_text("Все статьи:", reply_markup=kb)
     await call.answer()
 
-@dp.callback_query(F.data == "faq_back_to_list")
+@callback_router(FaqBackCallback)
 async def faq_back_to_list_callback(call: types.CallbackQuery, pool):
     """Handles the 'Back to questions' button press."""
     faqs = await get_all_faq(pool)
@@ -385,7 +454,7 @@ async def faq_back_to_list_callback(call: types.CallbackQuery, pool):
         await call.message.edit_text("Все статьи:", reply_markup=kb)
     await call.answer()
 
-@dp.callback_query(F.data == "back_to_main_menu")
+@callback_router(MainMenuCallback)
 async def back_to_main_menu_callback(call: types.CallbackQuery):
     """Handles the 'To main menu' button press."""
     await call.message.delete()
@@ -395,54 +464,28 @@ async def back_to_main_menu_callback(call: types.CallbackQuery):
     )
     await call.answer()
 
-async def broadcast_scheduler(pool):
-    """Периодически проверяет и отправляет рассылки."""
-    while True:
-        try:
-            broadcast = await get_pending_broadcast(pool)
-            if broadcast:
-                broadcast_id = broadcast['id']
-                logging.info(f"Начинаю рассылку #{broadcast_id}...")
- 
-                # Определяем, кому отправлять рассылку
-                explicit_recipients = await get_broadcast_recipients_from_db(pool, broadcast_id)
-                
-                if explicit_recipients:
-                    user_ids = explicit_recipients
-                    should_add_recipients_to_db = False # Получатели уже выбраны в админке
-                else:
-                    user_ids = await get_all_active_users_ids(pool)
-                    should_add_recipients_to_db = True # Отправляем всем, нужно записать получателей
- 
-                if not user_ids:
-                    logging.warning(f"Рассылка #{broadcast_id}: нет пользователей для отправки. Завершаю.")
-                    await finalize_broadcast(pool, broadcast_id)
-                    continue
- 
-                sent_user_ids = []
-                for user_id in user_ids:
-                    try:
-                        await bot.send_message(chat_id=user_id, text=broadcast['message'])
-                        sent_user_ids.append(user_id)
-                        await asyncio.sleep(0.1)  # Задержка для избежания лимитов Telegram
-                    except (TelegramForbiddenError, TelegramBadRequest):
-                        logging.warning(f"Не удалось отправить сообщение пользователю {user_id}. Он заблокировал бота.")
-                
-                if should_add_recipients_to_db and sent_user_ids:
-                    await add_recipients_to_broadcast(pool, broadcast_id, sent_user_ids) # Записываем получателей только если отправляли всем
-                
-                await finalize_broadcast(pool, broadcast_id)
-                logging.info(f"Рассылка #{broadcast_id} завершена. Отправлено: {len(sent_user_ids)}.")
-        except Exception as e:
-            logging.error(f"Ошибка в планировщике рассылок: {e}")
-        
-        await asyncio.sleep(60) # Проверка раз в минуту
+@callback_router.fallback
+async def stale_callback(call: types.CallbackQuery):
+    """Кнопка из старого сообщения (прежний формат callback_data) или повреждённые данные."""
+    await call.answer("Эта кнопка устарела. Откройте раздел заново через меню.", show_alert=True)
+
+def create_app():
+    """(dp, bot) этого модуля. Процессы супервизора (spawn) импортируют модуль заново и получают свои."""
+    return dp, bot
 
 async def main():
-    # on_startup будет вызван внутри start_polling и создаст пул соединений.
+    # on_startup будет вызван внутри start_polling / run_webhook и создаст пул соединений.
     # Aiogram DI (Dependency Injection) автоматически передаст этот пул
     # в хендлеры, у которых есть аргумент 'pool'.
-    await dp.start_polling(bot)
+    start_metrics_server()
+    if BOT_MODE == "webhook":
+        await run_webhook(dp, bot)
+    else:
+        await dp.start_polling(bot)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if BOT_WORKERS > 1:
+        # Процессы запускаются до создания event loop, поэтому супервизор не внутри main()
+        run_supervisor(create_app, BOT_MODE)
+    else:
+        asyncio.run(main())
@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from aiogram.exceptions import (TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError,
+                                TelegramRetryAfter, TelegramServerError)
+from dotenv import load_dotenv
+from db import get_pending_broadcast, iter_broadcast_recipients, checkpoint_broadcast, finalize_broadcast
+from metrics import BROADCAST_MESSAGES, BROADCAST_SEND_RATE
+
+load_dotenv()
+
+# Общий лимит бота на рассылку (Telegram допускает около 30 сообщений в секунду)
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', '16'))
+# Минимальный интервал между сообщениями в один чат, секунд
+BROADCAST_CHAT_INTERVAL = float(os.getenv('BROADCAST_CHAT_INTERVAL', '1'))
+# Сколько раз повторять отправку при сетевых ошибках и ошибках сервера Telegram
+BROADCAST_MAX_RETRIES = int(os.getenv('BROADCAST_MAX_RETRIES', '3'))
+BROADCAST_POLL_INTERVAL = int(os.getenv('BROADCAST_POLL_INTERVAL', '60'))
+# Размер порции получателей, после которой сохраняется прогресс
+BROADCAST_CHUNK_SIZE = int(os.getenv('BROADCAST_CHUNK_SIZE', '500'))
+# Через сколько секунд без отметок прогресса рассылку в статусе 'sending' подхватит другой воркер
+BROADCAST_STALE_AFTER = int(os.getenv('BROADCAST_STALE_AFTER', '300'))
+
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 30
+
+
+class TokenBucket:
+    """Ограничитель скорости: rate токенов в секунду, запас не больше capacity."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Останавливает выдачу токенов всем воркерам (flood control от Telegram действует на весь бот)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+        # Запас начинает копиться только после паузы, иначе сразу после нее уйдет полная пачка
+        self._updated = self._paused_until
+
+
+class BroadcastStats:
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+
+    def record(self, result):
+        """Учитывает исход попытки отправки: 'sent', 'failed' или 'retries'."""
+        setattr(self, result, getattr(self, result) + 1)
+        BROADCAST_MESSAGES.labels(result).inc()
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    @property
+    def rate(self):
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return (f"отправлено {self.sent}, не доставлено {self.failed}, повторов {self.retries}, "
+                f"{self.elapsed:.1f} с, {self.rate:.1f} сообщ./с")
+
+
+class BroadcastEngine:
+    """
+    Отправляет сообщение списку пользователей пулом воркеров
+    под общим token bucket и с паузой между сообщениями в один чат.
+    """
+
+    def __init__(self, bot, rate=BROADCAST_RATE, workers=BROADCAST_WORKERS,
+                 chat_interval=BROADCAST_CHAT_INTERVAL, max_retries=BROADCAST_MAX_RETRIES):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.workers = workers
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self._chat_sent_at = {}
+
+    async def send(self, user_ids, text, stats=None):
+        """
+        Возвращает (ID пользователей, которым сообщение доставлено, BroadcastStats).
+        stats можно передать, чтобы копить статистику по нескольким порциям одной рассылки.
+        """
+        stats = stats or BroadcastStats()
+        delivered = []
+        queue = asyncio.Queue(maxsize=self.workers * 2)
+
+        async def worker():
+            while True:
+                user_id = await queue.get()
+                try:
+                    if await self._deliver(user_id, text, stats):
+                        delivered.append(user_id)
+                except Exception as e:
+                    stats.record('failed')
+                    logging.error(f"Ошибка отправки рассылки пользователю {user_id}: {e}")
+                finally:
+                    queue.task_done()
+
+        tasks = [asyncio.create_task(worker()) for _ in range(self.workers)]
+        try:
+            for user_id in user_ids:
+                await queue.put(user_id)
+            await queue.join()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._chat_sent_at.clear()
+        return delivered, stats
+
+    async def _wait_for_chat(self, chat_id):
+        last = self._chat_sent_at.get(chat_id)
+        if last is not None:
+            delay = last + self.chat_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        self._chat_sent_at[chat_id] = time.monotonic()
+
+    async def _deliver(self, user_id, text, stats):
+        attempt = 0
+        while True:
+            await self._wait_for_chat(user_id)
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=user_id, text=text)
+                stats.record('sent')
+                return True
+            except TelegramRetryAfter as e:
+                # Telegram явно просит подождать: ждем все, сообщение не теряем
+                logging.warning(f"Flood control при рассылке, пауза {e.retry_after} с")
+                self.bucket.pause(e.retry_after)
+                stats.record('retries')
+            except (TelegramForbiddenError, TelegramBadRequest):
+                logging.warning(f"Не удалось отправить сообщение пользователю {user_id}. Он заблокировал бота.")
+                stats.record('failed')
+                return False
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempt >= self.max_retries:
+                    logging.warning(f"Не удалось отправить сообщение пользователю {user_id} после {attempt + 1} попыток: {e}")
+                    stats.record('failed')
+                    return False
+                delay = min(RETRY_BASE_DELAY * 2 ** attempt, RETRY_MAX_DELAY)
+                attempt += 1
+                stats.record('retries')
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+
+
+async def broadcast_scheduler(bot, pool):
+    """
+    Периодически проверяет и отправляет рассылки. Получатели читаются порциями,
+    после каждой порции прогресс сохраняется в БД; упавшую рассылку другой воркер
+    продолжит с последней сохраненной порции (ее сообщения могут уйти повторно).
+    """
+    engine = BroadcastEngine(bot)
+    while True:
+        try:
+            broadcast = await get_pending_broadcast(pool, BROADCAST_STALE_AFTER)
+            if broadcast:
+                broadcast_id = broadcast['id']
+                send_to_all = broadcast['send_to_all']
+                if broadcast['progress_user_id']:
+                    logging.info(f"Продолжаю рассылку #{broadcast_id} после пользователя {broadcast['progress_user_id']} "
+                                 f"(уже доставлено: {broadcast['sent_count']})...")
+                else:
+                    logging.info(f"Начинаю рассылку #{broadcast_id}...")
+
+                stats = BroadcastStats()
+                # Для рассылки всем записываем получателей; выбранные в админке уже записаны
+                async for user_ids in iter_broadcast_recipients(
+                    pool, broadcast_id, send_to_all, broadcast['progress_user_id'], BROADCAST_CHUNK_SIZE
+                ):
+                    delivered_ids, _ = await engine.send(user_ids, broadcast['message'], stats)
+                    await checkpoint_broadcast(pool, broadcast_id, user_ids[-1], delivered_ids, send_to_all)
+                    BROADCAST_SEND_RATE.set(stats.rate)
+
+                if not stats.sent and not stats.failed and not broadcast['progress_user_id']:
+                    logging.warning(f"Рассылка #{broadcast_id}: нет пользователей для отправки. Завершаю.")
+
+                await finalize_broadcast(pool, broadcast_id)
+                BROADCAST_SEND_RATE.set(0)
+                logging.info(f"Рассылка #{broadcast_id} завершена: {stats}.")
+                continue  # Сразу проверяем, нет ли следующей рассылки
+        except Exception as e:
+            logging.error(f"Ошибка в планировщике рассылок: {e}")
+
+        await asyncio.sleep(BROADCAST_POLL_INTERVAL) # Проверка раз в минуту
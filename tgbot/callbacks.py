@@ -0,0 +1,161 @@
+from enum import Enum
+from typing import Optional
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.event.handler import CallableObject
+from aiogram.filters.callback_data import CallbackData
+
+# Версия формата callback_data, входит в префикс каждой кнопки. При несовместимом изменении полей
+# ее увеличивают: кнопки в старых сообщениях перестают разбираться и уходят в обработчик устаревших.
+CALLBACK_VERSION = 1
+SEPARATOR = ':'
+
+
+def _prefix(name):
+    return f"{CALLBACK_VERSION}{name}"
+
+
+class CatalogLevel(str, Enum):
+    CATEGORIES = 'c'
+    SUBCATEGORIES = 's'
+    PRODUCTS = 'p'
+
+
+class CartAction(str, Enum):
+    INCR = '+'
+    DECR = '-'
+    DELETE = 'x'
+
+
+# --- Каталог ---
+class CategoryCallback(CallbackData, prefix=_prefix('c')):
+    id: int
+
+
+class SubcategoryCallback(CallbackData, prefix=_prefix('s')):
+    id: int
+
+
+class CatalogPageCallback(CallbackData, prefix=_prefix('pg')):
+    level: CatalogLevel
+    parent_id: int  # 0 — корневые категории
+    cursor: str
+
+
+class ProductCallback(CallbackData, prefix=_prefix('p')):
+    id: int
+
+
+# --- Корзина и заказ ---
+class AddToCartCallback(CallbackData, prefix=_prefix('a')):
+    product_id: int
+
+
+class QuantityCallback(CallbackData, prefix=_prefix('q')):
+    product_id: int
+    qty: int
+
+
+class ConfirmCallback(CallbackData, prefix=_prefix('cf')):
+    product_id: int
+    qty: int
+
+
+class CartItemCallback(CallbackData, prefix=_prefix('ci')):
+    action: CartAction
+    item_id: int
+
+
+class CartNoopCallback(CallbackData, prefix=_prefix('cn')):
+    pass
+
+
+class OrderCallback(CallbackData, prefix=_prefix('o')):
+    pass
+
+
+class PaidCallback(CallbackData, prefix=_prefix('pd')):
+    order_id: int
+    # created_at заказа, Unix-время: по нему выбирается секция shop_order.
+    # В кнопках, отправленных до секционирования (миграция 0021), его нет
+    created: Optional[int] = None
+
+    @classmethod
+    def unpack(cls, value):
+        # Старый формат '<префикс>:<order_id>' — совместимое изменение, версия не меняется
+        if value.count(SEPARATOR) == 1:
+            value += SEPARATOR
+        return super().unpack(value)
+
+
+# --- FAQ и меню ---
+class FaqCallback(CallbackData, prefix=_prefix('f')):
+    id: int
+
+
+class FaqAllCallback(CallbackData, prefix=_prefix('fa')):
+    pass
+
+
+class FaqBackCallback(CallbackData, prefix=_prefix('fb')):
+    pass
+
+
+class MainMenuCallback(CallbackData, prefix=_prefix('m')):
+    pass
+
+
+class CallbackRouter:
+    """
+    Таблица префикс -> (класс CallbackData, хендлер) для всех inline-кнопок бота.
+    Outer-middleware один раз разбирает callback_data, находит хендлер по префиксу в словаре
+    и кладет в data 'callback_data' (типизированный объект) и 'callback_handler';
+    в aiogram зарегистрирован единственный хендлер, который его вызывает.
+    Нажатия, которые не разбираются (старый формат, другая версия), получает fallback.
+    """
+
+    def __init__(self):
+        self._routes = {}
+        self._fallback = None
+
+    def __call__(self, callback_cls):
+        """Декоратор: @callback_router(ProductCallback) регистрирует хендлер кнопок этого типа."""
+        def register(handler):
+            if callback_cls.__prefix__ in self._routes:
+                raise ValueError(f"Префикс {callback_cls.__prefix__!r} уже зарегистрирован")
+            self._routes[callback_cls.__prefix__] = (callback_cls, CallableObject(handler))
+            return handler
+        return register
+
+    def fallback(self, handler):
+        self._fallback = CallableObject(handler)
+        return handler
+
+    def resolve(self, data):
+        """Возвращает (callback_data, хендлер) или (None, fallback), если кнопка не разбирается."""
+        route = self._routes.get((data or '').split(SEPARATOR, 1)[0])
+        if route is not None:
+            callback_cls, handler = route
+            try:
+                return callback_cls.unpack(data), handler
+            except (TypeError, ValueError):
+                pass
+        return None, self._fallback
+
+    def setup(self, observer):
+        observer.outer_middleware(_CallbackRoutingMiddleware(self))
+        observer.register(_dispatch_callback)
+
+
+class _CallbackRoutingMiddleware(BaseMiddleware):
+    def __init__(self, router):
+        self.router = router
+
+    async def __call__(self, handler, event, data):
+        data['callback_data'], data['callback_handler'] = self.router.resolve(event.data)
+        return await handler(event, data)
+
+
+async def _dispatch_callback(call, **data):
+    handler = data['callback_handler']
+    if handler is not None:
+        return await handler.call(call, **data)
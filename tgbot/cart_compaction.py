@@ -0,0 +1,41 @@
+import asyncio
+import logging
+import os
+from dotenv import load_dotenv
+from db import compact_cart
+
+load_dotenv()
+
+# Как часто переносить неактивные позиции корзины в архив, секунд; 0 — не запускать в боте
+CART_COMPACT_INTERVAL = int(os.getenv('CART_COMPACT_INTERVAL', '3600'))
+# Позиций в одной транзакции и пауза между порциями, чтобы не мешать оформлению заказов
+CART_COMPACT_BATCH_SIZE = int(os.getenv('CART_COMPACT_BATCH_SIZE', '1000'))
+CART_COMPACT_PAUSE = float(os.getenv('CART_COMPACT_PAUSE', '0.1'))
+# Через сколько дней без изменений корзина считается брошенной; 0 — брошенные корзины не трогать
+CART_ABANDONED_DAYS = int(os.getenv('CART_ABANDONED_DAYS', '30'))
+
+
+async def compact_cart_once(pool):
+    """Переносит в архив все, что есть на момент запуска, порциями по CART_COMPACT_BATCH_SIZE."""
+    abandoned_after = CART_ABANDONED_DAYS * 86400 if CART_ABANDONED_DAYS else None
+    total = 0
+    while True:
+        moved = await compact_cart(pool, CART_COMPACT_BATCH_SIZE, abandoned_after)
+        total += moved
+        if moved < CART_COMPACT_BATCH_SIZE:
+            return total
+        await asyncio.sleep(CART_COMPACT_PAUSE)
+
+
+async def cart_compactor(pool):
+    """Периодически уплотняет shop_cartitem (см. shop_compact_cartitems в миграции 0020)."""
+    if not CART_COMPACT_INTERVAL:
+        return
+    while True:
+        try:
+            moved = await compact_cart_once(pool)
+            if moved:
+                logging.info(f"Уплотнение корзин: в архив перенесено {moved} позиций")
+        except Exception as e:
+            logging.error(f"Ошибка уплотнения корзин: {e}")
+        await asyncio.sleep(CART_COMPACT_INTERVAL)
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+import asyncpg
+
+load_dotenv()
+
+# Канал, в который триггеры shop_category/shop_product/shop_faq шлют NOTIFY (миграции 0011, 0015)
+CATALOG_CHANNEL = 'catalog_changed'
+
+CATALOG_CACHE_TTL = float(os.getenv('CATALOG_CACHE_TTL', '300'))
+CATALOG_CACHE_MAX_ENTRIES = int(os.getenv('CATALOG_CACHE_MAX_ENTRIES', '10000'))
+LISTEN_RECONNECT_DELAY = 5
+
+_MISSING = object()
+
+
+class CatalogCache:
+    """
+    Read-through кэш каталога в памяти процесса бота.
+
+    Значения живут не дольше ttl секунд и сбрасываются целиком по NOTIFY
+    из Postgres, когда в админке меняются категории, товары или FAQ.
+    """
+
+    def __init__(self, ttl=CATALOG_CACHE_TTL, max_entries=CATALOG_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # Растет при каждой инвалидации, чтобы загрузка, начатая до сброса, не попала в кэш
+        self.version = 0
+        self._entries = OrderedDict()
+        self._loading = {}
+
+    async def get_or_load(self, key, loader):
+        """Возвращает значение по ключу, при промахе вызывает loader() один раз на все ожидающие запросы."""
+        value = self._get(key)
+        if value is not _MISSING:
+            return value
+
+        task = self._loading.get(key)
+        if task is None:
+            # Загрузка идет отдельной задачей: отмена запроса, который ее начал (например,
+            # по таймауту хендлера), не обрывает ее для остальных ожидающих
+            task = asyncio.create_task(self._load(key, loader))
+            self._loading[key] = task
+        return await asyncio.shield(task)
+
+    async def _load(self, key, loader):
+        version = self.version
+        try:
+            value = await loader()
+        finally:
+            self._loading.pop(key, None)
+        if version == self.version:
+            self._set(key, value)
+        return value
+
+    def invalidate(self, reason=None):
+        self._entries.clear()
+        self.version += 1
+        logging.info(f"Кэш каталога сброшен ({reason or 'вручную'}), версия {self.version}")
+
+    def forget(self, key):
+        self._entries.pop(key, None)
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return _MISSING
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return _MISSING
+        self._entries.move_to_end(key)
+        return value
+
+    def _set(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self.invalidate(payload)
+
+    async def listen(self, **connect_kwargs):
+        """
+        Держит отдельное соединение с LISTEN на канал каталога.
+        При обрыве переподключается и сбрасывает кэш, т.к. уведомления могли быть пропущены.
+        """
+        while True:
+            try:
+                connection = await asyncpg.connect(**connect_kwargs)
+            except (OSError, asyncpg.PostgresError) as e:
+                logging.warning(f"Не удалось подключиться для LISTEN {CATALOG_CHANNEL}: {e}")
+                await asyncio.sleep(LISTEN_RECONNECT_DELAY)
+                continue
+
+            closed = asyncio.Event()
+            connection.add_termination_listener(lambda _: closed.set())
+            try:
+                await connection.add_listener(CATALOG_CHANNEL, self._on_notify)
+                self.invalidate('LISTEN connected')
+                await closed.wait()
+                logging.warning(f"Соединение LISTEN {CATALOG_CHANNEL} потеряно, переподключаюсь")
+            except (OSError, asyncpg.PostgresError) as e:
+                logging.warning(f"Ошибка LISTEN {CATALOG_CHANNEL}: {e}")
+            finally:
+                if not connection.is_closed():
+                    await connection.close()
+            await asyncio.sleep(LISTEN_RECONNECT_DELAY)
+
+
+catalog_cache = CatalogCache()
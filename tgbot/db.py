@@ -1,7 +1,12 @@
 import asyncpg
 import os
 import logging
+import time
+from collections import namedtuple
 from dotenv import load_dotenv
+from catalog_cache import catalog_cache
+from faq_index import FAQIndex
+from metrics import DB_ERRORS, DB_POOL_WAIT, DB_QUERY_LATENCY
 
 load_dotenv()
 
@@ -13,12 +18,81 @@ DB_CONFIG = {
     'port': os.getenv('POSTGRES_PORT', '5432'),
 }
 
+# Размер пула на процесс; в режиме супервизора соединений будет BOT_WORKERS * DB_POOL_MAX_SIZE + пул фонового процесса
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '2'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+# Через сколько секунд простоя соединение сверх min_size закрывается
+DB_POOL_MAX_INACTIVE_LIFETIME = float(os.getenv('DB_POOL_MAX_INACTIVE_LIFETIME', '300'))
+# Таймаут запроса по умолчанию, секунд; для отдельного запроса — DB_TIMEOUT_<ИМЯ ЗАПРОСА>
+DB_COMMAND_TIMEOUT = float(os.getenv('DB_COMMAND_TIMEOUT', '10'))
+# Кэш подготовленных запросов на соединение; не меньше числа запросов в QUERIES
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '100'))
+# За PgBouncer в режиме transaction prepared statements между транзакциями не живут:
+# кэш asyncpg отключается, запросы QUERIES заранее не готовятся
+DB_PGBOUNCER = os.getenv('DB_PGBOUNCER', 'false').lower() in ('1', 'true', 'yes')
+
+CATALOG_PAGE_SIZE = int(os.getenv('CATALOG_PAGE_SIZE', '5'))
+PRODUCTS_PAGE_SIZE = int(os.getenv('PRODUCTS_PAGE_SIZE', '10'))
+
+# --- Реестр запросов ---
+# Все запросы бота объявляются один раз через _query() и готовятся (PREPARE)
+# на каждом соединении пула при его создании. Функции ниже обращаются к ним по имени.
+Query = namedtuple('Query', ['name', 'sql', 'timeout'])
+QUERIES = {}
+
+def _query(name, sql, timeout=None):
+    timeout = float(os.getenv(f'DB_TIMEOUT_{name.upper()}', timeout or DB_COMMAND_TIMEOUT))
+    QUERIES[name] = Query(name, sql, timeout)
+    return name
+
+async def _prepare_statements(connection):
+    # executemany() с пустым списком аргументов готовит запрос через кэш asyncpg и ничего не выполняет:
+    # fetch() с тем же текстом берет готовый statement без разбора, а после смены схемы asyncpg
+    # готовит его заново. connection.prepare() кэш не заполняет — его statement живет отдельно.
+    for query in QUERIES.values():
+        await connection.executemany(query.sql, [], timeout=query.timeout)
+
 async def get_pool():
-    return await asyncpg.create_pool(**DB_CONFIG)
+    return await asyncpg.create_pool(
+        **DB_CONFIG,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        max_inactive_connection_lifetime=DB_POOL_MAX_INACTIVE_LIFETIME,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        statement_cache_size=0 if DB_PGBOUNCER else max(DB_STATEMENT_CACHE_SIZE, len(QUERIES)),
+        init=None if DB_PGBOUNCER else _prepare_statements,
+    )
+
+async def _run(db, method, name, args):
+    """Выполняет запрос name из QUERIES; db — пул или уже взятое из него соединение."""
+    query = QUERIES[name]
+    started = time.perf_counter()
+    try:
+        if isinstance(db, asyncpg.Pool):
+            async with db.acquire() as connection:
+                DB_POOL_WAIT.observe(time.perf_counter() - started)
+                return await getattr(connection, method)(query.sql, *args, timeout=query.timeout)
+        return await getattr(db, method)(query.sql, *args, timeout=query.timeout)
+    except Exception as e:
+        DB_ERRORS.labels(name, type(e).__name__).inc()
+        raise
+    finally:
+        DB_QUERY_LATENCY.labels(name).observe(time.perf_counter() - started)
+
+async def _fetch(db, name, *args):
+    return await _run(db, 'fetch', name, args)
+
+async def _fetchrow(db, name, *args):
+    return await _run(db, 'fetchrow', name, args)
+
+async def _fetchval(db, name, *args):
+    return await _run(db, 'fetchval', name, args)
+
+async def _execute(db, name, *args):
+    await _run(db, 'execute', name, args)
 
 # --- Пользователи ---
-async def add_or_update_user(pool, user_id, username, first_name, last_name, is_subscribed):
-    query = """
+_query('add_or_update_user', """
         INSERT INTO shop_telegramuser (user_id, username, first_name, last_name, is_subscribed, is_active, created_at, updated_at)
         VALUES ($1, $2, $3, $4, $5, TRUE, NOW(), NOW())
         ON CONFLICT (user_id) DO UPDATE SET
@@ -28,264 +102,448 @@ async def add_or_update_user(pool, user_id, username, first_name, last_name, is_
             is_subscribed = EXCLUDED.is_subscribed,
             is_active = TRUE,
             updated_at = NOW();
-    """
-    await pool.execute(query, user_id, username, first_name, last_name, is_subscribed)
+""")
+
+async def add_or_update_user(pool, user_id, username, first_name, last_name, is_subscribed):
+    await _execute(pool, 'add_or_update_user', user_id, username, first_name, last_name, is_subscribed)
+
+_query('fetch_recent_subscribers', """
+        SELECT user_id, EXTRACT(EPOCH FROM NOW() - updated_at)::float8 AS age
+        FROM shop_telegramuser
+        WHERE is_active = TRUE AND is_subscribed = TRUE
+          AND updated_at > NOW() - $1 * INTERVAL '1 second'
+""")
+
+async def fetch_recent_subscribers(pool, max_age):
+    """Подписанные пользователи, чей статус обновлялся не раньше max_age секунд назад, и возраст записи."""
+    return await _fetch(pool, 'fetch_recent_subscribers', max_age)
 
 # --- Категории и товары ---
-async def fetch_categories(pool, parent_id=None):
+# Каталог читается через catalog_cache: повторные запросы не ходят в БД,
+# пока админка не изменит категории/товары (NOTIFY) или не истечет TTL.
+# Страница каталога: items — записи страницы, prev_cursor/next_cursor —
+# курсоры соседних страниц для callback_data (None, если страницы нет).
+CatalogPage = namedtuple('CatalogPage', ['items', 'prev_cursor', 'next_cursor'])
+
+def _keyset_queries(name, table, where, key, n_params):
+    """
+    Регистрирует keyset-запросы страницы по ключу сортировки key (последний столбец — id)
+    и возвращает их имена по направлению: None — первая страница, 'n' — вперед, 'p' — назад.
+    Курсор — id якорной записи: 'n<id>' — строки после нее, 'p<id>' — строки перед ней.
+    Параметры: n_params параметров условия where, затем id якоря, затем LIMIT.
+    """
+    columns = ", ".join(key)
+    descending = ", ".join(f"{column} DESC" for column in key)
+    anchor = f"(SELECT {columns} FROM {table} WHERE id = ${n_params + 1})"
+    base = f"SELECT id, name FROM {table} WHERE is_active = TRUE AND {where}"
+    return {
+        None: _query(f"{name}_first", f"{base} ORDER BY {columns} LIMIT ${n_params + 1}"),
+        'n': _query(f"{name}_next", f"{base} AND ({columns}) > {anchor} ORDER BY {columns} LIMIT ${n_params + 2}"),
+        'p': _query(f"{name}_prev", f"{base} AND ({columns}) < {anchor} ORDER BY {descending} LIMIT ${n_params + 2}"),
+    }
+
+ROOT_CATEGORIES_PAGE = _keyset_queries('root_categories_page', 'shop_category', 'parent_id IS NULL', ('sort_order', 'name', 'id'), 0)
+SUBCATEGORIES_PAGE = _keyset_queries('subcategories_page', 'shop_category', 'parent_id = $1', ('sort_order', 'name', 'id'), 1)
+PRODUCTS_PAGE = _keyset_queries('products_page', 'shop_product', 'category_id = $1', ('name', 'id'), 1)
+
+async def _fetch_page(pool, queries, params, cursor, limit):
+    # Берем limit + 1 строк: лишняя строка говорит о том, что есть следующая страница
+    if cursor:
+        direction, anchor_id = cursor[0], int(cursor[1:])
+        rows = await _fetch(pool, queries[direction], *params, anchor_id, limit + 1)
+        if not rows:
+            # Якорная запись удалена или скрыта — показываем первую страницу
+            return await _fetch_page(pool, queries, params, None, limit)
+    else:
+        direction = None
+        rows = await _fetch(pool, queries[None], *params, limit + 1)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == 'p':
+        rows.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = direction == 'n', has_more
+
+    return CatalogPage(
+        items=rows,
+        prev_cursor=f"p{rows[0]['id']}" if has_prev and rows else None,
+        next_cursor=f"n{rows[-1]['id']}" if has_next and rows else None,
+    )
+
+async def fetch_categories_page(pool, parent_id=None, cursor=None, limit=CATALOG_PAGE_SIZE):
+    """Страница категорий верхнего уровня (parent_id=None) или подкатегорий."""
     if parent_id is None:
-        query = """
-            SELECT id, name FROM shop_category
-            WHERE is_active = TRUE AND parent_id IS NULL
-            ORDER BY sort_order, name
-        """
-        return await pool.fetch(query)
+        queries, params = ROOT_CATEGORIES_PAGE, ()
     else:
-        query = """
-            SELECT id, name FROM shop_category
-            WHERE is_active = TRUE AND parent_id = $1
-            ORDER BY sort_order, name
-        """
-        return await pool.fetch(query, parent_id)
-
-async def fetch_products(pool, category_id):
-    query = """
-        SELECT id, name, description, image, price FROM shop_product
-        WHERE is_active = TRUE AND category_id = $1
-        ORDER BY name
-    """
-    return await pool.fetch(query, category_id)
+        queries, params = SUBCATEGORIES_PAGE, (parent_id,)
+    return await catalog_cache.get_or_load(
+        ('categories', parent_id, cursor, limit),
+        lambda: _fetch_page(pool, queries, params, cursor, limit)
+    )
 
-async def fetch_subcategories(pool, parent_id):
-    query = """
-        SELECT id, name FROM shop_category
-        WHERE is_active = TRUE AND parent_id = $1
-        ORDER BY sort_order, name
-    """
-    return await pool.fetch(query, parent_id)
+async def fetch_products_page(pool, category_id, cursor=None, limit=PRODUCTS_PAGE_SIZE):
+    """Страница активных товаров категории."""
+    return await catalog_cache.get_or_load(
+        ('products', category_id, cursor, limit),
+        lambda: _fetch_page(pool, PRODUCTS_PAGE, (category_id,), cursor, limit)
+    )
 
-async def fetch_product(pool, product_id):
-    query = """
-        SELECT id, name, description, image, price FROM shop_product
+_query('fetch_product', """
+        SELECT id, name, description, image, image_file_id, price FROM shop_product
         WHERE is_active = TRUE AND id = $1
+""")
+
+async def fetch_product(pool, product_id):
+    return await catalog_cache.get_or_load(('product', product_id), lambda: _fetchrow(pool, 'fetch_product', product_id))
+
+_query('save_product_image_file_id', """
+        UPDATE shop_product SET image_file_id = $3
+        WHERE id = $1 AND image = $2
+""")
+
+async def save_product_image_file_id(pool, product_id, image, file_id):
+    """
+    Запоминает file_id, выданный Telegram для изображения товара.
+    Условие по image не дает записать file_id старой картинки, если ее уже заменили в админке.
     """
-    return await pool.fetchrow(query, product_id)
+    await _execute(pool, 'save_product_image_file_id', product_id, image, file_id)
+    catalog_cache.forget(('product', product_id))
 
 # --- Корзина ---
-async def fetch_cart(pool, user_id):
-    query = """
+_query('fetch_cart', """
         SELECT ci.id, p.name, p.price, ci.quantity, ci.product_id
         FROM shop_cartitem ci
         JOIN shop_product p ON ci.product_id = p.id
         WHERE ci.user_id = $1 AND ci.is_active = TRUE
         ORDER BY ci.created_at
-    """
-    return await pool.fetch(query, user_id)
+""")
+
+async def fetch_cart(pool, user_id):
+    return await _fetch(pool, 'fetch_cart', user_id)
+
+# Хвост запросов, которые меняют корзину и сразу возвращают ее новое содержимое.
+# CTE changed содержит измененные строки в новом состоянии; основной SELECT видит
+# таблицу до изменения, поэтому остальные позиции берутся из нее, а измененные — из changed.
+_CART_AFTER_CHANGE = """
+    SELECT ci.id, p.name, p.price, ci.quantity, ci.product_id
+    FROM (
+        SELECT id, product_id, quantity, created_at FROM changed WHERE is_active
+        UNION ALL
+        SELECT c.id, c.product_id, c.quantity, c.created_at FROM shop_cartitem c
+        WHERE c.user_id = $1 AND c.is_active = TRUE
+          AND NOT EXISTS (SELECT 1 FROM changed WHERE changed.id = c.id)
+    ) ci
+    JOIN shop_product p ON ci.product_id = p.id
+    ORDER BY ci.created_at
+"""
+
+_query('add_to_cart', """
+        WITH revived AS (
+            UPDATE shop_cartitem
+            SET quantity = $3, is_active = TRUE, created_at = NOW(), updated_at = NOW()
+            WHERE is_active = FALSE AND id = (
+                SELECT id FROM shop_cartitem
+                WHERE user_id = $1 AND product_id = $2 AND is_active = FALSE
+                  AND NOT EXISTS (
+                      SELECT 1 FROM shop_cartitem
+                      WHERE user_id = $1 AND product_id = $2 AND is_active = TRUE
+                  )
+                LIMIT 1
+            )
+            RETURNING id, product_id, quantity, created_at, is_active
+        ), upserted AS (
+            INSERT INTO shop_cartitem (user_id, product_id, quantity, is_active, created_at, updated_at)
+            SELECT $1, $2, $3, TRUE, NOW(), NOW()
+            WHERE NOT EXISTS (SELECT 1 FROM revived)
+            ON CONFLICT (user_id, product_id) WHERE (is_active = TRUE)
+            DO UPDATE SET quantity = shop_cartitem.quantity + EXCLUDED.quantity, updated_at = NOW()
+            RETURNING id, product_id, quantity, created_at, is_active
+        ), changed AS (
+            SELECT * FROM revived
+            UNION ALL
+            SELECT * FROM upserted
+        )
+""" + _CART_AFTER_CHANGE)
 
 async def add_to_cart(pool, user_id, product_id, quantity):
-    # Сначала пытаемся найти и "оживить" неактивный товар в корзине.
-    # Это решает проблему дубликатов, когда товар добавляется повторно после удаления.
-    query_revive = """
-        UPDATE shop_cartitem
-        SET quantity = $3, is_active = TRUE, created_at = NOW()
-        WHERE user_id = $1 AND product_id = $2 AND is_active = FALSE
-        RETURNING id, created_at;
     """
-    revived_item = await pool.fetchrow(query_revive, user_id, product_id, quantity)
-
-    if revived_item:
-        logging.info(f"Revived item {product_id} for user {user_id}")
-        return revived_item
-
-    # Если неактивный товар не найден, используем основную логику
-    # для вставки нового или обновления существующего активного товара.
-    query_insert_or_update = """
-        INSERT INTO shop_cartitem (user_id, product_id, quantity, is_active, created_at)
-        VALUES ($1, $2, $3, TRUE, NOW())
-        ON CONFLICT (user_id, product_id) WHERE (is_active = TRUE)
-        DO UPDATE SET quantity = shop_cartitem.quantity + EXCLUDED.quantity
-        RETURNING id, created_at;
+    Добавляет товар в корзину и возвращает обновленную корзину (как fetch_cart).
+    Если активной позиции нет, "оживляет" неактивную — это решает проблему дубликатов,
+    когда товар добавляется повторно после удаления. Иначе вставляет новую позицию
+    или увеличивает количество в существующей активной.
     """
-    return await pool.fetchrow(query_insert_or_update, user_id, product_id, quantity)
+    logging.info(f"Добавление товара {product_id} ({quantity} шт.) пользователем {user_id}")
+    return await _fetch(pool, 'add_to_cart', user_id, product_id, quantity)
+
+_query('update_cart_item_quantity', """
+        WITH changed AS (
+            UPDATE shop_cartitem
+            SET quantity = GREATEST(quantity + $3, 0),
+                is_active = quantity + $3 > 0,
+                updated_at = NOW()
+            WHERE id = $2 AND user_id = $1 AND is_active = TRUE
+            RETURNING id, product_id, quantity, created_at, is_active
+        )
+""" + _CART_AFTER_CHANGE)
 
 async def update_cart_item_quantity(pool, cartitem_id, user_id, change: int):
     """
     Атомарно изменяет количество товара в корзине.
     Если количество становится 0 или меньше, товар удаляется (деактивируется).
-    Возвращает новое количество или 0, если товар удален.
+    Возвращает обновленную корзину (как fetch_cart).
     """
-    # Атомарно обновляем и получаем новое количество
     logging.info(f"Изменение количества товара {cartitem_id} пользователем {user_id} на {change}")
-    query = """
-        UPDATE shop_cartitem
-        SET quantity = quantity + $1
-        WHERE id = $2 AND user_id = $3 AND is_active = TRUE
-        RETURNING quantity
-    """
-    new_quantity = await pool.fetchval(query, change, cartitem_id, user_id)
-
-    # Если после уменьшения кол-во стало 0 или меньше, деактивируем позицию
-    if new_quantity is not None and new_quantity <= 0:
-        logging.info(f"Удаление товара {cartitem_id} (количество <= 0)")
-        await remove_from_cart(pool, cartitem_id, user_id)
-        return 0
+    return await _fetch(pool, 'update_cart_item_quantity', user_id, cartitem_id, change)
 
-    return new_quantity
+_query('remove_from_cart', """
+        WITH changed AS (
+            UPDATE shop_cartitem SET is_active = FALSE, updated_at = NOW()
+            WHERE id = $2 AND user_id = $1 AND is_active = TRUE
+            RETURNING id, product_id, quantity, created_at, is_active
+        )
+""" + _CART_AFTER_CHANGE)
 
 async def remove_from_cart(pool, cartitem_id, user_id):
-    query = """
-        UPDATE shop_cartitem SET is_active = FALSE
-        WHERE id = $1 AND user_id = $2
-    """
+    """Удаляет (деактивирует) позицию корзины и возвращает обновленную корзину."""
     logging.info(f"Удаление товара {cartitem_id} пользователем {user_id}")
-    await pool.execute(query, cartitem_id, user_id)
+    return await _fetch(pool, 'remove_from_cart', user_id, cartitem_id)
+
+# Уплотнение корзины: одна порция неактивных (и брошенных) позиций переносится в shop_cartitemarchive,
+# см. функцию shop_compact_cartitems в миграции 0020. Порции короткие и пропускают занятые строки.
+_query('compact_cart', "SELECT shop_compact_cartitems($1, NOW() - $2 * INTERVAL '1 second')", timeout=60)
 
-async def update_order_status(pool, order_id: int, user_id: int, new_status: str):
-    """Обновляет статус заказа для конкретного пользователя."""
-    query = "UPDATE shop_order SET status = $1 WHERE id = $2 AND user_id = $3 RETURNING id;"
-    updated_id = await pool.fetchval(query, new_status, order_id, user_id)
+async def compact_cart(pool, batch_size, abandoned_after=None):
+    """
+    Переносит в архив до batch_size позиций: неактивные, а если abandoned_after (секунд) задан —
+    и корзины, которые не менялись дольше этого. Возвращает число перенесенных позиций.
+    """
+    return await _fetchval(pool, 'compact_cart', batch_size, abandoned_after)
+
+# Месячные секции shop_order/shop_orderitem наперед (функция из миграции 0021); возвращает число созданных
+_query('ensure_order_partitions', "SELECT shop_ensure_order_partitions($1)", timeout=60)
+
+async def ensure_order_partitions(pool, months_ahead: int):
+    """Создает недостающие секции заказов с текущего месяца на months_ahead месяцев вперед."""
+    return await _fetchval(pool, 'ensure_order_partitions', months_ahead)
+
+# Сколько месяцев после текущего подряд покрыто секциями (не больше $1); -1 — нет секции текущего месяца
+_query('order_partitions_months_ahead', """
+        SELECT COALESCE(MIN(m), $1 + 1) - 1
+        FROM generate_series(0, $1) AS m
+        CROSS JOIN LATERAL (
+            SELECT to_char(date_trunc('month', NOW() AT TIME ZONE 'UTC') + m * INTERVAL '1 month',
+                           'YYYY"m"MM') AS suffix
+        ) s
+        WHERE to_regclass('public.shop_order_y' || s.suffix) IS NULL
+           OR to_regclass('public.shop_orderitem_y' || s.suffix) IS NULL;
+""")
+
+async def order_partitions_months_ahead(pool, limit: int):
+    """Число будущих месяцев с готовыми секциями заказов, не больше limit; -1 — нет даже текущего."""
+    return await _fetchval(pool, 'order_partitions_months_ahead', limit)
+
+# shop_order секционирована по created_at (миграция 0021): условие на дату создания оставляет
+# в плане одну секцию вместо проверки индекса в каждой
+_query('update_order_status', """
+        UPDATE shop_order SET status = $1
+        WHERE id = $2 AND user_id = $3 AND created_at >= $4 AND created_at < $4 + INTERVAL '1 second'
+        RETURNING id;
+""")
+
+# Для кнопок оплаты без даты заказа (отправлены до миграции 0021): индекс (user_id, created_at) в каждой секции
+_query('update_order_status_by_id', """
+        UPDATE shop_order SET status = $1
+        WHERE id = $2 AND user_id = $3
+        RETURNING id;
+""")
+
+async def update_order_status(pool, order_id: int, user_id: int, new_status: str, created_at=None):
+    """Обновляет статус заказа для конкретного пользователя; created_at — с точностью до секунды, если известен."""
+    if created_at is None:
+        updated_id = await _fetchval(pool, 'update_order_status_by_id', new_status, order_id, user_id)
+    else:
+        updated_id = await _fetchval(pool, 'update_order_status', new_status, order_id, user_id, created_at)
     logging.info(f"Статус заказа #{order_id} для пользователя {user_id} изменен на '{new_status}'.")
     return updated_id
 
 
-async def create_order(pool, user_id, delivery_info):
-    async with pool.acquire() as connection:
-        async with connection.transaction():
-            # 1. Получаем активные товары из корзины
-            cart_items_query = """
-                SELECT ci.product_id, ci.quantity, p.name as product_name, p.price as product_price
-                FROM shop_cartitem ci
-                JOIN shop_product p ON ci.product_id = p.id
-                WHERE ci.user_id = $1 AND ci.is_active = TRUE
-            """
-            cart_items = await connection.fetch(cart_items_query, user_id)
-
-            if not cart_items:
-                return None, []  # Корзина пуста
-
-            # 2. Создаем заказ
-            order_query = """
-                INSERT INTO shop_order (user_id, delivery_info, status, created_at)
-                VALUES ($1, $2, 'created', NOW())
-                RETURNING id, created_at, status
-            """
-            order_record = await connection.fetchrow(order_query, user_id, delivery_info)
-            order_id = order_record['id']
-
-            # 3. Создаем OrderItem для каждого товара и собираем данные для возврата
-            order_items_data = []
-            for item in cart_items:
-                await connection.execute(
-                    """
-                    INSERT INTO shop_orderitem (order_id, product_id, product_name, product_price, quantity, created_at)
-                    VALUES ($1, $2, $3, $4, $5, NOW())
-                    """,
-                    order_id, item['product_id'], item['product_name'], item['product_price'], item['quantity']
-                )
-                order_items_data.append(dict(item))
-
-            # 4. Деактивируем товары в корзине
-            await connection.execute(
-                "UPDATE shop_cartitem SET is_active = FALSE WHERE user_id = $1 AND is_active = TRUE",
-                user_id
-            )
+_query('create_order', """
+        WITH cart AS (
+            UPDATE shop_cartitem ci SET is_active = FALSE, updated_at = NOW()
+            FROM shop_product p
+            WHERE ci.user_id = $1 AND ci.is_active = TRUE AND p.id = ci.product_id
+            RETURNING ci.product_id, ci.quantity, ci.created_at,
+                      p.name AS product_name, p.price AS product_price
+        ), new_order AS (
+            INSERT INTO shop_order (user_id, delivery_info, status, created_at, total_cost, item_count)
+            SELECT $1, $2, 'created', NOW(), SUM(product_price * quantity), SUM(quantity)
+            FROM cart
+            HAVING COUNT(*) > 0
+            RETURNING id, created_at, status, total_cost
+        ), items AS (
+            INSERT INTO shop_orderitem (order_id, product_id, product_name, product_price, quantity, created_at)
+            SELECT o.id, c.product_id, c.product_name, c.product_price, c.quantity, o.created_at
+            FROM new_order o CROSS JOIN cart c
+        )
+        SELECT o.id, o.created_at, o.status, o.total_cost,
+               c.product_id, c.quantity, c.product_name, c.product_price
+        FROM new_order o CROSS JOIN cart c
+        ORDER BY c.created_at
+""")
 
-            return dict(order_record), order_items_data
+async def create_order(pool, user_id, delivery_info):
+    """
+    Оформляет заказ из активной корзины одним запросом: деактивирует позиции корзины,
+    создает заказ с итоговой суммой и числом товаров и копирует позиции в shop_orderitem
+    через INSERT ... SELECT.
+    Возвращает (заказ, позиции) или (None, []), если корзина пуста.
+    Если секции заказов на текущий месяц нет (обслуживание секций не работало), она создается
+    и запрос повторяется один раз: корзина при ошибке не меняется, запрос выполняется целиком или никак.
+    """
+    try:
+        rows = await _fetch(pool, 'create_order', user_id, delivery_info)
+    except asyncpg.exceptions.CheckViolationError as e:
+        if 'no partition of relation' not in str(e):
+            raise
+        logging.error(f"Нет секции заказов для заказа пользователя {user_id}, создаю и повторяю: {e}")
+        # Текущий и следующий месяц; остальной запас продлевает order_partition_maintainer
+        await ensure_order_partitions(pool, 1)
+        rows = await _fetch(pool, 'create_order', user_id, delivery_info)
+    if not rows:
+        return None, []  # Корзина пуста
+
+    order = {'id': rows[0]['id'], 'created_at': rows[0]['created_at'], 'status': rows[0]['status'],
+             'total_cost': rows[0]['total_cost']}
+    order_items_data = [
+        {
+            'product_id': row['product_id'],
+            'quantity': row['quantity'],
+            'product_name': row['product_name'],
+            'product_price': row['product_price'],
+        }
+        for row in rows
+    ]
+    return order, order_items_data
 
 # --- FAQ ---
-async def fetch_faq(pool, search=None):
-    if search:
-        query = """
-            SELECT id, question, answer FROM shop_faq
-            WHERE is_active = TRUE AND question ILIKE $1
-            ORDER BY id
-        """
-        return await pool.fetch(query, f"%{search}%")
-    else:
-        query = """
-            SELECT id, question, answer FROM shop_faq
-            WHERE is_active = TRUE
-            ORDER BY id
-        """
-        return await pool.fetch(query)
+# Все активные статьи хранятся в одном индексе FAQIndex в catalog_cache:
+# поиск, ответ и список статей обслуживаются из памяти, индекс пересобирается
+# после изменения shop_faq (NOTIFY) или по TTL.
+_query('fetch_faq_index', "SELECT id, question, answer FROM shop_faq WHERE is_active = TRUE ORDER BY id DESC")
+
+async def _load_faq_index(pool):
+    rows = await _fetch(pool, 'fetch_faq_index')
+    return FAQIndex(rows)
+
+async def get_faq_index(pool):
+    return await catalog_cache.get_or_load(('faq_index',), lambda: _load_faq_index(pool))
 
 async def search_faq(pool, query=None):
+    """Статьи по релевантности запросу (по вопросу и ответу, с учетом начала слов)."""
+    index = await get_faq_index(pool)
     if query:
-        # Поиск по подстроке, началу, концу, части слова, регистронезависимо
-        sql = '''
-            SELECT id, question FROM shop_faq
-            WHERE is_active = TRUE AND (
-                question ILIKE $1 OR question ILIKE $2 OR question ILIKE $3 OR question ILIKE $4
-            )
-            ORDER BY id DESC LIMIT 7
-        '''
-        q = f"%{query}%"
-        q_start = f"{query}%"
-        q_end = f"%{query}"
-        q_word = f"% {query}%"
-        faqs = await pool.fetch(sql, q, q_start, q_end, q_word)
+        faqs = index.search(query, limit=7)
         if faqs:
             return faqs
     # Если ничего не найдено или нет запроса — вернуть топ-3 самых новых FAQ
-    faqs = await pool.fetch(
-        "SELECT id, question FROM shop_faq WHERE is_active = TRUE ORDER BY id DESC LIMIT 3"
-    )
-    return faqs
+    return index.latest(3)
 
 async def get_faq_answer(pool, faq_id):
-    sql = """
-        SELECT answer FROM shop_faq WHERE id = $1 AND is_active = TRUE
-    """
-    row = await pool.fetchrow(sql, faq_id)
-    return row['answer'] if row else None
+    index = await get_faq_index(pool)
+    return index.answer(faq_id)
 
 async def get_all_faq(pool):
-    sql = "SELECT id, question FROM shop_faq WHERE is_active = TRUE ORDER BY id DESC"
-    return await pool.fetch(sql)
+    index = await get_faq_index(pool)
+    return index.latest()
 
 # --- Рассылки ---
-async def get_pending_broadcast(pool):
-    """
-    Атомарно находит одну рассылку в статусе 'pending'
-    и меняет ее статус на 'sending', чтобы другие воркеры ее не взяли.
-    """
-    query = """
-        UPDATE shop_broadcast
-        SET status = 'sending'
-        WHERE id = (
+_query('get_pending_broadcast', """
+        UPDATE shop_broadcast b
+        SET status = 'sending',
+            heartbeat_at = NOW(),
+            send_to_all = COALESCE(b.send_to_all, NOT EXISTS (
+                SELECT 1 FROM shop_broadcast_recipients r WHERE r.broadcast_id = b.id
+            ))
+        WHERE b.id = (
             SELECT id
             FROM shop_broadcast
             WHERE status = 'pending'
+               OR (status = 'sending' AND (heartbeat_at IS NULL OR heartbeat_at < NOW() - $1 * INTERVAL '1 second'))
             ORDER BY created_at
             FOR UPDATE SKIP LOCKED
             LIMIT 1
         )
-        RETURNING id, message;
+        RETURNING b.id, b.message, b.send_to_all, b.progress_user_id, b.sent_count;
+""")
+
+async def get_pending_broadcast(pool, stale_after):
+    """
+    Атомарно находит одну рассылку в статусе 'pending' (или 'sending', по которой
+    нет отметок прогресса дольше stale_after секунд — ее воркер упал)
+    и меняет ее статус на 'sending', чтобы другие воркеры ее не взяли.
+    При первом запуске фиксирует, отправляется ли рассылка всем активным пользователям.
+    """
+    return await _fetchrow(pool, 'get_pending_broadcast', stale_after)
+
+_query('broadcast_recipients_all', """
+        SELECT user_id FROM shop_telegramuser
+        WHERE is_active = TRUE AND user_id > $1
+        ORDER BY user_id
+        LIMIT $2
+""")
+_query('broadcast_recipients_selected', """
+        SELECT telegramuser_id FROM shop_broadcast_recipients
+        WHERE broadcast_id = $3 AND telegramuser_id > $1
+        ORDER BY telegramuser_id
+        LIMIT $2
+""")
+
+async def iter_broadcast_recipients(pool, broadcast_id, send_to_all, after_user_id, chunk_size):
+    """
+    Отдает ID получателей порциями по chunk_size в порядке user_id, начиная после after_user_id.
+    Каждая порция — отдельный keyset-запрос, поэтому память не зависит от размера аудитории,
+    а чтение можно продолжить с сохраненного ID после перезапуска.
     """
-    return await pool.fetchrow(query)
+    if send_to_all:
+        name, params = 'broadcast_recipients_all', ()
+    else:
+        name, params = 'broadcast_recipients_selected', (broadcast_id,)
+
+    last_user_id = after_user_id or 0
+    while True:
+        user_ids = [row[0] for row in await _fetch(pool, name, last_user_id, chunk_size, *params)]
+        if not user_ids:
+            return
+        yield user_ids
+        if len(user_ids) < chunk_size:
+            return
+        last_user_id = user_ids[-1]
+
+_query('checkpoint_broadcast', """
+        WITH recorded AS (
+            INSERT INTO shop_broadcast_recipients (broadcast_id, telegramuser_id)
+            SELECT $1, unnest($3::bigint[])
+            WHERE $4
+            ON CONFLICT (broadcast_id, telegramuser_id) DO NOTHING
+        )
+        UPDATE shop_broadcast
+        SET progress_user_id = $2,
+            sent_count = sent_count + cardinality($3::bigint[]),
+            heartbeat_at = NOW()
+        WHERE id = $1;
+""")
+
+async def checkpoint_broadcast(pool, broadcast_id, last_user_id, delivered_ids, record_recipients):
+    """
+    Сохраняет прогресс рассылки после порции получателей. Для рассылки всем
+    (record_recipients) в том же запросе записывает тех, кому сообщение доставлено.
+    """
+    await _execute(pool, 'checkpoint_broadcast', broadcast_id, last_user_id, delivered_ids, record_recipients)
 
-async def get_all_active_users_ids(pool):
-    """Получает ID всех активных пользователей."""
-    return await pool.fetchval("SELECT array_agg(user_id) FROM shop_telegramuser WHERE is_active = TRUE;")
+_query('finalize_broadcast', "UPDATE shop_broadcast SET status = 'sent', sent_at = NOW() WHERE id = $1;")
 
 async def finalize_broadcast(pool, broadcast_id):
     """Обновляет статус рассылки на 'sent' после завершения."""
-    query = "UPDATE shop_broadcast SET status = 'sent', sent_at = NOW() WHERE id = $1;"
-    await pool.execute(query, broadcast_id)
-
-async def add_recipients_to_broadcast(pool, broadcast_id, user_ids):
-    """Добавляет получателей к рассылке."""
-    if not user_ids:
-        return
-    # asyncpg может принимать список кортежей для executemany
-    data_to_insert = [(broadcast_id, user_id) for user_id in user_ids]
-    await pool.executemany(
-        "INSERT INTO shop_broadcast_recipients (broadcast_id, telegramuser_id) VALUES ($1, $2) ON CONFLICT (broadcast_id, telegramuser_id) DO NOTHING;",
-        data_to_insert
-    )
-
-async def get_broadcast_recipients_from_db(pool, broadcast_id):
-    """Получает ID пользователей, указанных в рассылке."""
-    query = "SELECT telegramuser_id FROM shop_broadcast_recipients WHERE broadcast_id = $1;"
-    # fetch returns records. We need a list of IDs.
-    return [r['telegramuser_id'] for r in await pool.fetch(query, broadcast_id)]
+    await _execute(pool, 'finalize_broadcast', broadcast_id)
@@ -1,28 +1,92 @@
+import asyncio
+import json
+import logging
 import os
-from openpyxl import Workbook, load_workbook
-from datetime import datetime
+from decimal import Decimal
+from openpyxl import Workbook
 
-ORDERS_FILE = os.path.join(os.path.dirname(__file__), 'orders.xlsx')
+EXPORT_DIR = os.getenv('ORDERS_EXPORT_DIR', os.path.join(os.path.dirname(__file__), 'exports'))
+JOURNAL_DIR = os.path.join(EXPORT_DIR, 'journal')
+# Период, на который ротируются журнал и итоговые XLSX: 'day' или 'month'
+EXPORT_ROTATION = os.getenv('ORDERS_EXPORT_ROTATION', 'month')
+COMPACT_INTERVAL = int(os.getenv('ORDERS_EXPORT_COMPACT_INTERVAL', '300'))
 
 HEADERS = ['Order ID', 'User ID', 'Delivery Info', 'Created At', 'Status', 'Product Name', 'Quantity', 'Price']
 
-def append_order_to_excel(order_id, user_id, delivery_info, created_at, status, order_items):
-    if not os.path.exists(ORDERS_FILE):
-        wb = Workbook()
-        ws = wb.active
-        ws.append(HEADERS)
-        wb.save(ORDERS_FILE)
-
-    wb = load_workbook(ORDERS_FILE)
-    ws = wb.active
+def _period(created_at):
+    return created_at.strftime('%Y-%m-%d' if EXPORT_ROTATION == 'day' else '%Y-%m')
 
+def append_order_to_journal(order_id, user_id, delivery_info, created_at, status, order_items):
+    """
+    Дописывает позиции заказа в журнал периода (JSONL, по строке на позицию).
+    Стоимость не зависит от количества прошлых заказов: файл только дописывается.
+    """
     created_at_str = created_at.strftime('%Y-%m-%d %H:%M:%S')
-
-    # Добавляем каждую позицию заказа как отдельную строку
-    for item in order_items:
-        ws.append([
+    lines = "".join(
+        json.dumps([
             order_id, user_id, delivery_info, created_at_str, status,
-            item['product_name'], item['quantity'], item['product_price']
-        ])
+            item['product_name'], item['quantity'], str(item['product_price'])
+        ], ensure_ascii=False) + "\n"
+        for item in order_items
+    )
+
+    os.makedirs(JOURNAL_DIR, exist_ok=True)
+    path = os.path.join(JOURNAL_DIR, f"orders-{_period(created_at)}.jsonl")
+    # Один write() в файл с O_APPEND: строки заказа не перемешаются с параллельными записями
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, lines.encode('utf-8'))
+    finally:
+        os.close(fd)
+
+def _build_xlsx(journal_path, xlsx_path):
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Orders')
+    ws.append(HEADERS)
+    with open(journal_path, encoding='utf-8') as journal:
+        for line in journal:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                # Строка, которая дописывается прямо сейчас; попадет в следующую сборку
+                continue
+            row[-1] = Decimal(row[-1])
+            ws.append(row)
+    tmp_path = f"{xlsx_path}.tmp"
+    wb.save(tmp_path)
+    os.replace(tmp_path, xlsx_path)
+
+def compact_journal():
+    """
+    Собирает orders-<период>.xlsx для тех периодов, журнал которых изменился
+    после прошлой сборки. Возвращает список пересобранных файлов.
+    """
+    if not os.path.isdir(JOURNAL_DIR):
+        return []
+
+    built = []
+    for name in sorted(os.listdir(JOURNAL_DIR)):
+        if not name.endswith('.jsonl'):
+            continue
+        journal_path = os.path.join(JOURNAL_DIR, name)
+        xlsx_path = os.path.join(EXPORT_DIR, name[:-len('.jsonl')] + '.xlsx')
+        journal_mtime = os.path.getmtime(journal_path)
+        if os.path.exists(xlsx_path) and os.path.getmtime(xlsx_path) >= journal_mtime:
+            continue
+        _build_xlsx(journal_path, xlsx_path)
+        # Помечаем XLSX временем журнала, с которого он собран: дозапись после этого момента
+        # сделает журнал новее, и период пересоберется на следующем проходе
+        os.utime(xlsx_path, (journal_mtime, journal_mtime))
+        built.append(xlsx_path)
+    return built
 
-    wb.save(ORDERS_FILE)
+async def export_compactor():
+    """Периодически пересобирает XLSX из журнала заказов в отдельном потоке."""
+    while True:
+        try:
+            built = await asyncio.to_thread(compact_journal)
+            if built:
+                logging.info(f"Выгрузка заказов обновлена: {', '.join(os.path.basename(p) for p in built)}")
+        except Exception as e:
+            logging.error(f"Ошибка сборки выгрузки заказов: {e}")
+        await asyncio.sleep(COMPACT_INTERVAL)
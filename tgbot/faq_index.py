@@ -0,0 +1,86 @@
+import math
+import re
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+# Вопрос весит больше ответа: совпадение в заголовке статьи точнее
+QUESTION_WEIGHT = 2.0
+ANSWER_WEIGHT = 1.0
+# Совпадение по началу слова (пользователь не дописал слово) ценится меньше полного
+PREFIX_MATCH_FACTOR = 0.5
+MIN_QUERY_TOKEN = 2
+MIN_STEM = 3
+
+_WORD_RE = re.compile(r"\w+")
+# Частые окончания русских слов; отрезается самое длинное, если остается основа от MIN_STEM букв
+_ENDINGS = sorted((
+    'ами', 'ями', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ать', 'ять', 'ить', 'еть', 'ешь', 'ете',
+    'ишь', 'ите', 'ает', 'яет', 'ует', 'ют', 'ут', 'ат', 'ят', 'ет', 'ит', 'ая', 'яя', 'ое', 'ее',
+    'ые', 'ие', 'ый', 'ий', 'ой', 'ей', 'ам', 'ям', 'ах', 'ях', 'ом', 'ем', 'ов', 'ев', 'ию', 'ия',
+    'ью', 'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й',
+), key=len, reverse=True)
+
+
+def _stem(word):
+    for ending in _ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def tokenize(text):
+    return [_stem(word) for word in _WORD_RE.findall(text.lower().replace('ё', 'е'))]
+
+
+class FAQIndex:
+    """
+    Инвертированный индекс по вопросам и ответам FAQ.
+    rows — активные статьи (id, question, answer), отсортированные по id по убыванию.
+    """
+
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self._by_id = {row['id']: row for row in self.rows}
+        postings = defaultdict(dict)
+        for row in self.rows:
+            weights = Counter()
+            for term in tokenize(row['question']):
+                weights[term] += QUESTION_WEIGHT
+            for term in tokenize(row['answer']):
+                weights[term] += ANSWER_WEIGHT
+            for term, weight in weights.items():
+                postings[term][row['id']] = 1 + math.log(weight)
+
+        total = len(self.rows)
+        self._postings = {
+            term: {faq_id: weight * math.log(1 + total / len(docs)) for faq_id, weight in docs.items()}
+            for term, docs in postings.items()
+        }
+        self._terms = sorted(self._postings)
+
+    def search(self, query, limit):
+        """Статьи по убыванию релевантности; слово запроса совпадает с термином целиком или его началом."""
+        scores = defaultdict(float)
+        for query_term in set(tokenize(query)):
+            if len(query_term) < MIN_QUERY_TOKEN:
+                continue
+            best = {}
+            i = bisect_left(self._terms, query_term)
+            while i < len(self._terms) and self._terms[i].startswith(query_term):
+                term = self._terms[i]
+                factor = 1.0 if term == query_term else PREFIX_MATCH_FACTOR
+                for faq_id, weight in self._postings[term].items():
+                    best[faq_id] = max(best.get(faq_id, 0.0), weight * factor)
+                i += 1
+            for faq_id, score in best.items():
+                scores[faq_id] += score
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+        return [self._by_id[faq_id] for faq_id, _ in ranked[:limit]]
+
+    def latest(self, limit=None):
+        return self.rows[:limit]
+
+    def answer(self, faq_id):
+        row = self._by_id.get(faq_id)
+        return row['answer'] if row else None
@@ -0,0 +1,209 @@
+import asyncio
+import json
+import logging
+import os
+from abc import abstractmethod
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from aiogram.fsm.storage.memory import MemoryStorage
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Где хранится состояние диалогов: 'memory' (только один процесс), 'postgres' или 'redis'
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'postgres')
+REDIS_URL = os.getenv('REDIS_URL', 'redis://redis:6379/0')
+# Сколько секунд живет состояние без изменений (брошенное оформление заказа)
+FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', '86400'))
+# Записи копятся в памяти не дольше этого интервала и уходят в хранилище одной пачкой
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', '0.05'))
+FSM_CLEANUP_INTERVAL = int(os.getenv('FSM_CLEANUP_INTERVAL', '600'))
+FLUSH_RETRY_DELAY = 1
+
+
+class BufferedStorage(BaseStorage):
+    """
+    Основа для внешних хранилищ FSM: set_state/set_data пишутся в буфер процесса,
+    фоновая задача отправляет накопленное одной пачкой. Пока запись не ушла,
+    чтения этого процесса берут значение из буфера.
+    """
+
+    def __init__(self, ttl=FSM_STATE_TTL, flush_interval=FSM_FLUSH_INTERVAL, cleanup_interval=None):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.cleanup_interval = cleanup_interval
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        # ключ -> {'state': ..., 'data': ...}; присутствуют только измененные части
+        self._pending = {}
+        self._flushing = {}
+        self._dirty = asyncio.Event()
+        self._tasks = []
+
+    # BaseStorage aiogram — ABC: наследник без этих методов не создастся
+    @abstractmethod
+    async def _write_batch(self, batch):
+        """Записывает пачку {ключ: {часть: значение}} в хранилище."""
+
+    @abstractmethod
+    async def _read(self, key, part):
+        """Читает часть ('state' или 'data') по ключу хранилища, None — если ее нет."""
+
+    async def _cleanup(self):
+        pass
+
+    def _put(self, key, part, value):
+        self._pending.setdefault(self.key_builder.build(key), {})[part] = value
+        self._dirty.set()
+        if not self._tasks:
+            self._tasks.append(asyncio.create_task(self._flush_loop()))
+            if self.cleanup_interval:
+                self._tasks.append(asyncio.create_task(self._cleanup_loop()))
+
+    async def _get(self, key, part):
+        storage_key = self.key_builder.build(key)
+        for buffer in (self._pending, self._flushing):
+            changes = buffer.get(storage_key)
+            if changes is not None and part in changes:
+                return changes[part]
+        return await self._read(storage_key, part)
+
+    async def set_state(self, key, state=None):
+        self._put(key, 'state', state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key):
+        return await self._get(key, 'state')
+
+    async def set_data(self, key, data):
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        self._put(key, 'data', dict(data))
+
+    async def get_data(self, key):
+        data = await self._get(key, 'data')
+        return dict(data) if data else {}
+
+    async def flush(self):
+        """Отправляет накопленные изменения; при ошибке возвращает их в буфер и пробрасывает исключение."""
+        if not self._pending:
+            return
+        self._flushing, self._pending = self._pending, {}
+        try:
+            await self._write_batch(self._flushing)
+        except BaseException:
+            # Более новые изменения, пришедшие во время записи, важнее неотправленных
+            for key, changes in self._flushing.items():
+                self._pending[key] = {**changes, **self._pending.get(key, {})}
+            raise
+        finally:
+            self._flushing = {}
+
+    async def _flush_loop(self):
+        while True:
+            await self._dirty.wait()
+            await asyncio.sleep(self.flush_interval)
+            self._dirty.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Не удалось сохранить состояние FSM ({len(self._pending)} ключей): {e}")
+                self._dirty.set()
+                await asyncio.sleep(FLUSH_RETRY_DELAY)
+
+    async def _cleanup_loop(self):
+        while True:
+            await asyncio.sleep(self.cleanup_interval)
+            try:
+                await self._cleanup()
+            except Exception as e:
+                logging.error(f"Ошибка очистки устаревших состояний FSM: {e}")
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        try:
+            await self.flush()
+        except Exception as e:
+            logging.error(f"Состояние FSM не сохранено при остановке ({len(self._pending)} ключей): {e}")
+
+
+class PostgresStorage(BufferedStorage):
+    """
+    Состояния FSM в UNLOGGED-таблице bot_fsm_state (миграция 0016) через общий пул asyncpg.
+    Пул присваивается в on_startup: storage.pool = pool.
+    """
+
+    UPSERT = """
+        INSERT INTO bot_fsm_state AS f (key, value, expires_at)
+        SELECT k, v, NOW() + make_interval(secs => $3)
+        FROM unnest($1::text[], $2::jsonb[]) AS t(k, v)
+        ON CONFLICT (key) DO UPDATE SET
+            -- Пишем только измененные части: состояние и данные могут прийти в разных пачках
+            value = CASE WHEN f.expires_at > NOW() THEN f.value ELSE '{}'::jsonb END || EXCLUDED.value,
+            expires_at = EXCLUDED.expires_at;
+    """
+    SELECT = "SELECT value -> $2 FROM bot_fsm_state WHERE key = $1 AND expires_at > NOW();"
+    CLEANUP = "DELETE FROM bot_fsm_state WHERE expires_at <= NOW();"
+
+    def __init__(self, pool=None, cleanup_interval=FSM_CLEANUP_INTERVAL, **kwargs):
+        super().__init__(cleanup_interval=cleanup_interval, **kwargs)
+        self.pool = pool
+
+    async def _write_batch(self, batch):
+        keys = list(batch)
+        values = [json.dumps(batch[key], ensure_ascii=False) for key in keys]
+        await self.pool.execute(self.UPSERT, keys, values, float(self.ttl))
+
+    async def _read(self, key, part):
+        value = await self.pool.fetchval(self.SELECT, key, part)
+        return json.loads(value) if value is not None else None
+
+    async def _cleanup(self):
+        result = await self.pool.execute(self.CLEANUP)
+        logging.info(f"Удалены устаревшие состояния FSM: {result}")
+
+
+class RedisStorage(BufferedStorage):
+    """
+    Состояния FSM в Redis (или совместимом сервере): ключи <key>:state и <key>:data
+    с EX = ttl, пачка изменений уходит одним pipeline. Требует пакет redis.
+    """
+
+    def __init__(self, redis, **kwargs):
+        super().__init__(**kwargs)
+        self.redis = redis
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        from redis.asyncio import Redis
+        return cls(Redis.from_url(url), **kwargs)
+
+    async def _write_batch(self, batch):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key, changes in batch.items():
+                for part, value in changes.items():
+                    if value is None or value == {}:
+                        pipe.delete(f"{key}:{part}")
+                    else:
+                        pipe.set(f"{key}:{part}", json.dumps(value, ensure_ascii=False), ex=self.ttl)
+            await pipe.execute()
+
+    async def _read(self, key, part):
+        value = await self.redis.get(f"{key}:{part}")
+        return json.loads(value) if value is not None else None
+
+    async def close(self):
+        await super().close()
+        await self.redis.aclose()
+
+
+def create_storage(kind=FSM_STORAGE):
+    if kind == 'memory':
+        return MemoryStorage()
+    if kind == 'postgres':
+        return PostgresStorage()
+    if kind == 'redis':
+        return RedisStorage.from_url(REDIS_URL)
+    raise ValueError(f"Неизвестное хранилище FSM: {kind}")
@@ -1,67 +1,90 @@
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from datetime import datetime
+from aiogram.types import KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from callbacks import (CatalogLevel, CartAction, CategoryCallback, SubcategoryCallback, CatalogPageCallback,
+                       ProductCallback, AddToCartCallback, QuantityCallback, ConfirmCallback, CartItemCallback,
+                       CartNoopCallback, OrderCallback, PaidCallback, FaqCallback, FaqAllCallback, FaqBackCallback,
+                       MainMenuCallback)
+from markup_cache import PackedInlineKeyboardMarkup, PackedReplyKeyboardMarkup, memoized_markup, pack
 
-main_menu = ReplyKeyboardMarkup(
+# Клавиатуры, одинаковые для всех пользователей, строятся один раз (статические) или
+# берутся из markup_cache (страницы каталога, FAQ, кнопки товара) уже с готовым JSON.
+main_menu = pack(PackedReplyKeyboardMarkup(
     keyboard=[
         [KeyboardButton(text="🛍️ Каталог")],
         [KeyboardButton(text="🛒 Корзина")],
         [KeyboardButton(text="❓ FAQ")],
     ],
     resize_keyboard=True
-)
+))
 
-def get_inline_categories(categories, parent_prefix="cat", page=1, per_page=5, parent_id_for_cb=None):
-    if not categories:
-        return None
+def _page_key(page):
+    return tuple((item['id'], item['name']) for item in page.items), page.prev_cursor, page.next_cursor
+
+def _page_buttons(page, level, parent_id=0):
+    """Кнопки перехода по страницам: курсоры берутся из CatalogPage."""
+    buttons = []
+    if page.next_cursor:
+        cb = CatalogPageCallback(level=level, parent_id=parent_id, cursor=page.next_cursor)
+        buttons.append([InlineKeyboardButton(text="Далее ▶️", callback_data=cb.pack())])
+    if page.prev_cursor:
+        cb = CatalogPageCallback(level=level, parent_id=parent_id, cursor=page.prev_cursor)
+        buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data=cb.pack())])
+    return buttons
 
-    # Для пагинации по подкатегориям нам нужно передавать ID родителя в callback_data
-    cb_prefix = parent_prefix
-    if parent_prefix == 'subcat' and parent_id_for_cb:
-        cb_prefix = f"subcat_{parent_id_for_cb}"
+@memoized_markup(key=lambda page, parent_id=None: (_page_key(page), parent_id))
+def get_inline_categories(page, parent_id=None):
+    """Корневые категории (parent_id=None) или подкатегории категории parent_id."""
+    if not page.items:
+        return None
 
+    callback_cls = SubcategoryCallback if parent_id else CategoryCallback
     buttons = [
-        [InlineKeyboardButton(text=cat['name'], callback_data=f"{parent_prefix}_{cat['id']}")]
-        for cat in categories[(page-1)*per_page:page*per_page]
+        [InlineKeyboardButton(text=cat['name'], callback_data=callback_cls(id=cat['id']).pack())]
+        for cat in page.items
     ]
-    # Пагинация
-    if len(categories) > page*per_page:
-        buttons.append([InlineKeyboardButton(text="Далее ▶️", callback_data=f"{cb_prefix}_page_{page+1}")])
-    if page > 1:
-        buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data=f"{cb_prefix}_page_{page-1}")])
-    return InlineKeyboardMarkup(inline_keyboard=buttons) if buttons else None
+    # Для пагинации по подкатегориям в callback_data передается ID родителя
+    level = CatalogLevel.SUBCATEGORIES if parent_id else CatalogLevel.CATEGORIES
+    buttons += _page_buttons(page, level, parent_id or 0)
+    return PackedInlineKeyboardMarkup(inline_keyboard=buttons)
 
-def get_inline_products(products):
-    if not products:
+@memoized_markup(key=lambda page, category_id: (_page_key(page), category_id))
+def get_inline_products(page, category_id):
+    if not page.items:
         return None
     buttons = [
-        [InlineKeyboardButton(text=prod['name'], callback_data=f"product_{prod['id']}")]
-        for prod in products
+        [InlineKeyboardButton(text=prod['name'], callback_data=ProductCallback(id=prod['id']).pack())]
+        for prod in page.items
     ]
-    return InlineKeyboardMarkup(inline_keyboard=buttons) if buttons else None
+    buttons += _page_buttons(page, CatalogLevel.PRODUCTS, category_id)
+    return PackedInlineKeyboardMarkup(inline_keyboard=buttons)
 
+@memoized_markup(key=lambda product_id: product_id)
 def get_add_to_cart_keyboard(product_id):
     if not product_id:
         return None
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="➕ Добавить в корзину", callback_data=f"addcart_{product_id}")]
+    return PackedInlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="➕ Добавить в корзину", callback_data=AddToCartCallback(product_id=product_id).pack())]
     ])
 
+@memoized_markup(key=lambda product_id, max_qty=10: (product_id, max_qty))
 def get_quantity_keyboard(product_id, max_qty=10):
     buttons = []
     row = []
     for i in range(1, max_qty+1):
-        row.append(InlineKeyboardButton(text=str(i), callback_data=f"qty_{product_id}_{i}"))
+        row.append(InlineKeyboardButton(text=str(i), callback_data=QuantityCallback(product_id=product_id, qty=i).pack()))
         if i % 5 == 0:
             buttons.append(row)
             row = []
     if row:
         buttons.append(row)
-    return InlineKeyboardMarkup(inline_keyboard=buttons) if buttons else None
+    return PackedInlineKeyboardMarkup(inline_keyboard=buttons) if buttons else None
 
+@memoized_markup(key=lambda product_id, qty: (product_id, qty))
 def get_confirm_keyboard(product_id, qty):
     buttons = [
-        [InlineKeyboardButton(text=f"✅ Добавить {qty} шт.", callback_data=f"confirm_{product_id}_{qty}")]
+        [InlineKeyboardButton(text=f"✅ Добавить {qty} шт.", callback_data=ConfirmCallback(product_id=product_id, qty=qty).pack())]
     ]
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
+    return PackedInlineKeyboardMarkup(inline_keyboard=buttons)
 
 def get_cart_keyboard(cart_items):
     if not cart_items:
@@ -72,45 +95,48 @@ def get_cart_keyboard(cart_items):
         buttons.append([
             InlineKeyboardButton(
                 text=item['name'],
-                callback_data=f"product_{item['product_id']}"
+                callback_data=ProductCallback(id=item['product_id']).pack()
             )
         ])
         # Ряд 2: Управление количеством и удаление
         buttons.append([
-            InlineKeyboardButton(text="➖", callback_data=f"cart_decr_{item['id']}"),
-            InlineKeyboardButton(text=f"{item['quantity']} шт.", callback_data="cart_noop"),
-            InlineKeyboardButton(text="➕", callback_data=f"cart_incr_{item['id']}"),
-            InlineKeyboardButton(text="❌ Удалить", callback_data=f"delcart_{item['id']}")
+            InlineKeyboardButton(text="➖", callback_data=CartItemCallback(action=CartAction.DECR, item_id=item['id']).pack()),
+            InlineKeyboardButton(text=f"{item['quantity']} шт.", callback_data=CartNoopCallback().pack()),
+            InlineKeyboardButton(text="➕", callback_data=CartItemCallback(action=CartAction.INCR, item_id=item['id']).pack()),
+            InlineKeyboardButton(text="❌ Удалить", callback_data=CartItemCallback(action=CartAction.DELETE, item_id=item['id']).pack())
         ])
-    buttons.append([InlineKeyboardButton(text="💳 Оформить заказ", callback_data="order")])
+    buttons.append([InlineKeyboardButton(text="💳 Оформить заказ", callback_data=OrderCallback().pack())])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-def get_payment_keyboard(order_id: int, total_cost: float, payment_url: str):
+def get_payment_keyboard(order_id: int, total_cost: float, payment_url: str, created_at: datetime):
     """Создает клавиатуру для оплаты с реальной ссылкой и кнопкой-заглушкой."""
     buttons = [
         [InlineKeyboardButton(text=f"Оплатить {total_cost:.2f} ₽", url=payment_url)],
         # Кнопка-заглушка для имитации ответа от платежной системы
-        [InlineKeyboardButton(text="✅ Я оплатил(а)", callback_data=f"paid_{order_id}")]
+        [InlineKeyboardButton(text="✅ Я оплатил(а)", callback_data=PaidCallback(
+            order_id=order_id, created=int(created_at.timestamp())).pack())]
     ]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-def get_back_to_faq_keyboard():
-    """Создает клавиатуру для возврата к списку FAQ или в главное меню."""
-    buttons = [
-        [
-            InlineKeyboardButton(text="⬅️ Назад к вопросам", callback_data="faq_back_to_list"),
-            InlineKeyboardButton(text="🏠 В главное меню", callback_data="back_to_main_menu")
-        ]
+_back_to_faq_keyboard = pack(PackedInlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(text="⬅️ Назад к вопросам", callback_data=FaqBackCallback().pack()),
+        InlineKeyboardButton(text="🏠 В главное меню", callback_data=MainMenuCallback().pack())
     ]
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
+]))
 
+def get_back_to_faq_keyboard():
+    """Клавиатура для возврата к списку FAQ или в главное меню."""
+    return _back_to_faq_keyboard
+
+@memoized_markup(key=lambda faqs, show_all_button=True: (tuple((f['id'], f['question']) for f in faqs), show_all_button))
 def get_faq_keyboard(faqs, show_all_button=True):
     buttons = [
-        [InlineKeyboardButton(text=faq['question'], callback_data=f"faq_{faq['id']}")]
+        [InlineKeyboardButton(text=faq['question'], callback_data=FaqCallback(id=faq['id']).pack())]
         for faq in faqs
     ]
     if show_all_button:
-        buttons.append([InlineKeyboardButton(text="📖 Показать все статьи", callback_data="faq_all")])
+        buttons.append([InlineKeyboardButton(text="📖 Показать все статьи", callback_data=FaqAllCallback().pack())])
     if not buttons or (not faqs and not show_all_button):
         return None
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
+    return PackedInlineKeyboardMarkup(inline_keyboard=buttons)
@@ -0,0 +1,85 @@
+import os
+from collections import OrderedDict
+from functools import wraps
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.types import InlineKeyboardMarkup, ReplyKeyboardMarkup
+from dotenv import load_dotenv
+from pydantic import PrivateAttr
+from catalog_cache import catalog_cache
+
+load_dotenv()
+
+MARKUP_CACHE_MAX_ENTRIES = int(os.getenv('MARKUP_CACHE_MAX_ENTRIES', '5000'))
+
+
+class PackedInlineKeyboardMarkup(InlineKeyboardMarkup):
+    """Inline-клавиатура с JSON, сериализованным один раз при создании."""
+    _json: str = PrivateAttr(default=None)
+
+
+class PackedReplyKeyboardMarkup(ReplyKeyboardMarkup):
+    _json: str = PrivateAttr(default=None)
+
+
+def pack(markup):
+    """Фиксирует JSON клавиатуры. Упакованную клавиатуру нельзя менять: она общая для всех пользователей."""
+    markup._json = markup.model_dump_json(exclude_none=True)
+    return markup
+
+
+class MarkupCache:
+    """
+    LRU-кэш готовых клавиатур: ключ — (builder, ключ аргументов, catalog_cache.version).
+    Страницы каталога и списки FAQ одинаковы для всех пользователей, поэтому на повторное
+    нажатие клавиатура не строится и не валидируется заново; после NOTIFY об изменении каталога
+    версия растет и старые записи просто вытесняются.
+    """
+
+    def __init__(self, max_entries=MARKUP_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get_or_build(self, key, build):
+        markup = self._entries.get(key)
+        if markup is not None:
+            self._entries.move_to_end(key)
+            return markup
+        markup = build()
+        if markup is None:
+            return None
+        self._entries[key] = pack(markup)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return markup
+
+    def clear(self):
+        self._entries.clear()
+
+
+markup_cache = MarkupCache()
+
+
+def memoized_markup(key):
+    """
+    Декоратор построителя клавиатуры; key(*args, **kwargs) возвращает hashable-ключ аргументов.
+    Построитель должен создавать PackedInlineKeyboardMarkup.
+    """
+    def decorator(builder):
+        @wraps(builder)
+        def wrapper(*args, **kwargs):
+            cache_key = (builder.__name__, key(*args, **kwargs), catalog_cache.version)
+            return markup_cache.get_or_build(cache_key, lambda: builder(*args, **kwargs))
+        return wrapper
+    return decorator
+
+
+class PackedMarkupSession(AiohttpSession):
+    """Сессия бота, которая отправляет reply_markup упакованных клавиатур готовой строкой, без model_dump."""
+
+    def build_form_data(self, bot, method):
+        packed = getattr(getattr(method, 'reply_markup', None), '_json', None)
+        if packed is None:
+            return super().build_form_data(bot, method)
+        form = super().build_form_data(bot, method.model_copy(update={'reply_markup': None}))
+        form.add_field('reply_markup', packed)
+        return form
@@ -0,0 +1,96 @@
+import logging
+import os
+import time
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from dotenv import load_dotenv
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, multiprocess, start_http_server
+
+load_dotenv()
+
+# Порт HTTP-сервера с /metrics; 0 — не запускать.
+# В режиме супервизора (BOT_WORKERS > 1) нужен PROMETHEUS_MULTIPROC_DIR: метрики всех процессов
+# пишутся в файлы этого каталога, а /metrics супервизора отдает их сумму.
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))
+
+# Границы бакетов в секундах: от быстрых запросов к кэшу до таймаутов Telegram
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+HANDLER_LATENCY = Histogram('bot_handler_seconds', 'Время обработки события хендлером',
+                            ['handler'], buckets=LATENCY_BUCKETS)
+HANDLER_ERRORS = Counter('bot_handler_errors_total', 'Исключения в хендлерах', ['handler', 'error'])
+
+DB_QUERY_LATENCY = Histogram('bot_db_query_seconds', 'Время запроса к БД (с учетом ожидания соединения)',
+                             ['query'], buckets=LATENCY_BUCKETS)
+DB_POOL_WAIT = Histogram('bot_db_pool_acquire_seconds', 'Ожидание свободного соединения в пуле',
+                         buckets=LATENCY_BUCKETS)
+DB_ERRORS = Counter('bot_db_errors_total', 'Ошибки запросов к БД', ['query', 'error'])
+
+TELEGRAM_API_LATENCY = Histogram('bot_telegram_api_seconds', 'Время вызова метода Bot API',
+                                 ['method'], buckets=LATENCY_BUCKETS)
+TELEGRAM_API_ERRORS = Counter('bot_telegram_api_errors_total', 'Ошибки вызовов Bot API', ['method', 'error'])
+
+BROADCAST_MESSAGES = Counter('bot_broadcast_messages_total', 'Сообщения рассылок по результату', ['result'])
+BROADCAST_SEND_RATE = Gauge('bot_broadcast_send_rate', 'Скорость текущей рассылки, сообщений в секунду',
+                            multiprocess_mode='livesum')
+# Запас будущих месяцев с секциями заказов; 0 — в следующем месяце оформление заказов упадет
+ORDER_PARTITIONS_MONTHS_AHEAD = Gauge('bot_order_partitions_months_ahead',
+                                      'Будущих месяцев с готовыми секциями shop_order/shop_orderitem',
+                                      multiprocess_mode='livemin')
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner-middleware: время и ошибки по каждому хендлеру (имя функции)."""
+
+    async def __call__(self, handler, event, data):
+        # У inline-кнопок в aiogram один общий хендлер, настоящий выбирает CallbackRouter (callbacks.py)
+        name = (data.get('callback_handler') or data['handler']).callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            HANDLER_ERRORS.labels(name, type(e).__name__).inc()
+            raise
+        finally:
+            HANDLER_LATENCY.labels(name).observe(time.perf_counter() - started)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии Bot: время и ошибки по каждому методу Bot API."""
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_API_ERRORS.labels(name, type(e).__name__).inc()
+            raise
+        finally:
+            TELEGRAM_API_LATENCY.labels(name).observe(time.perf_counter() - started)
+
+
+def setup_metrics(dp, bot):
+    middleware = HandlerMetricsMiddleware()
+    for observer in (dp.message, dp.callback_query):
+        observer.middleware(middleware)
+    bot.session.middleware(TelegramMetricsMiddleware())
+
+
+def start_metrics_server(port=METRICS_PORT):
+    """Запускает /metrics в отдельном потоке текущего процесса."""
+    if not port:
+        return
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    start_http_server(port, registry=registry)
+    logging.info(f"Metrics available on :{port}/metrics")
+
+
+def mark_process_dead(pid):
+    """Удаляет файлы метрик завершившегося процесса (только для gauge в режиме multiprocess)."""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,49 @@
+import asyncio
+import logging
+import os
+from dotenv import load_dotenv
+from db import ensure_order_partitions, order_partitions_months_ahead
+from metrics import ORDER_PARTITIONS_MONTHS_AHEAD
+
+load_dotenv()
+
+# На сколько месяцев вперед держать готовые секции shop_order/shop_orderitem
+ORDER_PARTITIONS_AHEAD = int(os.getenv('ORDER_PARTITIONS_AHEAD', '3'))
+# Как часто проверять секции, секунд; 0 — только при запуске бота (дальше их создает команда order_partitions)
+ORDER_PARTITIONS_INTERVAL = int(os.getenv('ORDER_PARTITIONS_INTERVAL', '86400'))
+# Если готовых будущих месяцев меньше, пишется ERROR: секции не создаются, и скоро заказы перестанут оформляться
+ORDER_PARTITIONS_ALERT_MONTHS = int(os.getenv('ORDER_PARTITIONS_ALERT_MONTHS', '2'))
+
+
+async def check_order_partitions(pool):
+    """
+    Создает недостающие секции заказов (см. миграцию 0021) и проверяет запас месяцев.
+    Секции по умолчанию нет: без секции месяца create_order создает ее сам и повторяет запрос,
+    но это ERROR в журнале и лишняя задержка на оформлении заказа.
+    """
+    try:
+        created = await ensure_order_partitions(pool, ORDER_PARTITIONS_AHEAD)
+        if created:
+            logging.info(f"Секции заказов: создано {created}")
+    except Exception as e:
+        logging.error(f"Ошибка создания секций заказов: {e}")
+    try:
+        months = await order_partitions_months_ahead(pool, ORDER_PARTITIONS_AHEAD)
+    except Exception as e:
+        logging.error(f"Не удалось проверить секции заказов: {e}")
+        return
+    ORDER_PARTITIONS_MONTHS_AHEAD.set(months)
+    if months < 0:
+        logging.error("Нет секции заказов на текущий месяц: оформление заказов не работает. "
+                      "Запустите manage.py order_partitions")
+    elif months < ORDER_PARTITIONS_ALERT_MONTHS:
+        logging.error(f"Секции заказов готовы только на {months} мес. вперед. Запустите manage.py order_partitions")
+
+
+async def order_partition_maintainer(pool):
+    """Периодически продлевает секции заказов; первая проверка — в on_startup."""
+    if not ORDER_PARTITIONS_INTERVAL:
+        return
+    while True:
+        await asyncio.sleep(ORDER_PARTITIONS_INTERVAL)
+        await check_order_partitions(pool)
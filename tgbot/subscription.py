@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import os
+import time
+from aiogram.exceptions import TelegramBadRequest
+from dotenv import load_dotenv
+from db import fetch_recent_subscribers
+
+load_dotenv()
+
+# Сколько секунд доверяем положительному и отрицательному результату проверки подписки
+SUBSCRIPTION_POSITIVE_TTL = float(os.getenv('SUBSCRIPTION_POSITIVE_TTL', '3600'))
+SUBSCRIPTION_NEGATIVE_TTL = float(os.getenv('SUBSCRIPTION_NEGATIVE_TTL', '60'))
+SUBSCRIPTION_REFRESH_INTERVAL = float(os.getenv('SUBSCRIPTION_REFRESH_INTERVAL', '60'))
+# Пользователи, которых проверяли за это время, считаются активными: их статус обновляется заранее
+SUBSCRIPTION_ACTIVE_WINDOW = float(os.getenv('SUBSCRIPTION_ACTIVE_WINDOW', '86400'))
+SUBSCRIPTION_REFRESH_CONCURRENCY = 5
+
+SUBSCRIBED_STATUSES = ("member", "administrator", "creator")
+
+
+class _Entry:
+    __slots__ = ('subscribed', 'expires_at', 'last_seen')
+
+    def __init__(self, subscribed, expires_at, last_seen):
+        self.subscribed = subscribed
+        self.expires_at = expires_at
+        self.last_seen = last_seen
+
+
+class SubscriptionCache:
+    """
+    Кэш статуса подписки на канал. Одновременные проверки одного пользователя
+    объединяются в один вызов get_chat_member; при ошибке API используется последний известный статус.
+    """
+
+    def __init__(self, bot, channel_id, positive_ttl=SUBSCRIPTION_POSITIVE_TTL,
+                 negative_ttl=SUBSCRIPTION_NEGATIVE_TTL):
+        self.bot = bot
+        self.channel_id = channel_id
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self._entries = {}
+        self._inflight = {}
+
+    async def seed(self, pool):
+        """Заполняет кэш подписчиками из shop_telegramuser, чей статус обновлялся в пределах positive_ttl."""
+        now = time.monotonic()
+        rows = await fetch_recent_subscribers(pool, self.positive_ttl)
+        for row in rows:
+            # last_seen = -inf: до первого обращения пользователь не считается активным
+            self._entries[row['user_id']] = _Entry(True, now + self.positive_ttl - row['age'], float('-inf'))
+        logging.info(f"Кэш подписок заполнен из БД: {len(rows)} пользователей")
+
+    async def is_subscribed(self, user_id: int) -> bool:
+        now = time.monotonic()
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            entry.last_seen = now
+            if entry.expires_at > now:
+                return entry.subscribed
+        return await self._lookup(user_id)
+
+    async def _lookup(self, user_id):
+        future = self._inflight.get(user_id)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(user_id))
+            self._inflight[user_id] = future
+            future.add_done_callback(lambda _: self._inflight.pop(user_id, None))
+        return await asyncio.shield(future)
+
+    async def _fetch(self, user_id):
+        entry = self._entries.get(user_id)
+        try:
+            member = await self.bot.get_chat_member(self.channel_id, user_id)
+        except TelegramBadRequest as e:
+            logging.critical(f"CRITICAL: Subscription check failed due to bad request. Check if bot is admin in the channel {self.channel_id}. Error: {e}")
+            # Если бот не в канале или канал указан неверно, доступ не предоставляем.
+            return False
+        except Exception as e:
+            # Временный сбой API: не отказываем тем, кто по последним данным подписан
+            logging.error(f"Unexpected error in subscription check for user {user_id}: {e}")
+            return entry.subscribed if entry is not None else False
+
+        subscribed = member.status in SUBSCRIBED_STATUSES
+        now = time.monotonic()
+        ttl = self.positive_ttl if subscribed else self.negative_ttl
+        last_seen = entry.last_seen if entry is not None else now
+        self._entries[user_id] = _Entry(subscribed, now + ttl, last_seen)
+        return subscribed
+
+    async def refresh_loop(self, interval=SUBSCRIPTION_REFRESH_INTERVAL, active_window=SUBSCRIPTION_ACTIVE_WINDOW):
+        """
+        Фоново перепроверяет активных подписчиков, у которых статус скоро истечет,
+        чтобы /start не ждал API, и удаляет давно не использованные записи.
+        """
+        semaphore = asyncio.Semaphore(SUBSCRIPTION_REFRESH_CONCURRENCY)
+
+        async def refresh(user_id):
+            async with semaphore:
+                await self._lookup(user_id)
+
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                now = time.monotonic()
+                to_refresh = []
+                for user_id, entry in list(self._entries.items()):
+                    if now - entry.last_seen > active_window:
+                        if entry.expires_at <= now:
+                            del self._entries[user_id]
+                    elif entry.subscribed and entry.expires_at - now < interval * 2:
+                        to_refresh.append(user_id)
+                if to_refresh:
+                    await asyncio.gather(*(refresh(user_id) for user_id in to_refresh))
+            except Exception as e:
+                logging.error(f"Ошибка фонового обновления подписок: {e}")
@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+from aiogram.exceptions import TelegramNetworkError, TelegramServerError
+from dotenv import load_dotenv
+from metrics import mark_process_dead, start_metrics_server
+from webhook import serve_webhook, wait_for_stop_signal
+
+load_dotenv()
+
+# Число процессов-обработчиков; 1 — бот работает в одном процессе, как раньше
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '1'))
+# Сколько обновлений разных пользователей один обработчик ведет одновременно
+WORKER_CONCURRENCY = int(os.getenv('BOT_WORKER_CONCURRENCY', '100'))
+WORKER_QUEUE_SIZE = int(os.getenv('BOT_WORKER_QUEUE_SIZE', '1000'))
+# Сколько секунд при остановке ждем, пока обработчики доделают свои очереди
+SHUTDOWN_TIMEOUT = float(os.getenv('BOT_SHUTDOWN_TIMEOUT', '30'))
+POLLING_TIMEOUT = 30
+POLLING_RETRY_DELAY = 5
+MONITOR_INTERVAL = 1
+# Сколько секунд ждать места в полной очереди, прежде чем проверить, не заменили ли ее
+QUEUE_PUT_TIMEOUT = 1
+
+
+def update_user_id(update):
+    """ID пользователя, от которого пришло обновление (поле from у message, callback_query и т.п.)."""
+    for value in update.values():
+        if isinstance(value, dict):
+            user = value.get('from') or value.get('user')
+            if user:
+                return user['id']
+            chat = value.get('chat')
+            if chat:
+                return chat['id']
+    return 0
+
+
+# --- Процесс-обработчик ---
+def _worker_main(app, index, updates):
+    # Ctrl+C получает вся группа процессов; останавливает обработчики супервизор
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    dp, bot = app()
+    asyncio.run(_run_worker(dp, bot, index, updates))
+
+
+async def _run_worker(dp, bot, index, updates):
+    workflow_data = {"dispatcher": dp, "bots": [bot], "role": "worker"}
+    await dp.emit_startup(bot=bot, **workflow_data)
+    logging.info(f"Обработчик #{index} запущен (pid {os.getpid()})")
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(WORKER_CONCURRENCY)
+    # user_id -> [Lock, число ожидающих]: обновления одного пользователя обрабатываются по порядку
+    user_locks = {}
+    tasks = set()
+
+    async def process(update):
+        user_id = update_user_id(update)
+        entry = user_locks.setdefault(user_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await dp.feed_raw_update(bot, update, **workflow_data)
+        except Exception as e:
+            logging.error(f"Ошибка обработки обновления {update.get('update_id')}: {e}")
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del user_locks[user_id]
+            semaphore.release()
+
+    try:
+        while True:
+            update = await loop.run_in_executor(None, updates.get)
+            if update is None:
+                break
+            await semaphore.acquire()
+            task = asyncio.create_task(process(update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+    finally:
+        try:
+            await dp.emit_shutdown(bot=bot, **workflow_data)
+        finally:
+            await bot.session.close()
+        logging.info(f"Обработчик #{index} остановлен")
+
+
+# --- Процесс фоновых задач ---
+def _background_main(app):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    dp, bot = app()
+    asyncio.run(_run_background(dp, bot))
+
+
+async def _run_background(dp, bot):
+    """Рассылки и сборка выгрузки заказов: on_startup с role='background', до SIGTERM от супервизора."""
+    workflow_data = {"dispatcher": dp, "bots": [bot], "role": "background"}
+    await dp.emit_startup(bot=bot, **workflow_data)
+    logging.info(f"Процесс фоновых задач запущен (pid {os.getpid()})")
+    try:
+        await wait_for_stop_signal((signal.SIGTERM,))
+    finally:
+        try:
+            await dp.emit_shutdown(bot=bot, **workflow_data)
+        finally:
+            await bot.session.close()
+
+
+# --- Супервизор ---
+class Supervisor:
+    """
+    Запускает BOT_WORKERS процессов-обработчиков и процесс фоновых задач.
+    Сам только получает обновления (polling или webhook) и раскладывает их по обработчикам
+    по from_user.id, поэтому все обновления одного пользователя идут в один процесс и по порядку.
+
+    app — функция модуля без аргументов, возвращающая (dp, bot). Процессы запускаются через spawn
+    и вызывают ее у себя: при перезапуске упавшего процесса fork унаследовал бы открытую сессию
+    aiohttp супервизора (привязана к его event loop и его соединениям) и его потоки.
+    """
+
+    def __init__(self, app, workers=BOT_WORKERS):
+        self.app = app
+        self.dp, self.bot = app()
+        self._ctx = multiprocessing.get_context('spawn')
+        self._queues = [self._ctx.Queue(WORKER_QUEUE_SIZE) for _ in range(workers)]
+        self._workers = [None] * workers
+        self._background = None
+        self._put_lock = None
+        self._stopping = False
+
+    def _restart_worker(self, index):
+        # Процесс, убитый внутри updates.get(), не отпускает блокировку чтения очереди, и замена
+        # ждала бы ее вечно. Замена получает новую очередь; необработанные обновления старой теряются
+        lost = self._queues[index].qsize()
+        if lost:
+            logging.warning(f"Обработчик #{index}: потеряно обновлений в очереди: {lost}")
+        self._queues[index] = self._ctx.Queue(WORKER_QUEUE_SIZE)
+        self._start_worker(index)
+
+    def _start_worker(self, index):
+        process = self._ctx.Process(target=_worker_main, args=(self.app, index, self._queues[index]),
+                                    name=f"bot-worker-{index}", daemon=True)
+        process.start()
+        self._workers[index] = process
+
+    def start_processes(self):
+        for index in range(len(self._workers)):
+            self._start_worker(index)
+        self._start_background()
+
+    def _start_background(self):
+        self._background = self._ctx.Process(target=_background_main, args=(self.app,), name="bot-background",
+                                            daemon=True)
+        self._background.start()
+
+    async def route(self, update):
+        index = update_user_id(update) % len(self._queues)
+        # Под общей блокировкой, чтобы ожидание места в очереди не переставило обновления одного пользователя
+        async with self._put_lock:
+            while True:
+                # Очередь берется заново на каждой попытке: при перезапуске обработчика ее заменяют
+                updates = self._queues[index]
+                try:
+                    updates.put_nowait(update)
+                    return
+                except queue.Full:
+                    pass
+                try:
+                    await asyncio.get_running_loop().run_in_executor(None, updates.put, update, True, QUEUE_PUT_TIMEOUT)
+                    return
+                except queue.Full:
+                    continue
+
+    async def _poll(self, allowed_updates):
+        offset = None
+        while True:
+            try:
+                updates = await self.bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT,
+                                                     allowed_updates=allowed_updates)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                logging.warning(f"Ошибка getUpdates: {e}")
+                await asyncio.sleep(POLLING_RETRY_DELAY)
+                continue
+            for update in updates:
+                await self.route(update.model_dump(mode='json', by_alias=True, exclude_none=True))
+                offset = update.update_id + 1
+
+    async def _monitor(self):
+        while not self._stopping:
+            await asyncio.sleep(MONITOR_INTERVAL)
+            for index, process in enumerate(self._workers):
+                if not process.is_alive() and not self._stopping:
+                    logging.error(f"Обработчик #{index} завершился с кодом {process.exitcode}, перезапускаю")
+                    mark_process_dead(process.pid)
+                    self._restart_worker(index)
+            # Без фонового процесса молча встанут рассылки, сжатие корзин и выгрузки
+            # и создание будущих секций заказов
+            if not self._background.is_alive() and not self._stopping:
+                logging.error(f"Процесс фоновых задач завершился с кодом {self._background.exitcode}, перезапускаю")
+                mark_process_dead(self._background.pid)
+                self._start_background()
+
+    async def serve(self, mode):
+        self._put_lock = asyncio.Lock()
+        allowed_updates = self.dp.resolve_used_update_types()
+        monitor = asyncio.create_task(self._monitor())
+        try:
+            if mode == "webhook":
+                await serve_webhook(self.bot, self.route, allowed_updates)
+            else:
+                await self.bot.delete_webhook()
+                poller = asyncio.create_task(self._poll(allowed_updates))
+                stop = asyncio.create_task(wait_for_stop_signal())
+                await asyncio.wait({poller, stop}, return_when=asyncio.FIRST_COMPLETED)
+                for task in (poller, stop):
+                    task.cancel()
+                await asyncio.gather(poller, stop, return_exceptions=True)
+                if poller.done() and not poller.cancelled() and poller.exception():
+                    raise poller.exception()
+        finally:
+            self._stopping = True
+            monitor.cancel()
+            await self._stop_processes()
+            await self.bot.session.close()
+
+    async def _stop_processes(self):
+        loop = asyncio.get_running_loop()
+        for updates in self._queues:
+            await loop.run_in_executor(None, updates.put, None)
+        for process in self._workers:
+            await loop.run_in_executor(None, process.join, SHUTDOWN_TIMEOUT)
+            if process.is_alive():
+                logging.warning(f"{process.name} не завершился за {SHUTDOWN_TIMEOUT} с, останавливаю принудительно")
+                process.kill()
+        self._background.terminate()
+        await loop.run_in_executor(None, self._background.join, SHUTDOWN_TIMEOUT)
+        logging.info("Все процессы бота остановлены")
+
+
+def run_supervisor(app, mode, workers=BOT_WORKERS):
+    supervisor = Supervisor(app, workers)
+    supervisor.start_processes()
+    # Метрики обработчиков и фонового процесса собираются через PROMETHEUS_MULTIPROC_DIR
+    start_metrics_server()
+    logging.info(f"Supervisor started: {workers} workers, mode {mode}")
+    asyncio.run(supervisor.serve(mode))
@@ -0,0 +1,152 @@
+import asyncio
+import hmac
+import logging
+import os
+import signal
+from contextlib import suppress
+from aiohttp import web
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Публичный адрес, на который Telegram шлет обновления, например https://shop.example.com
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+# Передается Telegram в setWebhook и проверяется в заголовке каждого запроса
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# Сколько обновлений обрабатывается одновременно; остальные запросы Telegram ждут свободного места
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv('WEBHOOK_MAX_CONCURRENCY', '100'))
+# Сколько секунд при остановке ждем завершения уже принятых обновлений
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', '30'))
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    """
+    HTTP-сервер для вебхука Telegram. Каждое обновление обрабатывается отдельной задачей
+    вызовом process_update(dict); число одновременных задач ограничено семафором.
+    Ответ Telegram отправляется сразу после того, как задача запущена.
+    """
+
+    def __init__(self, process_update, secret=WEBHOOK_SECRET, path=WEBHOOK_PATH,
+                 max_concurrency=WEBHOOK_MAX_CONCURRENCY):
+        if not secret:
+            raise RuntimeError("Вебхук без секрета принимал бы запросы от кого угодно")
+        self.process_update = process_update
+        self.secret = secret
+        self.path = path
+        self.app = web.Application()
+        self.app.router.add_post(path, self.handle)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tasks = set()
+        self._accepting = True
+        self._runner = None
+
+    def _check_secret(self, request):
+        token = request.headers.get(SECRET_HEADER, '')
+        return hmac.compare_digest(token.encode(), self.secret.encode())
+
+    async def handle(self, request):
+        if not self._check_secret(request):
+            logging.warning(f"Вебхук: запрос с неверным секретом от {request.remote}")
+            return web.Response(status=401)
+        if not self._accepting:
+            # Telegram повторит доставку позже, ее получит другой экземпляр или этот после рестарта
+            return web.Response(status=503)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        # Пока все места заняты, не отвечаем: Telegram не шлет новые обновления сверх max_connections
+        await self._semaphore.acquire()
+        if not self._accepting:
+            self._semaphore.release()
+            return web.Response(status=503)
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update):
+        try:
+            await self.process_update(update)
+        except Exception as e:
+            logging.error(f"Ошибка обработки обновления {update.get('update_id')}: {e}")
+        finally:
+            self._semaphore.release()
+
+    async def start(self, host=WEBHOOK_HOST, port=WEBHOOK_PORT):
+        self._runner = web.AppRunner(self.app, handle_signals=False)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logging.info(f"Вебхук слушает {host}:{port}{self.path}")
+
+    async def stop(self, drain_timeout=WEBHOOK_DRAIN_TIMEOUT):
+        """Перестает принимать обновления и ждет обработки уже принятых, не дольше drain_timeout."""
+        self._accepting = False
+        if self._tasks:
+            logging.info(f"Вебхук: дожидаюсь обработки {len(self._tasks)} обновлений")
+            _, pending = await asyncio.wait(set(self._tasks), timeout=drain_timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                logging.warning(f"Вебхук: прервано {len(pending)} обновлений по таймауту")
+                await asyncio.gather(*pending, return_exceptions=True)
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def wait_for_stop_signal(signals=(signal.SIGINT, signal.SIGTERM)):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in signals:
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+
+async def serve_webhook(bot, process_update, allowed_updates, url=WEBHOOK_URL):
+    """Поднимает сервер, регистрирует вебхук в Telegram и работает до сигнала остановки."""
+    if not url:
+        raise RuntimeError("Для режима webhook нужен WEBHOOK_URL")
+    if not WEBHOOK_SECRET:
+        # Без секрета любой, кто узнал адрес, может подделать обновления, например нажать «Я оплатил(а)»
+        raise RuntimeError("Для режима webhook нужен WEBHOOK_SECRET")
+
+    server = WebhookServer(process_update)
+    try:
+        await server.start()
+        await bot.set_webhook(
+            url=url.rstrip('/') + server.path,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=min(WEBHOOK_MAX_CONCURRENCY, 100),
+            allowed_updates=allowed_updates,
+        )
+        logging.info("Webhook mode started")
+        await wait_for_stop_signal()
+    finally:
+        # Вебхук в Telegram не удаляем: его продолжают обслуживать другие экземпляры бота
+        await server.stop()
+
+
+async def run_webhook(dp, bot, url=WEBHOOK_URL):
+    """Запускает бота в режиме вебхука: startup диспетчера, сервер, setWebhook; по сигналу — остановка."""
+    workflow_data = {"dispatcher": dp, "bots": [bot]}
+    await dp.emit_startup(bot=bot, **workflow_data)
+    try:
+        await serve_webhook(
+            bot,
+            lambda update: dp.feed_raw_update(bot, update, **workflow_data),
+            dp.resolve_used_update_types(),
+            url,
+        )
+    finally:
+        try:
+            await dp.emit_shutdown(bot=bot, **workflow_data)
+        finally:
+            await bot.session.close()